@@ -11,6 +11,7 @@ December 2019
 
 
 import os
+import logging
 from imageio import imread, imwrite
 import glob
 import pandas as pd
@@ -53,18 +54,23 @@ def read_xls(xls_file):
     return out
 
 
-def read_status(status_file, add_wet_radome = False):
+def read_status(status_file, add_wet_radome = False, fname = None):
     """Reads a radar xml status file
 
     Parameters
     ----------
-    fname : str
-        Full path of the status xml file to be read
+    status_file : str or bytes
+        Full path of the status xml file to be read, or its content as bytes
+        (as given by retrieve_prod_memory)
     add_wet_Radome : boolean (optional)
         For older files, there is not information about the wet radome. 
         If this is true, the script will estimate the wet radome precipitation
         as a 3 x 3 mean of the RZC product at the given time (as is done for
         more recent files)
+    fname : str (optional)
+        Name of the status file, the radar and the time are obtained from it
+        to estimate the wet radome, it is needed only if status_file is 
+        given as bytes
         
     Returns
     -------
@@ -72,16 +78,23 @@ def read_status(status_file, add_wet_radome = False):
     """
     
     # Reads a xml status file 
-    status = xmltodict.parse(open(status_file,'r').read())
+    if type(status_file) == bytes:
+        status = xmltodict.parse(status_file)
+    else:
+        status = xmltodict.parse(open(status_file,'r').read())
+        fname = status_file
     
     #  if wetradome is missing computes it
     radstat = status['status']['sweep'][-1]['RADAR']['STAT']
     
     if 'WET_RADOME' not in radstat.keys() and add_wet_radome:
+        if fname == None:
+            logging.warning('The wet radome can not be estimated without the name of the status file')
+            return status
         # get radar and time from filename
-        bname = os.path.basename(status_file)
+        bname = os.path.basename(fname)
         radar = bname[2]
-        time = datetime.strptime(bname[3:12],'%y%j%H%M')
+        time = datetime.datetime.strptime(bname[3:12],'%y%j%H%M')
         
         file_rzc = retrieve.retrieve_prod('/tmp/',time,time,'RZC')[0]
         rzc = read_cart(file_rzc)
@@ -156,6 +169,29 @@ def read_polar(polar_files, physic_value = True):
     return sweepnumbers, radar
     
     
+def _memmap_rf(cart_file):
+    """
+    Memory-maps a Cartesian file generated by the qpe module of this library,
+    either in DN (bytes) or float format, which is found from the file size
+    
+    Parameters
+    ----------
+    cart_file: str 
+        Full path of the file to read as a a string
+        
+    Returns
+    ----------
+    The memory-mapped raw data as a 2D array and a boolean that is True 
+    if the data is in DN format
+    """
+    nbins_x, nbins_y = constants.NBINS_X, constants.NBINS_Y
+    # Get from filesize if it is DN or float
+    DN = os.path.getsize(cart_file) == nbins_x * nbins_y
+    dtype = 'B' if DN else np.float32
+    data = np.memmap(cart_file, dtype = dtype, mode = 'r', 
+                     shape = (nbins_x, nbins_y))
+    return data, DN
+
 def read_cart(cart_file):
     '''
     Generic function that reads a Cartesian radar file, either in gif or 
@@ -178,25 +214,50 @@ def read_cart(cart_file):
     if extension == '.gif' or 'CPC' in cart_file:
         data = read_gif(cart_file)
     elif 'RF' in cart_file:
-         # Get from filesize if it is DN or float
-         size = os.path.getsize(cart_file)
-         DN = False
-         nbins_x, nbins_y = constants.NBINS_X, constants.NBINS_Y
-         if size == nbins_x * nbins_y:
-             DN = True
+         data, DN = _memmap_rf(cart_file)
          if DN:
-             data = np.fromfile(cart_file, dtype = 
-                                'B').reshape(nbins_x, nbins_y)
              data = constants.SCALE_CPC[data] # Convert to float
          else:
-             data = np.fromfile(cart_file, dtype = 
-                                np.float32).reshape(nbins_x, nbins_y)
+             data = np.array(data)
     else:
         data = read_cartesian_metranet(cart_file, physic_value = True)
         data = list(data.fields.values())[0]['data'].data.copy()
         data[data < constants.MIN_RZC_VALID] = 0
         data = np.flipud(np.squeeze(data))
     return data
+
+def read_cart_points(cart_file, rows, cols):
+    '''
+    Reads only some pixels of a Cartesian radar file, for files generated
+    by the qpe module of this library, the file is memory-mapped and only the
+    requested pixels are decoded, other formats are fully read with read_cart
+    
+    Parameters
+    ----------
+    cart_file: str 
+        Full path of the file to read as a a string
+    rows : array of int
+        row indexes of the pixels to read
+    cols : array of int
+        column indexes of the pixels to read, same length as rows
+           
+    Returns
+    ----------
+    The values of the requested pixels as a float32 numpy array
+        
+    '''
+    rows = np.asarray(rows, dtype = int)
+    cols = np.asarray(cols, dtype = int)
+    
+    extension = os.path.splitext(cart_file)[1]
+    if extension != '.gif' and 'CPC' not in cart_file and 'RF' in cart_file:
+        data, DN = _memmap_rf(cart_file)
+        points = data[rows, cols]
+        if DN:
+            points = constants.SCALE_CPC[points] # Convert to float
+    else:
+        points = read_cart(cart_file)[rows, cols]
+    return np.asarray(points, dtype = np.float32)
     
 def save_gif(gif_file, precip):
     '''
@@ -21,6 +21,11 @@ extracted for MDR and stored in /store/s83/owm/COSMO-1/ORDERS/MDR/
 **cosmo1T_to_rad** : same thing but for netCDF files of COSMO2 temperature
 extracted for MDR and stored in /store/msrad/cosmo/cosmo2/data/
 
+The cosmo*_to_rad tables are also available in a flat form, see 
+get_flat_cosmo_lookup, where the three indexes are replaced by a single 
+int32 offset in the flattened COSMO grid, for all sweeps at once, and the
+mask by a packed bitmap of the valid gates
+
 **station_to_rad** : maps the SMN stations to radar coordinates, it is an 
 extraction of the more generic but less convenient **qpegrid_to_rad** table
 It is list of 3 elements, first element is a dict with keys [station][sweep][ncode]
@@ -48,12 +53,25 @@ neighbour of every station in the QPE 2D grid 640 x 710 pixels
 
 **visibility_rad** : gives the (static) visibility of every polar gate 
 for a given sweep number in the form of a 2D field of size nazimuth x nrange
+
+The tables are stored as pickle (.p) files, they can be converted with 
+convert_lookups to a binary layout (a .lut folder with a json manifest and
+one .npy file per data type) that is read as memory-mapped arrays, so that 
+it is faster to read and shared by all processes. get_lookup uses the binary 
+layout when it is available and keeps the last used tables in memory, the 
+arrays it returns are shared and read-only
     
 """
 
 import pickle
 import os
 import glob
+import json
+import time
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import logging
 import numpy as np
@@ -71,6 +89,14 @@ DATA_FOLDER = Path(current_folder, 'data')
 LOOKUP_FOLDER = Path(DATA_FOLDER, 'lookup_data')
 
 
+# Version of the binary layout of the lookup tables, see convert_lookups
+LOOKUP_STORE_VERSION = 2
+# Lookup tables in memory, in the form (lookup_type, radar): (table, version)
+_LOOKUPS = OrderedDict()
+_LOOKUPS_LOCK = threading.Lock()
+# Maximal number of lookup tables in binary layout to keep in memory
+LOOKUP_CACHE = 32
+
 def get_lookup(lookup_type, radar = None):
     """Read a lookup table from the /data/lookup_data folder
 
@@ -97,39 +123,375 @@ def get_lookup(lookup_type, radar = None):
     Returns
     -------
     lut: dict
-        The lookup table in the form of a python dict
+        The lookup table in the form of a python dict, its arrays are shared
+        between all calls and are read-only, they must be copied before
+        being modified
     """
     
     if 'rad' in lookup_type and radar == None:
         raise ValueError('Please indicate radar name for this lookup type')
     
     if radar == None:
-        lut_name = str(Path(LOOKUP_FOLDER, 'lut_' + lookup_type + '.p'))
-        if not os.path.exists(lut_name):
-            raise FileNotFoundError('Lookup table {:s} could not be found!'
-                                        .format(lut_name))
-
-        lut = pickle.load(open(lut_name,'rb'))
+        lut = _load_lookup(lookup_type, '')
     else:
         if type(radar) != list:
             radar = [radar]
             
         lut = {}
         for r in radar:
-            lut_name = str(Path(LOOKUP_FOLDER, 'lut_' + lookup_type + r + '.p'))
-            if not os.path.exists(lut_name):
-                raise FileNotFoundError('Lookup table {:s} could not be found!'
-                                            .format(lut_name))
-    
-            lut[r] = pickle.load(open(lut_name,'rb'))
+            lut[r] = _load_lookup(lookup_type, r)
             
         if len(lut.keys()) == 1:
             lut = lut[r]
         
+    return _copy_lookup(lut)
+
+def _copy_lookup(lut):
+    """Copies the dicts, lists and tuples of a lookup table, the arrays are
+    shared with the lookup tables in memory and are read-only
+    """
+    if isinstance(lut, dict):
+        return {k: _copy_lookup(v) for k, v in lut.items()}
+    if isinstance(lut, tuple):
+        return tuple([_copy_lookup(v) for v in lut])
+    if isinstance(lut, list):
+        return [_copy_lookup(v) for v in lut]
+    return lut
+
+def _freeze_lookup(lut):
+    """Makes all arrays of a lookup table read-only"""
+    if isinstance(lut, dict):
+        for v in lut.values():
+            _freeze_lookup(v)
+    elif isinstance(lut, (list, tuple)):
+        for v in lut:
+            _freeze_lookup(v)
+    elif isinstance(lut, np.ndarray):
+        lut.setflags(write = False)
+
+def _load_lookup(lookup_type, radar):
+    """Reads a single lookup table, from memory if it was read recently, 
+    otherwise from its binary layout if it is up to date, or from the 
+    pickle file. The returned table is shared, its arrays are read-only.
+    Only the tables in binary layout are kept in memory, as their arrays 
+    are memory-mapped and take little space
+    """
+    lut_name = str(Path(LOOKUP_FOLDER, 'lut_' + lookup_type + radar + '.p'))
+    # The table in memory is used only if neither the pickle file nor the
+    # binary layout have changed since it was read
+    version = (os.path.realpath(lut_name[:-2] + '.lut'),
+               os.path.getmtime(lut_name) if os.path.exists(lut_name) else None)
+    key = (lookup_type, radar)
+    with _LOOKUPS_LOCK:
+        if key in _LOOKUPS.keys() and _LOOKUPS[key][1] == version:
+            _LOOKUPS.move_to_end(key)
+            return _LOOKUPS[key][0]
+        
+    lut = _read_lookup_store(lut_name)
+    if lut is None:
+        if not os.path.exists(lut_name):
+            raise FileNotFoundError('Lookup table {:s} could not be found!'
+                                        .format(lut_name))
+        lut = pickle.load(open(lut_name,'rb'))
+        _freeze_lookup(lut)
+        return lut
+    
+    with _LOOKUPS_LOCK:
+        _LOOKUPS[key] = (lut, version)
+        _LOOKUPS.move_to_end(key)
+        if len(_LOOKUPS) > LOOKUP_CACHE:
+            _LOOKUPS.popitem(last = False)
     return lut
 
+def convert_lookups(folder = LOOKUP_FOLDER):
+    """Converts all pickled lookup tables (.p files) of a folder to the 
+    binary layout used by get_lookup, i.e. a .lut folder with a manifest in
+    json format that describes the structure of the table and one .npy file
+    per data type that contains all arrays of the table. The .lut folder is
+    a link to the current version of the table, so that it can be converted 
+    again while other processes read it. The cosmo*_to_rad tables are also 
+    stored in flat form (see get_flat_cosmo_lookup) for the shape of the 
+    COSMO grid given by the coordinates file in the /data/ folder
+    
+    Parameters
+    ----------
+    folder : str (optional)
+        folder that contains the lookup tables, default is the 
+        /data/lookup_data folder
+    """
+    grid_shapes = {}
+    for lut_name in sorted(glob.glob(str(Path(folder, 'lut_*.p')))):
+        logging.info('Converting lookup table {:s}'.format(lut_name))
+        lut = pickle.load(open(lut_name,'rb'))
+        try:
+            _write_lookup_store(lut, lut_name)
+        except TypeError as e:
+            logging.warning('Could not convert {:s}: {:s}'.format(lut_name,
+                                                                  str(e)))
+        
+        # lut_<lookup_type><radar>.p
+        lookup_type = os.path.basename(lut_name)[4:-3]
+        radar = os.path.basename(lut_name)[-3]
+        if lookup_type in ['cosmo1_to_rad', 'cosmo2_to_rad', 
+                           'cosmo1T_to_rad', 'cosmo2T_to_rad']:
+            if lookup_type not in grid_shapes.keys():
+                try:
+                    grid_shapes[lookup_type] = _cosmo_grid_shape(lookup_type)
+                except (OSError, KeyError):
+                    logging.warning('Could not read the COSMO grid of {:s}'
+                                    .format(lookup_type))
+                    grid_shapes[lookup_type] = None
+            if grid_shapes[lookup_type] != None:
+                _save_flat_cosmo_lookup(lut, lookup_type, radar, 
+                                        grid_shapes[lookup_type], folder)
+                
+def _cosmo_grid_shape(lookup_type):
+    """Returns the shape of the COSMO grid (nz x ny x nx) used by a 
+    cosmo*_to_rad lookup table, from the coordinates file in the /data/ 
+    folder, as in calc_lookup
+    """
+    cosmo_version = int(lookup_type[5])
+    if lookup_type in ['cosmo1T_to_rad', 'cosmo2T_to_rad']:
+        fname_cosmo_coords =  Path(DATA_FOLDER, 'coords_COSMO{:d}_T.nc'.
+                                   format(cosmo_version))
+        with netCDF4.Dataset(fname_cosmo_coords) as coords_COSMO:
+            return tuple(coords_COSMO.variables['HFL'].shape)
+    else:
+        fname_cosmo_coords =  Path(DATA_FOLDER, 'coords_COSMO{:d}.nc'.
+                                   format(cosmo_version))
+        with netCDF4.Dataset(fname_cosmo_coords) as coords_COSMO:
+            shape = coords_COSMO.variables['HHL'].shape
+        # the heights of the levels are in the middle of the half levels
+        return (shape[0] - 1,) + tuple(shape[1:])
+    
+def _write_lookup_store(lut, lut_name):
+    """Writes a lookup table in binary layout next to its pickle file"""
+    arrays = {}
+    sizes = {}
+    
+    def encode(obj):
+        if isinstance(obj, np.ma.MaskedArray):
+            raise TypeError('masked arrays are not supported')
+        if isinstance(obj, (np.ndarray, np.generic)):
+            arr = np.asarray(obj)
+            dtype = arr.dtype.str
+            if arr.dtype.hasobject:
+                raise TypeError('object arrays are not supported')
+            offset = sizes.get(dtype, 0)
+            arrays.setdefault(dtype, []).append(arr.ravel())
+            sizes[dtype] = offset + arr.size
+            if isinstance(obj, np.generic): # numpy scalar
+                return {'s': [dtype, offset]}
+            return {'a': [dtype, offset, list(arr.shape)]}
+        if isinstance(obj, dict):
+            items = []
+            for k in obj.keys():
+                if isinstance(k, np.generic): # keep the numpy type
+                    items.append([k.item(), encode(obj[k]), k.dtype.str])
+                elif isinstance(k, (int, str)):
+                    items.append([k, encode(obj[k])])
+                else:
+                    raise TypeError('unsupported key {:s}'.format(str(k)))
+            return {'d': items}
+        if isinstance(obj, tuple):
+            return {'t': [encode(o) for o in obj]}
+        if isinstance(obj, list):
+            return {'l': [encode(o) for o in obj]}
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return {'v': obj}
+        raise TypeError('unsupported type {:s}'.format(str(type(obj))))
+    
+    manifest = {'version': LOOKUP_STORE_VERSION, 
+                'source_mtime': os.path.getmtime(lut_name),
+                'tree': encode(lut)}
+    
+    # Every version of the store is written to its own hidden folder and the
+    # store is a symbolic link to the current version, which is replaced at 
+    # once, so processes that mapped the previous version can keep reading it
+    store = lut_name[:-2] + '.lut'
+    version = str(Path(os.path.dirname(store), '.{:s}.{:d}.{:d}'.format(
+        os.path.basename(store), os.getpid(), time.time_ns())))
+    os.makedirs(version)
+    try:
+        for i, dtype in enumerate(arrays.keys()):
+            np.save(os.path.join(version, 'data{:d}.npy'.format(i)), 
+                    np.concatenate(arrays[dtype]))
+            manifest.setdefault('files', {})[dtype] = 'data{:d}.npy'.format(i)
+        with open(os.path.join(version, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+    except:
+        shutil.rmtree(version)
+        raise
+    
+    previous = None
+    if os.path.islink(store):
+        previous = os.path.realpath(store)
+    elif os.path.isdir(store): # written by an older version
+        shutil.rmtree(store)
+    os.symlink(os.path.basename(version), version + '.link')
+    os.replace(version + '.link', store)
+    if previous != None and os.path.isdir(previous):
+        shutil.rmtree(previous)
+        
+def _read_lookup_store(lut_name):
+    """Reads a lookup table in binary layout, the arrays are memory-mapped,
+    returns None if the table is not available in binary layout or if it is
+    older than its pickle file
+    """
+    store = os.path.realpath(lut_name[:-2] + '.lut')
+    manifest_name = os.path.join(store, 'manifest.json')
+    try:
+        with open(manifest_name, 'r') as f:
+            manifest = json.load(f)
+        if manifest['version'] != LOOKUP_STORE_VERSION:
+            return None
+        if (os.path.exists(lut_name) and 
+            os.path.getmtime(lut_name) != manifest['source_mtime']):
+            logging.warning('{:s} is outdated, please run convert_lookups'
+                            .format(lut_name[:-2] + '.lut'))
+            return None
+        
+        data = {}
+        for dtype in manifest.get('files', {}).keys():
+            data[dtype] = np.load(os.path.join(store, 
+                                               manifest['files'][dtype]),
+                                  mmap_mode = 'r')
+    except (OSError, ValueError):
+        # Not available, or replaced by convert_lookups in the meantime
+        return None
+        
+    def decode(node):
+        if 'a' in node.keys():
+            dtype, offset, shape = node['a']
+            size = int(np.prod(shape))
+            return data[dtype][offset:offset + size].reshape(shape)
+        if 's' in node.keys():
+            dtype, offset = node['s']
+            return data[dtype][offset]
+        if 'd' in node.keys():
+            out = {}
+            for item in node['d']:
+                k = item[0]
+                if len(item) == 3:
+                    k = np.dtype(item[2]).type(k)
+                out[k] = decode(item[1])
+            return out
+        if 't' in node.keys():
+            return tuple([decode(v) for v in node['t']])
+        if 'l' in node.keys():
+            return [decode(v) for v in node['l']]
+        return node['v']
+    
+    return decode(manifest['tree'])
+
+
+def get_flat_cosmo_lookup(lookup_type, radar, shape):
+    """Reads a cosmo*_to_rad lookup table in flat form, as stored by 
+    calc_lookup or convert_lookups, if it is not available, does not 
+    correspond to the shape of the COSMO grid or is older than the pickle 
+    file of the lookup table, it is computed in memory from the standard 
+    lookup table
+
+    Parameters
+    ----------
+    lookup_type : str
+        the lookup table type, must be one of
+        
+        -   cosmo1_to_rad
+        -   cosmo2_to_rad
+        -   cosmo1T_to_rad
+        -   cosmo2T_to_rad
+    radar : char
+        the radar for which to retrieve the lookup table, must be either 
+        'A', 'D', 'L', 'W' or 'P'
+    shape : tuple
+        shape of the COSMO grid (nz x ny x nx)
+
+    Returns
+    -------
+    lut: dict
+        A dict with keys 'offsets' (offsets of all gates in the flattened 
+        COSMO grid, for all sweeps one after the other), 'valid' (bool array
+        with the gates within the COSMO domain), 'sweeps' (sweep numbers), 
+        'bounds' (first and last offsets of every sweep) and 'shapes' (shape 
+        of every sweep)
+    """
+    lut_name = str(Path(LOOKUP_FOLDER, 'lut_' + lookup_type + radar + 
+                        '_flat.npz'))
+    source_name = str(Path(LOOKUP_FOLDER, 'lut_' + lookup_type + radar + 
+                           '.p'))
+    if os.path.exists(lut_name) and os.path.exists(source_name):
+        with np.load(lut_name) as data:
+            if ('source_mtime' in data.files and 
+                data['source_mtime'] == os.path.getmtime(source_name) and
+                tuple(data['grid_shape']) == tuple(shape)):
+                lut = {k: data[k] for k in ['offsets', 'sweeps', 'bounds',
+                                            'shapes']}
+                lut['valid'] = np.unpackbits(data['valid'], 
+                                count = len(lut['offsets'])).astype(np.bool_)
+                return lut
+    
+    logging.info('No up to date flat lookup table {:s} for a COSMO grid of shape {:s}, computing it'
+                 .format(lut_name, str(tuple(shape))))
+    return _flatten_cosmo_lookup(get_lookup(lookup_type, radar), shape)
 
-def calc_lookup(lookup_type, radar = None):
+def _flatten_cosmo_lookup(lut, shape):
+    """Converts a cosmo*_to_rad lookup table to its flat form, see
+    get_flat_cosmo_lookup, the gates whose indexes are outside of the 
+    COSMO grid are marked as invalid
+    """
+    sweeps = sorted(lut.keys())
+    offsets = []
+    valid = []
+    shapes = []
+    n_outside = 0
+    for sweep in sweeps:
+        idx = [np.asarray(lut[sweep][k]).ravel() for k in ['idx0', 'idx1',
+                                                           'idx2']]
+        inside = np.logical_and.reduce([np.logical_and(i >= 0, i < n) 
+                                        for i, n in zip(idx, shape)])
+        n_outside += np.sum(~inside)
+        idx = [np.where(inside, i, 0) for i in idx]
+        offsets.append(np.ravel_multi_index(idx, shape))
+        valid.append(np.logical_and(inside, 
+                    ~np.asarray(lut[sweep]['mask'], dtype = np.bool_).ravel()))
+        shapes.append(lut[sweep]['idx0'].shape)
+    bounds = np.cumsum([0] + [len(o) for o in offsets])
+    
+    if n_outside:
+        logging.warning('{:d} gates of the lookup table are outside of the COSMO grid of shape {:s}, they will be masked'
+                        .format(n_outside, str(tuple(shape))))
+    
+    return {'offsets': np.concatenate(offsets).astype(np.int32),
+            'valid': np.concatenate(valid),
+            'sweeps': np.array(sweeps),
+            'bounds': np.array([bounds[:-1], bounds[1:]]).T,
+            'shapes': np.array(shapes)}
+
+def _save_flat_cosmo_lookup(lut, lookup_type, radar, shape, 
+                            folder = LOOKUP_FOLDER):
+    """Converts a cosmo*_to_rad lookup table to its flat form, see
+    get_flat_cosmo_lookup, and stores it next to its pickle file, with the
+    modification time of the pickle file
+    """
+    flat_lut = _flatten_cosmo_lookup(lut, shape)
+    lut_name = str(Path(folder, 'lut_' + lookup_type + radar + '_flat.npz'))
+    source_name = str(Path(folder, 'lut_' + lookup_type + radar + '.p'))
+    try:
+        tmp_name = lut_name + '.{:d}.tmp'.format(os.getpid())
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, grid_shape = np.array(shape), 
+                     source_mtime = os.path.getmtime(source_name),
+                     offsets = flat_lut['offsets'], 
+                     valid = np.packbits(flat_lut['valid']),
+                     sweeps = flat_lut['sweeps'], bounds = flat_lut['bounds'],
+                     shapes = flat_lut['shapes'])
+        os.replace(tmp_name, lut_name)
+    except OSError:
+        logging.warning('Could not store lookup table {:s}'.format(lut_name))
+    return flat_lut
+
+def calc_lookup(lookup_type, radar = None, max_workers = 1):
     """Calculates a lookup table and stores it in the /data/lookup_data folder
 
     Parameters
@@ -151,6 +513,9 @@ def calc_lookup(lookup_type, radar = None):
         the radar for which to retrieve the lookup table, needed only
         if the lookup_type contains the term 'rad', must be either 'A', 'D', 'L',
         'W' or 'P'
+    max_workers : int (optional)
+        number of processes used to compute the tables of several radars 
+        in parallel, currently only used for station_to_rad
     """
     
     # Default is to use all sweeps, and a window of 25 (5 x 5) pixels 
@@ -160,80 +525,16 @@ def calc_lookup(lookup_type, radar = None):
     neighb_y = 5
                 
     if lookup_type == 'station_to_rad':
-        offset_x = int((neighb_x-1)/2)
-        offset_y = int((neighb_y-1)/2)
-            
-        for r in radar:
-            lut_name =  Path(LOOKUP_FOLDER, 'lut_station_to_rad{:s}.p'.format(r))
-            logging.info('Creating lookup table {:s}'.format(str(lut_name)))
-            try:
-                lut_cart = get_lookup('qpegrid_to_rad', radar)
-            except:
-                raise IOError('Could not load qpegrid_to_rad lookup for radar {:s}, compute it first!'.format(r))
-            try:
-                lut_coords = get_lookup('cartcoords_rad', radar)
-            except:    
-                raise IOError('Could not load cartcoords_rad lookup for radar {:s}, compute it first!'.format(r))
-                
-            stations = list(constants.METSTATIONS['Abbrev'])
-            
-            all_idx_sta = {}
-            all_distances_sta = {}
-            all_heights_sta = {}
-            
-            # Get x and y of all radar pixels    
-            for sweep in sweeps:        
-                sweep_idx = sweep - 1
-                for station in stations:
-                    station_data = constants.METSTATIONS[constants.METSTATIONS.Abbrev 
-                                                      == station]
-                    x_sta =  float(station_data.X)
-                    y_sta = float(station_data.Y)
-                    
-                    # For x the columns in the Cartesian lookup tables are lower bounds
-                    # e.g. x = 563, means that radar pixels are between 563 and 564
-                    x_llc_sta = np.int(x_sta/constants.CART_GRID_SIZE)
-                    # For y the columns in the Cartesian lookup tables are upper bounds
-                    # e.g. x = 182, means that radar pixels are between 181 and 182            
-                    y_llc_sta = np.int(np.ceil(y_sta/constants.CART_GRID_SIZE))
-                    
-                    # Distance from all gates to gauge
-                    idx = lut_cart[np.logical_and(lut_cart[:,0] == sweep_idx,
-                                          np.logical_and(lut_cart[:,3] == y_llc_sta, 
-                                          lut_cart[:,4] == x_llc_sta)), 0:3]
-                    
-                    if not len(idx):
-                        continue
-                    
-                    if station not in all_idx_sta.keys():
-                        all_idx_sta[station] = {}
-                        all_heights_sta[station] = {}
-                        all_distances_sta[station] = np.sqrt((lut_coords[sweep][0] - x_sta)**2+
-                                 (lut_coords[sweep][1] - y_sta)**2)
-                    
-                    if sweep not in  all_idx_sta[station].keys():
-                        all_idx_sta[station][sweep] = {}
-                        
-                        
-                    all_heights_sta[station][sweep] = np.nanmean(lut_coords[sweep][2][idx[:,1],
-                                        idx[:,2]])
-            
-                    for i in range(-offset_x, offset_x + 1):
-                        for j in range(-offset_y, offset_y + 1):
-                            x_llc = x_llc_sta + i
-                            y_llc = y_llc_sta + j 
-                            
-                            idx = lut_cart[np.logical_and(lut_cart[:,0] == sweep_idx,
-                                          np.logical_and(lut_cart[:,3] == x_llc, 
-                                          lut_cart[:,4] == y_llc)), 0:3]
-               
-                            key = str(i)+str(j)
-                            if len( idx[:,1:3]):
-                                all_idx_sta[station][sweep][key] = idx[:,1:3]
-    
-            
-            pickle.dump([all_idx_sta, all_distances_sta, all_heights_sta],
-                        open(str(lut_name), 'wb'))
+        # Every radar is independent, so they can be computed in parallel
+        radars = list(radar)
+        n = len(radars)
+        if max_workers > 1 and n > 1:
+            with ProcessPoolExecutor(min(max_workers, n)) as executor:
+                list(executor.map(_calc_station_to_rad, radars, [sweeps] * n,
+                                  [neighb_x] * n, [neighb_y] * n))
+        else:
+            for r in radars:
+                _calc_station_to_rad(r, sweeps, neighb_x, neighb_y)
     elif lookup_type in ['cosmo1_to_rad', 'cosmo2_to_rad']:
         
         converter = GPSConverter()
@@ -295,6 +596,7 @@ def calc_lookup(lookup_type, radar = None):
                 lut[sweep]['mask'] = mask.astype(np.bool_)
             
             pickle.dump(lut, open(str(lut_name), 'wb'))
+            _save_flat_cosmo_lookup(lut, lookup_type, r, z_c.shape)
     
     elif lookup_type in ['cosmo1T_to_rad', 'cosmo2T_to_rad']:
         cosmo_version = int(lookup_type[5])
@@ -349,6 +651,7 @@ def calc_lookup(lookup_type, radar = None):
                 lut[sweep]['mask'] = mask.astype(np.bool_)
              
             pickle.dump(lut, open(str(lut_name), 'wb'))
+            _save_flat_cosmo_lookup(lut, lookup_type, r, z_c.shape)
         
     elif lookup_type == 'qpebias_station':
         biasfile = Path(DATA_FOLDER, 'lbias_af_map15.dat')
@@ -358,50 +661,41 @@ def calc_lookup(lookup_type, radar = None):
         # TODO
     elif lookup_type == 'station_to_qpegrid':
            
-        df_stations = constants.METSTATIONS
+        df_stations = pd.concat([constants.METSTATIONS, constants.RADARS])
     
         offset_x = int((neighb_x-1)/2)
         offset_y = int((neighb_y-1)/2)
         
-        df_stations = df_stations.append(constants.RADARS)
-            
-    
         all_idx_sta = {}
         x_qpe = constants.X_QPE
         y_qpe = constants.Y_QPE
-        y,x = np.meshgrid(y_qpe,x_qpe)
-        # Get x and y of all radar pixels                 
-        for station in stations:
+        
+        for station, x_sta, y_sta in zip(df_stations.Abbrev, df_stations.X,
+                                         df_stations.Y):
             all_idx_sta[station] = {}
-            station_data = df_stations[df_stations.Abbrev == station]
-            y_sta =  float(station_data.Y)
-            x_sta = float(station_data.X)
             
             # For x the columns in the Cartesian lookup tables are lower bounds
             # e.g. x = 563, means that radar pixels are between 563 and 564
-            y_llc_sta = np.int(y_sta / constants.CART_GRID_SIZE)
+            y_llc_sta = int(float(y_sta) / constants.CART_GRID_SIZE)
             # For y the columns in the Cartesian lookup tables are upper bounds
             # e.g. x = 182, means that radar pixels are between 181 and 182            
-            x_llc_sta = np.int(np.ceil(x_sta / constants.CART_GRID_SIZE))
+            x_llc_sta = int(np.ceil(float(x_sta) / constants.CART_GRID_SIZE))
+            
+            # Find index of all neighbours of the station in the cart grid
+            idx_x = _axis_index(x_qpe, x_llc_sta + 
+                                np.arange(-offset_x, offset_x + 1))
+            idx_y = _axis_index(y_qpe, y_llc_sta + 
+                                np.arange(-offset_y, offset_y + 1))
             
-          
             for i in range(-offset_y, offset_y + 1):
-                print(i)
                 for j in range(-offset_x, offset_x + 1):
-                    print(j)
-                    x_llc = x_llc_sta + j
-                    y_llc = y_llc_sta + i 
-                    # Find index of station in cart grid
-                    idx =  np.where(np.logical_and(x == x_llc, 
-                                  y == y_llc))
-                 
-                    idx = [int(idx[0]),int(idx[1])]
+                    idx = [int(idx_x[j + offset_x]), int(idx_y[i + offset_y])]
                     key = str(i)+str(j)
-                    if len( idx):
+                    if min(idx) >= 0:
                         all_idx_sta[station][key] = idx
 
         lut_name = Path(LOOKUP_FOLDER, 'lut_station_to_qpegrid.p')
-        pickle.dump(all_idx_sta, open(str(lut_name)),'wb')
+        pickle.dump(all_idx_sta, open(str(lut_name), 'wb'))
     
     elif lookup_type == 'cartcoords_rad':
         converter = GPSConverter()
@@ -469,6 +763,132 @@ def calc_lookup(lookup_type, radar = None):
             pickle.dump(lut, open(str(lut_name), 'wb'))
             
 
+def _calc_station_to_rad(radar, sweeps, neighb_x, neighb_y):
+    """Computes the station_to_rad lookup table of a single radar and stores 
+    it in the /data/lookup_data folder, see calc_lookup
+    """
+    offset_x = int((neighb_x-1)/2)
+    offset_y = int((neighb_y-1)/2)
+    
+    lut_name =  Path(LOOKUP_FOLDER, 'lut_station_to_rad{:s}.p'.format(radar))
+    logging.info('Creating lookup table {:s}'.format(str(lut_name)))
+    try:
+        lut_cart = get_lookup('qpegrid_to_rad', radar)
+    except:
+        raise IOError('Could not load qpegrid_to_rad lookup for radar {:s}, compute it first!'.format(radar))
+    try:
+        lut_coords = get_lookup('cartcoords_rad', radar)
+    except:    
+        raise IOError('Could not load cartcoords_rad lookup for radar {:s}, compute it first!'.format(radar))
+        
+    # Sort the table once, instead of scanning it for every pixel
+    lut_cart = _sort_qpegrid_lut(lut_cart)
+    stations = constants.METSTATIONS
+    
+    all_idx_sta = {}
+    all_distances_sta = {}
+    all_heights_sta = {}
+    
+    # Get x and y of all radar pixels    
+    for sweep in sweeps:        
+        sweep_idx = sweep - 1
+        for station, x_sta, y_sta in zip(stations.Abbrev, stations.X,
+                                         stations.Y):
+            x_sta = float(x_sta)
+            y_sta = float(y_sta)
+            
+            # For x the columns in the Cartesian lookup tables are lower bounds
+            # e.g. x = 563, means that radar pixels are between 563 and 564
+            x_llc_sta = int(x_sta/constants.CART_GRID_SIZE)
+            # For y the columns in the Cartesian lookup tables are upper bounds
+            # e.g. x = 182, means that radar pixels are between 181 and 182            
+            y_llc_sta = int(np.ceil(y_sta/constants.CART_GRID_SIZE))
+            
+            # Distance from all gates to gauge
+            idx = _qpegrid_gates(lut_cart, sweep_idx, y_llc_sta, x_llc_sta)
+            
+            if not len(idx):
+                continue
+            
+            if station not in all_idx_sta.keys():
+                all_idx_sta[station] = {}
+                all_heights_sta[station] = {}
+                all_distances_sta[station] = np.sqrt((lut_coords[sweep][0] - x_sta)**2+
+                         (lut_coords[sweep][1] - y_sta)**2)
+            
+            if sweep not in  all_idx_sta[station].keys():
+                all_idx_sta[station][sweep] = {}
+                
+            all_heights_sta[station][sweep] = np.nanmean(lut_coords[sweep][2][idx[:,1],
+                                idx[:,2]])
+    
+            # i is the offset along Swiss X (south to north) and j along 
+            # Swiss Y (west to east), the key is str(i) + str(j)
+            for i in range(-offset_x, offset_x + 1):
+                for j in range(-offset_y, offset_y + 1):
+                    x_llc = x_llc_sta + i
+                    y_llc = y_llc_sta + j 
+                    
+                    idx = _qpegrid_gates(lut_cart, sweep_idx, y_llc, x_llc)
+       
+                    key = str(i)+str(j)
+                    if len( idx[:,1:3]):
+                        all_idx_sta[station][sweep][key] = idx[:,1:3]
+
+    pickle.dump([all_idx_sta, all_distances_sta, all_heights_sta],
+                open(str(lut_name), 'wb'))
+
+def _sort_qpegrid_lut(lut_cart):
+    """Sorts a qpegrid_to_rad lookup table along the composite key 
+    (sweep, Swiss Y coord, Swiss X coord), so that the gates of a given sweep 
+    and Cartesian pixel are contiguous and can be found by _qpegrid_gates 
+    with a binary search instead of a scan of the whole table
+    
+    Returns
+    -------
+    A tuple (sorted table, sorted keys, key origin, key extent)
+    """
+    lut_cart = np.asarray(lut_cart)
+    cols = lut_cart[:,[0,3,4]]
+    # Gates with non-integer coordinates can never match a pixel
+    lut_cart = lut_cart[np.all(np.round(cols) == cols, axis = 1)]
+    cols = lut_cart[:,[0,3,4]].astype(np.int64)
+    
+    order = np.lexsort((cols[:,2], cols[:,1], cols[:,0]))
+    lut_cart = lut_cart[order]
+    cols = cols[order]
+    
+    if len(cols):
+        origin = cols.min(axis = 0)
+        extent = cols.max(axis = 0) - origin + 1
+    else:
+        origin = extent = np.ones(3, dtype = np.int64)
+    keys = ((cols[:,0] - origin[0]) * extent[1] + cols[:,1] - origin[1]) * \
+        extent[2] + cols[:,2] - origin[2]
+    return lut_cart, keys, origin, extent
+
+def _qpegrid_gates(sorted_lut, sweep_idx, coord_y, coord_x):
+    """Returns the columns | sweep | azimuth_idx | range_idx | of all gates 
+    of a given sweep (0-indexed) that fall within a given Cartesian pixel,
+    sorted_lut is the output of _sort_qpegrid_lut
+    """
+    lut_cart, keys, origin, extent = sorted_lut
+    key = np.array([sweep_idx, coord_y, coord_x]) - origin
+    if np.any(key < 0) or np.any(key >= extent):
+        return lut_cart[0:0, 0:3]
+    key = (key[0] * extent[1] + key[1]) * extent[2] + key[2]
+    return lut_cart[np.searchsorted(keys, key, side = 'left'):
+                    np.searchsorted(keys, key, side = 'right'), 0:3]
+
+def _axis_index(axis, values):
+    """Returns the index of every value in a 1D axis, or -1 if the value is
+    not part of the axis
+    """
+    order = np.argsort(axis)
+    pos = np.searchsorted(axis[order], values)
+    pos = np.minimum(pos, len(axis) - 1)
+    return np.where(axis[order][pos] == values, order[pos], -1)
+
 def _WGS_to_COSMO(coords_WGS, SP_coords = (-43,10)): 
      if isinstance(coords_WGS, tuple): 
          coords_WGS=np.vstack(coords_WGS) 
@@ -24,14 +24,62 @@ from .io_data import read_status, read_vpr
 from . import constants
 from .lookup import get_lookup
 
+# Fields of Radar that are computed on demand from other fields, in the form
+# name : (input fields, method that computes the field for a single sweep)
+DERIVED_FIELDS = {'NH': ([], '_compute_noise'),
+                  'NV': ([], '_compute_noise'),
+                  'ZH_VISIB': (['ZH', 'VISIB'], '_compute_visib'),
+                  'ZV_VISIB': (['ZV', 'VISIB'], '_compute_visib'),
+                  'PHIDP': (['ZH', 'PSIDP'], '_compute_phidp'),
+                  'KDP': (['PHIDP'], '_compute_kdp'),
+                  'AH': (['ZH', 'ZDR', 'PHIDP', 'T'], '_compute_attenuation'),
+                  'ZH_CORR': (['ZH', 'ZDR', 'PHIDP', 'T'], '_compute_attenuation'),
+                  'ZDR_CORR': (['ZH', 'ZDR', 'PHIDP', 'T'], '_compute_attenuation'),
+                  'ZV_CORR': (['ZH', 'ZDR', 'ZV', 'PHIDP', 'T'], '_compute_attenuation'),
+                  'HYDRO': (['ZH', 'ZDR', 'RHOHV', 'KDP', 'T'], '_compute_hydro')}
+
+def required_moments(variables):
+    """
+    Gives the radar moments that must be decoded from the polar files to
+    get a set of variables
+    
+    Parameters
+    ----------
+    variables : list of str
+        list of variables, as used in Radar.get_field, i.e. moments 
+        (e.g. ZH, ZDR), derived variables (e.g. ZH_VISIB, KDP) or their 
+        linear counterpart in lowercase (e.g. zh), other variables (COSMO, 
+        height...) are ignored
+    
+    Returns
+    -------
+    The list of required moments, ZH is always included
+    """
+    moments = ['ZH']
+    for v in variables:
+        v = v.upper()
+        if v in constants.PYART_NAMES_MAPPING.values():
+            needed = [v]
+        elif v in DERIVED_FIELDS.keys():
+            needed = required_moments(DERIVED_FIELDS[v][0])
+        else:
+            needed = []
+        for m in needed:
+            if m not in moments:
+                moments.append(m)
+    return moments
+
 class Radar(object):
     '''
     A class that contains polar radar data and performs some pre-processing
     before adding that data to the database or computing the QPE product
     The different elevations are stored in a dictionary rather as in a
     single pyart radar instance as this was found to be faster in practice
+    The derived fields (see DERIVED_FIELDS) are computed for a given sweep 
+    only when they are first needed, and then kept
     '''
-    def __init__(self, radname, polfiles, statusfile = None, vprfile = None):
+    def __init__(self, radname, polfiles, statusfile = None, vprfile = None,
+                 fields = None):
         """
         Creates an Radar class instance
         
@@ -43,16 +91,41 @@ class Radar(object):
             List of full filepaths of the radar files for a given timestemp,
             one file for every elevation, typically obtained with
             the retrieve_prod function in the common submodule
-        statusfile: str (optional)
+        statusfile: str or bytes (optional)
             Full path of the status file that corresponds to this particular
-            radar and timestep, used to compute noise estimates
+            radar and timestep, used to compute noise estimates, or its 
+            content as bytes
         vprfile : str(optional)
              Full path of the vpr xml file that corresponds to this particular
             radar and timestep, used to compute VPR correction
+        fields : list of str (optional)
+            List of the radar moments to decode from the polar files, e.g.
+            ZH, ZDR, RHOHV, see required_moments. The other moments are 
+            decoded only when they are first needed. If not specified, all 
+            moments are decoded
         """
         
         self.sweeps = []
         self.radsweeps = {}
+        self.polfiles = {}
+        
+        # Moments that are not decoded yet
+        self.lazyfields = []
+        include_fields = None
+        if fields != None:
+            fields = required_moments(fields)
+            self.lazyfields = [v for v in constants.PYART_NAMES_MAPPING.values()
+                               if v not in fields]
+            include_fields = [k for k in constants.PYART_NAMES_MAPPING.keys()
+                              if constants.PYART_NAMES_MAPPING[k] in fields]
+        # SNR mask of every sweep, applied to the fields computed later
+        self._snr_masks = {}
+        # Masks of the fields before the SNR masking, for the visibility
+        # correction
+        self._presnr_masks = {}
+        # Parameters of the visibility correction and of the KDP estimation
+        self._visib_params = None
+        self._kdp_params = None
         
         visib = get_lookup('visibility_rad', radname)
         
@@ -60,7 +133,8 @@ class Radar(object):
         for f in polfiles:
             try:
                 sweep = sweepnumber_fromfile(f)
-                radinstance = read_metranet(f, reader = 'python')
+                radinstance = read_metranet(f, reader = 'python',
+                                            include_fields = include_fields)
                 rename_fields(radinstance)
                 visib_sweep = np.ma.array(visib[sweep].astype(np.float32), 
                                           mask = np.isnan(visib[sweep]))
@@ -70,6 +144,7 @@ class Radar(object):
                 
                 
                 self.radsweeps[sweep] = radinstance
+                self.polfiles[sweep] = f
                 self.sweeps.append(sweep)
             except:
                 logging.error('Could not read file {:s}'.format(f))
@@ -80,7 +155,6 @@ class Radar(object):
         if statusfile != None:
             try:
                 self.status =  read_status(statusfile)
-                self.compute_noise()
             except:
                 logging.error('Could not compute noise from status file!')
                 pass
@@ -93,8 +167,10 @@ class Radar(object):
                 pass
             
     
-        # To keep track of the nature of data fields
+        # To keep track of the nature of data fields, the SNR mask applies
+        # to all radar fields
         self.radarfields = list(self.radsweeps[self.sweeps[0]].fields.keys())
+        self.radarfields.extend(self.lazyfields + ['NH', 'NV'])
         self.cosmofields = [] # updated later
         self.precipfield  = [] # updated later
   
@@ -110,6 +186,8 @@ class Radar(object):
         
         for s in self.sweeps:
             radsweep = self.radsweeps[s]
+            self._compute_field(s, 'ZH')
+            self._compute_field(s, 'NH')
                             
             if 'NH' not in radsweep.fields:
                 msg = '''Could not find NH (noise) field in radar instance, 
@@ -123,13 +201,25 @@ class Radar(object):
             # Mask data below SNR and with visib < threshold
             masked = snr < snr_threshold
             
+            if self._visib_params != None:
+                # The visibility correction uses the data before SNR masking
+                self._presnr_masks[s] = {}
+                for k in ['ZH', 'ZV', 'VISIB']:
+                    if k in radsweep.fields:
+                        self._presnr_masks[s][k] = np.ma.getmaskarray(
+                            radsweep.fields[k]['data']).copy()
+                        
             for k in self.radarfields: # Apply only to radar data, COSMO not affected
-                radsweep.fields[k]['data'].mask[masked] = True
+                if k in radsweep.fields: # fields not computed yet are skipped
+                    radsweep.fields[k]['data'].mask[masked] = True
+            self._snr_masks[s] = np.ma.getdata(masked)
         
     def visib_mask(self, min_visib, max_visib_corr):
         """
-        Masks the radar data at low visibility and corrects the reflectivity
-        for visibility
+        Sets the parameters of the visibility correction, the radar data is
+        masked at low visibility and the reflectivities are corrected for 
+        visibility, in the fields ZH_VISIB and ZV_VISIB, which are computed
+        when they are first needed
         
         Parameters
         ----------
@@ -140,74 +230,13 @@ class Radar(object):
             is 100/VISIB (with VISIB in %) and can be thresholded with this 
             parameter. This is usually set to 2 at MeteoSwiss
         """
-        
-        for s in self.sweeps:
-            radsweep = self.radsweeps[s]
-            visib = radsweep.fields['VISIB']['data']
-
-            z = radsweep.fields['ZH']['data']
-            zlin = 10 ** (0.1 * z)
-            corr = 1./(visib/100.)
-            corr[corr >= max_visib_corr] = max_visib_corr
-           
-            zlin_corr = zlin * corr
-            # mask
-            zlin_corr.mask[visib < min_visib ] = True
-            radsweep.add_field('ZH_VISIB',{'data': 10 * np.log10(zlin_corr)})
-            
-
-            z = radsweep.fields['ZV']['data']
-            zlin = 10 ** (0.1 * z)
-            corr = 1. / (visib / 100.)
-            corr[corr >= max_visib_corr] = max_visib_corr
-
-            zlin_corr = zlin * corr
-            # mask
-            zlin_corr.mask[visib < min_visib ] = True
-            radsweep.add_field('ZV_VISIB',{'data':  10 * np.log10(zlin_corr)})
+        self._visib_params = (min_visib, max_visib_corr)
 
     def compute_noise(self):
         """
-        Computes a noise estimate from a status file
+        Computes a noise estimate from a status file, for all sweeps
         """
-        
-        for i,s in enumerate(self.sweeps):
-            radsweep = self.radsweeps[s]
-            try:
-                noise_h = float(self.status['status']['sweep'][i]['RADAR']['STAT']
-                            ['CALIB']['noisepower_frontend_h_inuse']['@value'])
-                rconst_h = float(self.status['status']['sweep'][i]['RADAR']['STAT']
-                                            ['CALIB']['rconst_h']['@value'])
-                noisedBADU_h = 10.*np.log10(noise_h) + rconst_h
-                
-                noise_v = float(self.status['status']['sweep'][i]['RADAR']['STAT']
-                                ['CALIB']['noisepower_frontend_v_inuse']['@value'])
-                rconst_v = float(self.status['status']['sweep'][i]['RADAR']['STAT']
-                                        ['CALIB']['rconst_v']['@value'])
-                noisedBADU_v = 10.*np.log10(noise_v) + rconst_v
-                
-            except:
-                # default noise
-                noisedBADU_h = constants.NOISE_100
-                noisedBADU_v = constants.NOISE_100
-                pass
-            
-            noisedBZ_h = compute_noisedBZ(radsweep.nrays, noisedBADU_h,
-                    radsweep.range['data'], 100.,
-                    noise_field='noisedBZ_hh')
-                
-            noisedBZ_v = compute_noisedBZ(radsweep.nrays, noisedBADU_v,
-                    radsweep.range['data'], 100.,
-                    noise_field='noisedBZ_vv')
-            
-            # Convert to masked array for consistency
-            noisedBZ_h['data'] = np.ma.array(noisedBZ_h['data'], 
-                                        mask = np.isnan(noisedBZ_h['data'])) 
-            noisedBZ_v['data'] = np.ma.array(noisedBZ_v['data'], 
-                                        mask = np.isnan(noisedBZ_v['data']))    
-            
-            radsweep.add_field('NH', noisedBZ_h)
-            radsweep.add_field('NV', noisedBZ_v)
+        self.compute_fields(['NH', 'NV'])
 
     def add_cosmo_data(self, cosmo_data):
         """
@@ -237,48 +266,24 @@ class Radar(object):
     def compute_hydro(self):
         """
         Computes the hydrometeor classification using Nikola Besic' 
-        algorithm, all necessary fields 
+        algorithm for all sweeps, all necessary fields 
         ZH, ZDR, RHOHV, KDP, T (COSMO) must be available
         """
-        
-        for s in self.sweeps:
-            radsweep = self.radsweeps[s]
-            out = hydroclass_semisupervised(radsweep, refl_field = 'ZH',
-                                            zdr_field = 'ZDR',
-                                            rhv_field = 'RHOHV',
-                                            kdp_field = 'KDP',
-                                            temp_ref = 'temperature',
-                                            temp_field = 'T',
-                                            vectorize = True)
-            
-            radsweep.add_field('HYDRO', out['hydro'])
+        self.compute_fields(['HYDRO'])
         
     def correct_attenuation(self):
         """
         Corrects for attenuation using the ZPHI algorithm (Testud et al.)
-        using the COSMO temperature to identify liquid precipitation
+        using the COSMO temperature to identify liquid precipitation, for
+        all sweeps
         """
-        
-        for s in self.sweeps:
-            radsweep = self.radsweeps[s]
-            ah, pia, cor_z, _, pida, cor_zdr = calculate_attenuation_zphi(
-                             radsweep,
-                             refl_field='ZH',
-                             zdr_field = 'ZDR',
-                             phidp_field = 'PHIDP',
-                             temp_field = 'T',
-                             temp_ref = 'temperature',
-                             doc = 15) 
-            radsweep.add_field('AH', ah)
-            radsweep.add_field('ZH_CORR', cor_z)
-            radsweep.add_field('ZDR_CORR', cor_zdr)
-            
-            zv_corr = pia['data'] - pida['data'] + radsweep.get_field(0, 'ZV')
-            radsweep.add_field('ZV_CORR', {'data': zv_corr})
+        self.compute_fields(['AH', 'ZH_CORR', 'ZDR_CORR', 'ZV_CORR'])
             
     def compute_kdp(self, dscfg):
         """
-        Computes KDP using the simple moving least-square algorithm
+        Sets the parameters of the KDP estimation, which uses the simple 
+        moving least-square algorithm, the fields PHIDP and KDP are computed
+        when they are first needed
         
         Parameters
         ----------
@@ -289,45 +294,34 @@ class Radar(object):
             RWIND: 
             ZMIN: 
             ZMAX: 
+            METHOD: (optional) 'pyart' or 'numpy', the least-square fit is
+            done with pyart or with kdp_leastsquare, default is 'pyart'
         """
+        self._kdp_params = dscfg
+    
+    def compute_fields(self, field_names):
+        """
+        Computes a set of derived fields for all sweeps, so that they can be
+        read directly from the pyart instances in radsweeps
         
+        Parameters
+        ----------
+        field_names: list of str
+            name of the fields, e.g. ZH_VISIB, KDP, unknown names are ignored
+        """
+        field_names = [f.upper() for f in field_names]
+        if ('KDP' in field_names and self._kdp_params != None and
+            self._kdp_params.get('METHOD', 'pyart') == 'numpy'):
+            # All sweeps in a single call
+            self._compute_kdp_stack()
         for s in self.sweeps:
-            radsweep = self.radsweeps[s]
-            ind_rmin = np.where(radsweep.range['data'] > dscfg['RMIN'])[0][0]
-            ind_rmax = np.where(radsweep.range['data'] < dscfg['RMAX'])[0][-1]
-            r_res = radsweep.range['data'][1]-radsweep.range['data'][0]
-            min_rcons = int(dscfg['RCELL']/r_res)
-            wind_len = int(dscfg['RWIND']/r_res)
-            min_valid = int(wind_len/2+1)
-
-            psidp_field = 'PSIDP'
-            refl_field = 'ZH'
-            phidp_field = 'PHIDP'
-        
-            phidp = smooth_phidp_single_window(
-                radsweep, ind_rmin=ind_rmin, ind_rmax=ind_rmax, min_rcons=min_rcons,
-                zmin=dscfg['ZMIN'], zmax=dscfg['ZMAX'], wind_len=wind_len,
-                min_valid=min_valid, psidp_field=psidp_field, refl_field=refl_field,
-                phidp_field=phidp_field)
-            
-            radsweep.add_field(phidp_field,phidp)
-            
-            r_res = radsweep.range['data'][1] - radsweep.range['data'][0]
-            wind_len = int(dscfg['RWIND']/r_res)
-            min_valid = int(wind_len/2+1)
-            kdp_field = 'KDP'
-            
-            kdp = kdp_leastsquare_single_window(
-                radsweep, wind_len=wind_len, min_valid=min_valid, 
-                phidp_field=phidp_field, kdp_field=kdp_field, 
-                vectorize = True)
-  
-         
-            radsweep.add_field('KDP', kdp)
-    
+            for f in field_names:
+                self._compute_field(s, f)
+                
     def get_field(self, sweep, field_name):
         """
-        Gets a radar variable at given elevation (sweep)
+        Gets a radar variable at given elevation (sweep), derived fields are
+        computed if needed
         
         Parameters
         ----------
@@ -339,12 +333,348 @@ class Radar(object):
         
         # Check if all uppercase
         field_name_upper = field_name.upper()
+        self._compute_field(sweep, field_name_upper)
         data = self.radsweeps[sweep].get_field(0, field_name_upper)
         # Convention is lowercase is radar variable in linear scale
         if field_name_upper != field_name:
             data = 10 ** (0.1 * data)
         return data
+    
+    def _compute_field(self, sweep, field_name):
+        """
+        Makes a field available for a given sweep, by decoding it or by
+        computing it and its inputs, as given in DERIVED_FIELDS
+        
+        Parameters
+        ----------
+        sweep : int
+            Sweep number from 1 to 20
+        field_name: str
+            name of the field, in uppercase
+        """
+        if field_name in self.radsweeps[sweep].fields:
+            return
+        if field_name in self.lazyfields:
+            self._require(sweep, [field_name])
+        elif field_name in DERIVED_FIELDS.keys():
+            inputs, method = DERIVED_FIELDS[field_name]
+            for f in inputs:
+                self._compute_field(sweep, f)
+            getattr(self, method)(sweep, field_name)
+    
+    def _add_field(self, sweep, field_name, field):
+        """
+        Adds a field to a given sweep, the SNR mask is applied to radar 
+        fields if it was already computed
+        """
+        if field_name in self.radarfields and sweep in self._snr_masks.keys():
+            if field_name == 'ZV' and sweep in self._presnr_masks.keys():
+                self._presnr_masks[sweep][field_name] = np.ma.getmaskarray(
+                    field['data']).copy()
+            field['data'][self._snr_masks[sweep]] = np.ma.masked
+        self.radsweeps[sweep].add_field(field_name, field)
+        
+    def _require(self, sweep, field_names):
+        """
+        Decodes the radar moments of a given sweep that are needed but were
+        not decoded when reading the files
+        
+        Parameters
+        ----------
+        sweep : int
+            Sweep number from 1 to 20
+        field_names: list of str
+            name of the moments, e.g. ZH, ZDR, RHOHV, SW, ...
+        """
+        radsweep = self.radsweeps[sweep]
+        missing = [f for f in field_names if f in self.lazyfields
+                   and f not in radsweep.fields]
+        if not len(missing):
+            return
+        
+        include_fields = [k for k in constants.PYART_NAMES_MAPPING.keys()
+                          if constants.PYART_NAMES_MAPPING[k] in missing]
+        radinstance = read_metranet(self.polfiles[sweep], reader = 'python',
+                                    include_fields = include_fields)
+        rename_fields(radinstance)
+        for f in missing:
+            self._add_field(sweep, f, radinstance.fields[f])
+            
+    def _compute_noise(self, sweep, field_name):
+        """
+        Computes the noise estimates NH and NV of a given sweep from the 
+        status file
+        """
+        if getattr(self, 'status', None) == None:
+            return # no status file
+        
+        i = self.sweeps.index(sweep)
+        radsweep = self.radsweeps[sweep]
+        try:
+            noise_h = float(self.status['status']['sweep'][i]['RADAR']['STAT']
+                        ['CALIB']['noisepower_frontend_h_inuse']['@value'])
+            rconst_h = float(self.status['status']['sweep'][i]['RADAR']['STAT']
+                                        ['CALIB']['rconst_h']['@value'])
+            noisedBADU_h = 10.*np.log10(noise_h) + rconst_h
+            
+            noise_v = float(self.status['status']['sweep'][i]['RADAR']['STAT']
+                            ['CALIB']['noisepower_frontend_v_inuse']['@value'])
+            rconst_v = float(self.status['status']['sweep'][i]['RADAR']['STAT']
+                                    ['CALIB']['rconst_v']['@value'])
+            noisedBADU_v = 10.*np.log10(noise_v) + rconst_v
             
+        except:
+            # default noise
+            noisedBADU_h = constants.NOISE_100
+            noisedBADU_v = constants.NOISE_100
+            pass
+        
+        noisedBZ_h = compute_noisedBZ(radsweep.nrays, noisedBADU_h,
+                radsweep.range['data'], 100.,
+                noise_field='noisedBZ_hh')
+            
+        noisedBZ_v = compute_noisedBZ(radsweep.nrays, noisedBADU_v,
+                radsweep.range['data'], 100.,
+                noise_field='noisedBZ_vv')
+        
+        # Convert to masked array for consistency
+        noisedBZ_h['data'] = np.ma.array(noisedBZ_h['data'], 
+                                    mask = np.isnan(noisedBZ_h['data'])) 
+        noisedBZ_v['data'] = np.ma.array(noisedBZ_v['data'], 
+                                    mask = np.isnan(noisedBZ_v['data']))    
+        
+        self._add_field(sweep, 'NH', noisedBZ_h)
+        self._add_field(sweep, 'NV', noisedBZ_v)
+        
+    def _compute_visib(self, sweep, field_name):
+        """
+        Computes the visibility corrected reflectivity ZH_VISIB or ZV_VISIB
+        of a given sweep
+        """
+        if self._visib_params == None:
+            raise ValueError('Please run first visib_mask()')
+        min_visib, max_visib_corr = self._visib_params
+        
+        radsweep = self.radsweeps[sweep]
+        moment = field_name.replace('_VISIB', '')
+        visib = radsweep.fields['VISIB']['data']
+        z = radsweep.fields[moment]['data']
+        
+        # Use the data as it was before the SNR masking
+        presnr = self._presnr_masks.get(sweep, {})
+        if 'VISIB' in presnr.keys():
+            visib = np.ma.array(np.ma.getdata(visib), mask = presnr['VISIB'])
+        if moment in presnr.keys():
+            z = np.ma.array(np.ma.getdata(z), mask = presnr[moment])
+                
+        zlin = 10 ** (0.1 * z)
+        corr = 1./(visib/100.)
+        corr[corr >= max_visib_corr] = max_visib_corr
+       
+        zlin_corr = zlin * corr
+        # mask
+        zlin_corr.mask[visib < min_visib ] = True
+        radsweep.add_field(field_name, {'data': 10 * np.log10(zlin_corr)})
+        
+    def _compute_phidp(self, sweep, field_name):
+        """
+        Computes the smoothed differential phase PHIDP of a given sweep
+        """
+        if self._kdp_params == None:
+            raise ValueError('Please run first compute_kdp()')
+        dscfg = self._kdp_params
+        
+        radsweep = self.radsweeps[sweep]
+        ind_rmin = np.where(radsweep.range['data'] > dscfg['RMIN'])[0][0]
+        ind_rmax = np.where(radsweep.range['data'] < dscfg['RMAX'])[0][-1]
+        r_res = radsweep.range['data'][1]-radsweep.range['data'][0]
+        min_rcons = int(dscfg['RCELL']/r_res)
+        wind_len = int(dscfg['RWIND']/r_res)
+        min_valid = int(wind_len/2+1)
+
+        psidp_field = 'PSIDP'
+        refl_field = 'ZH'
+        phidp_field = 'PHIDP'
+    
+        phidp = smooth_phidp_single_window(
+            radsweep, ind_rmin=ind_rmin, ind_rmax=ind_rmax, min_rcons=min_rcons,
+            zmin=dscfg['ZMIN'], zmax=dscfg['ZMAX'], wind_len=wind_len,
+            min_valid=min_valid, psidp_field=psidp_field, refl_field=refl_field,
+            phidp_field=phidp_field)
+        
+        radsweep.add_field(phidp_field,phidp)
+        
+    def _kdp_window(self, sweep):
+        """
+        Gives the length of the KDP window (in gates) and the minimum number
+        of valid gates within the window for a given sweep
+        """
+        radsweep = self.radsweeps[sweep]
+        r_res = radsweep.range['data'][1] - radsweep.range['data'][0]
+        wind_len = int(self._kdp_params['RWIND']/r_res)
+        min_valid = int(wind_len/2+1)
+        return wind_len, min_valid
+    
+    def _compute_kdp(self, sweep, field_name):
+        """
+        Computes KDP of a given sweep from the smoothed differential phase
+        """
+        radsweep = self.radsweeps[sweep]
+        wind_len, min_valid = self._kdp_window(sweep)
+        
+        if self._kdp_params.get('METHOD', 'pyart') == 'numpy':
+            kdp = {'data': kdp_leastsquare(radsweep.fields['PHIDP']['data'],
+                                           radsweep.range['data'] / 1000.,
+                                           wind_len, min_valid)}
+        else:
+            kdp = kdp_leastsquare_single_window(
+                radsweep, wind_len=wind_len, min_valid=min_valid, 
+                phidp_field='PHIDP', kdp_field='KDP', 
+                vectorize = True)
+  
+        radsweep.add_field('KDP', kdp)
+        
+    def _compute_kdp_stack(self):
+        """
+        Computes KDP of all sweeps at once with kdp_leastsquare, the sweeps
+        are stacked and padded to the largest number of rays and gates, and
+        the sweeps that have the same window parameters are processed 
+        together
+        """
+        sweeps = [s for s in self.sweeps 
+                  if 'KDP' not in self.radsweeps[s].fields]
+        groups = {}
+        for s in sweeps:
+            self._compute_field(s, 'PHIDP')
+            r_res = np.diff(self.radsweeps[s].range['data'][0:2])[0]
+            groups.setdefault(self._kdp_window(s) + (r_res,), []).append(s)
+            
+        for key in groups.keys():
+            wind_len, min_valid, r_res = key
+            group = groups[key]
+            nrays = max([self.radsweeps[s].nrays for s in group])
+            ngates = max([self.radsweeps[s].ngates for s in group])
+            
+            phidp = np.full((len(group), nrays, ngates), np.nan)
+            rng = np.full(ngates, np.nan)
+            for i, s in enumerate(group):
+                radsweep = self.radsweeps[s]
+                phidp[i, :radsweep.nrays, :radsweep.ngates] = np.ma.filled(
+                    radsweep.fields['PHIDP']['data'], np.nan)
+                if radsweep.ngates == ngates:
+                    rng = radsweep.range['data'] / 1000.
+                    
+            kdp = kdp_leastsquare(phidp, rng, wind_len, min_valid)
+            for i, s in enumerate(group):
+                radsweep = self.radsweeps[s]
+                kdp_sweep = kdp[i, :radsweep.nrays, :radsweep.ngates].copy()
+                # The windows at the end of the range must not overlap the
+                # padding
+                kdp_sweep[:, max(0, radsweep.ngates - wind_len // 2):] = \
+                    np.ma.masked
+                radsweep.add_field('KDP', {'data': kdp_sweep})
+        
+    def _compute_attenuation(self, sweep, field_name):
+        """
+        Computes the attenuation AH and the corrected reflectivities ZH_CORR,
+        ZDR_CORR and ZV_CORR (if ZV is available) of a given sweep
+        """
+        radsweep = self.radsweeps[sweep]
+        ah, pia, cor_z, _, pida, cor_zdr = calculate_attenuation_zphi(
+                         radsweep,
+                         refl_field='ZH',
+                         zdr_field = 'ZDR',
+                         phidp_field = 'PHIDP',
+                         temp_field = 'T',
+                         temp_ref = 'temperature',
+                         doc = 15) 
+        radsweep.add_field('AH', ah)
+        radsweep.add_field('ZH_CORR', cor_z)
+        radsweep.add_field('ZDR_CORR', cor_zdr)
+        
+        if 'ZV' in radsweep.fields:
+            zv_corr = pia['data'] - pida['data'] + radsweep.get_field(0, 'ZV')
+            radsweep.add_field('ZV_CORR', {'data': zv_corr})
+            
+    def _compute_hydro(self, sweep, field_name):
+        """
+        Computes the hydrometeor classification of a given sweep
+        """
+        radsweep = self.radsweeps[sweep]
+        out = hydroclass_semisupervised(radsweep, refl_field = 'ZH',
+                                        zdr_field = 'ZDR',
+                                        rhv_field = 'RHOHV',
+                                        kdp_field = 'KDP',
+                                        temp_ref = 'temperature',
+                                        temp_field = 'T',
+                                        vectorize = True)
+        
+        radsweep.add_field('HYDRO', out['hydro'])
+            
+
+def kdp_leastsquare(phidp, rng, wind_len, min_valid):
+    """
+    Computes KDP as half the slope of a least-square linear fit of PHIDP
+    over a moving window along the range, this gives the same result as the
+    pyart function kdp_leastsquare_single_window, but the sums over the 
+    windows are obtained from cumulative sums, so the cost does not depend
+    on the window size, and any number of sweeps can be processed at once
+    
+    Parameters
+    ----------
+    phidp : ndarray
+        array of smoothed differential phase in degrees, with the range in 
+        the last dimension, e.g. (nrays x ngates) or (nsweeps x nrays x
+        ngates), masked or nan values are ignored
+    rng : ndarray
+        1D array with the range of all gates in km
+    wind_len : int
+        length of the moving window in number of gates, an even length is
+        increased by one
+    min_valid : int
+        minimum number of valid gates within the window to compute KDP
+        
+    Returns
+    -------
+    A masked array of KDP in deg/km, with the same shape as phidp, where 
+    KDP could not be computed (invalid center gate or not enough valid 
+    gates in the window) it is masked
+    """
+    # we want an odd window
+    if wind_len % 2 == 0:
+        wind_len += 1
+    half_wind = int((wind_len - 1) / 2)
+    
+    phidp = np.ma.filled(phidp.astype(np.float64), np.nan)
+    rng = np.broadcast_to(np.asarray(rng, dtype = np.float64), phidp.shape)
+    valid = np.logical_and(np.isfinite(phidp), np.isfinite(rng))
+    
+    phidp = np.where(valid, phidp, 0)
+    rng = np.where(valid, rng, 0)
+    
+    def window_sum(x):
+        # sum over all windows that fit completely within the range
+        csum = np.zeros(x.shape[:-1] + (x.shape[-1] + 1,))
+        np.cumsum(x, axis = -1, out = csum[..., 1:])
+        return csum[..., wind_len:] - csum[..., :-wind_len]
+    
+    nvalid = window_sum(valid.astype(np.float64))
+    rng_sum = window_sum(rng)
+    rng_sum2 = window_sum(rng ** 2)
+    phidp_sum = window_sum(phidp)
+    rphidp_sum = window_sum(rng * phidp)
+    
+    center = slice(half_wind, phidp.shape[-1] - half_wind)
+    ok = np.logical_and(nvalid >= min_valid, valid[..., center])
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        slope = ((rphidp_sum - rng_sum * phidp_sum / nvalid) / 
+                 (rng_sum2 - rng_sum * rng_sum / nvalid))
+    ok = np.logical_and(ok, np.isfinite(slope))
+    
+    kdp = np.full(phidp.shape, np.nan)
+    kdp[..., center] = np.where(ok, 0.5 * slope, np.nan)
+    return np.ma.masked_invalid(kdp)
 
 def hydroClass_single(radars, zh, zdr, kdp, rhohv, temp, 
                       weights = np.array([1., 1., 1., 0.75, 0.5])):
@@ -13,6 +13,7 @@ December 2019
 import numpy as np
 import os
 import zipfile
+import shutil
 import datetime
 import glob
 import subprocess
@@ -20,10 +21,15 @@ import netCDF4
 import logging
 import fnmatch
 import re
+import threading
+import hashlib
+import fcntl
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 
 from . import constants 
-from .lookup import get_lookup
+from .lookup import get_flat_cosmo_lookup
 from .utils import round_to_hour
 from . import io_data as io # avoid circular
 
@@ -78,29 +84,114 @@ def get_COSMO_T(time, sweeps = None, radar = None):
     file_COSMO = constants.FILES_COSMO1_T[idx_closest]
     dt = (time - constants.TIMES_COSMO1_T[idx_closest]).total_seconds()
 
-    file_COSMO = netCDF4.Dataset(file_COSMO)
-    idx_time = np.argmin(np.abs(dt - file_COSMO.variables['time'][:]))    
-    T = file_COSMO.variables['T'][idx_time,:,:,:]
+    T, shape = _cosmo_T_slice(file_COSMO, dt)
 
     T_at_radar = {}
     for r in radar:
-        lut_rad = get_lookup('cosmo1T_to_rad', r)
-        T_at_radar[r] = {'T':{}}
-        for s in sweeps:
-  
-            # Finally get temperature at radar
-            m1 = lut_rad[s]['idx0']
-            m2 = lut_rad[s]['idx1']
-            m3 = lut_rad[s]['idx2']
-            mask = lut_rad[s]['mask']
-            # Finally get variables at radar
-            T_at_radar[r]['T'][s] = np.ma.array(T[m1, m2, m3], mask = mask)
-    file_COSMO.close()        
+        # Finally get temperature at radar
+        lut_rad = _cosmo_flat_lookup('cosmo1T_to_rad', r, shape)
+        T_at_radar[r] = {'T': _cosmo_at_radar(T, lut_rad, sweeps)}
     
     return T_at_radar
 
+# Open COSMO files with their times, decoded temperature fields and indexes
+# of the radar gates in the COSMO grid, see get_COSMO_T
+_COSMO_FILES = OrderedDict()
+_COSMO_SLICES = OrderedDict()
+_COSMO_GATHER = {}
+_COSMO_LOCK = threading.Lock()
+# Maximal number of COSMO files to keep open and of temperature fields to 
+# keep in memory
+COSMO_FILE_CACHE = 2
+COSMO_SLICE_CACHE = 4
+
+def _cosmo_T_slice(file_COSMO, dt):
+    """ Returns the COSMO temperature field of a file that is closest to a
+    given time, the files are kept open and the fields are kept in memory
+    for the COSMO_FILE_CACHE and COSMO_SLICE_CACHE last used ones
+    
+    Parameters
+    ----------
+    file_COSMO : str
+        full path of the COSMO netCDF file
+    dt : float
+        time in seconds from the start of the file
+        
+    Returns
+    -------
+    The temperature field as a flattened float32 masked array and its shape
+    """
+    with _COSMO_LOCK:
+        if file_COSMO in _COSMO_FILES.keys():
+            _COSMO_FILES.move_to_end(file_COSMO)
+        else:
+            ncfile = netCDF4.Dataset(file_COSMO)
+            _COSMO_FILES[file_COSMO] = (ncfile, ncfile.variables['time'][:])
+            if len(_COSMO_FILES) > COSMO_FILE_CACHE:
+                _, (oldfile, _) = _COSMO_FILES.popitem(last = False)
+                oldfile.close()
+        ncfile, times = _COSMO_FILES[file_COSMO]
+        
+        idx_time = np.argmin(np.abs(dt - times))
+        key = (file_COSMO, idx_time)
+        if key in _COSMO_SLICES.keys():
+            _COSMO_SLICES.move_to_end(key)
+        else:
+            T = np.ma.asarray(ncfile.variables['T'][idx_time,:,:,:])
+            _COSMO_SLICES[key] = (T.astype(np.float32).ravel(), T.shape)
+            if len(_COSMO_SLICES) > COSMO_SLICE_CACHE:
+                _COSMO_SLICES.popitem(last = False)
+        return _COSMO_SLICES[key]
+    
+def _cosmo_flat_lookup(lookup_type, radar, shape):
+    """ Returns the flat lookup table of a given radar, see 
+    get_flat_cosmo_lookup, the tables are read only once
+    """
+    key = (lookup_type, radar, tuple(shape))
+    with _COSMO_LOCK:
+        if key not in _COSMO_GATHER.keys():
+            _COSMO_GATHER[key] = get_flat_cosmo_lookup(lookup_type, radar, 
+                                                       shape)
+        return _COSMO_GATHER[key]
+    
+def _cosmo_at_radar(data, lut, sweeps):
+    """ Gets a COSMO variable at the radar gates of all sweeps at once, 
+    with the flat lookup table of the radar
+    
+    Parameters
+    ----------
+    data : ndarray or MaskedArray
+        the COSMO variable, flattened
+    lut : dict
+        the flat lookup table, as given by get_flat_cosmo_lookup
+    sweeps : list of int
+        the sweeps for which to return the data
+        
+    Returns
+    -------
+    A dict of float32 masked arrays in the form dict[sweep], where gates
+    outside of the COSMO domain are masked
+    """
+    offsets = lut['offsets']
+    values = np.empty(len(offsets), dtype = np.float32)
+    np.take(np.ma.getdata(data), offsets, out = values)
+    mask = ~lut['valid']
+    if np.ma.getmask(data) is not np.ma.nomask:
+        mask = np.logical_or(mask, np.take(np.ma.getmaskarray(data), offsets))
+        
+    out = {}
+    for i, sweep in enumerate(lut['sweeps']):
+        if sweep not in sweeps:
+            continue
+        i0, i1 = lut['bounds'][i]
+        shape = tuple(lut['shapes'][i])
+        out[int(sweep)] = np.ma.array(values[i0:i1].reshape(shape),
+                                 mask = mask[i0:i1].reshape(shape))
+    return out
+
 def get_COSMO_variables(time, variables, sweeps = None, radar = None,
-                        tmp_folder = '/tmp/', cleanup = True):
+                        tmp_folder = '/tmp/', cleanup = True, 
+                        cache_folder = None, cache_size = 20E9):
     
     """Retrieves COSMO data from the CSCS repository, and 
     interpolates them to the radar gates, using precomputed lookup tables
@@ -124,6 +215,14 @@ def get_COSMO_variables(time, variables, sweeps = None, radar = None,
     cleanup = boolean (optional)
         If true all extracted files will be deleted before returning the output
         (recommended)
+    cache_folder = str (optional)
+        Directory where to keep the extracted files, so that they can be 
+        reused by later calls and by other processes, if specified tmp_folder
+        and cleanup are not used. By default the files are extracted again
+        at every call
+    cache_size = float (optional)
+        Maximal size in bytes of the files in cache_folder, when it is 
+        exceeded the files that were used least recently are removed
         
     Returns
     -------
@@ -152,9 +251,42 @@ def get_COSMO_variables(time, variables, sweeps = None, radar = None,
     grb = constants.FOLDER_COSMO1 + 'ANA{:s}/laf{:s}'.format(str(t_near.year)[2:],
                                 datetime.datetime.strftime(t_near,'%Y%m%d%H')) 
     
-    # Extract fields and convert to netCDF
+    if cache_folder != None:
+        data = _read_COSMO_cached(grb, variables, cache_folder, cache_size)
+    else:
+        # Extract fields and convert to netCDF
+        tmp_name = tmp_folder + os.path.basename(grb) + '_filtered'
+        _extract_COSMO(grb, variables, tmp_name)
+        
+        file_COSMO = netCDF4.Dataset(tmp_name + '.nc')
+        data = {}
+        for v in variables:
+            data[v] = np.squeeze(file_COSMO.variables[v][:])
+        file_COSMO.close() 
+        if cleanup:
+            os.remove(tmp_name)
+            os.remove(tmp_name + '.nc')
+            
+    # Finally interpolate to radar grid
+    
+    # Interpolate for all radars and sweeps
+    var_at_radar = {}
+    for r in radar:
+        var_at_radar[r] = {}
+        for v in variables:
+            lut_rad = _cosmo_flat_lookup('cosmo1T_to_rad', r, data[v].shape)
+            # Finally get variables at radar
+            var_at_radar[r][v] = _cosmo_at_radar(data[v].ravel(), lut_rad,
+                                                 sweeps)
+        
+    return var_at_radar
+
+def _extract_COSMO(grb, variables, tmp_name):
+    """ Extracts a set of variables from a COSMO GRIB file with fieldextra,
+    the filtered GRIB file is written to tmp_name and its conversion to 
+    netCDF to tmp_name + '.nc'
+    """
     list_variables = ','.join(variables)
-    tmp_name = tmp_folder + os.path.basename(grb) + '_filtered'
     
     cmd_filter = {'{:s} {:s} --force -s {:s} -o {:s}'.format(
                 constants.FILTER_COMMAND, grb, list_variables, tmp_name)}
@@ -166,35 +298,115 @@ def get_COSMO_variables(time, variables, sweeps = None, radar = None,
 
     subprocess.call(cmd_convert, shell = True)
     
-    # Finally interpolate to radar grid
-    file_COSMO = netCDF4.Dataset(tmp_name + '.nc')
+def _lock_COSMO_cache(nc_name, operation):
+    """ Opens and locks with flock the lock file of a file of the COSMO
+    cache, the lock files are removed on eviction, so the lock is taken 
+    again if the lock file was removed or replaced while waiting for it
     
-    # Interpolate for all radars and sweeps
-    var_at_radar = {}
-    for r in radar:
-        lut_rad = get_lookup('cosmo1T_to_rad', r)
-        var_at_radar[r] = {}
-        for v in variables:
-            data = np.squeeze(file_COSMO.variables[v][:])
-            var_at_radar[r][v] = {}
-            for s in sweeps:
-                m1 = lut_rad[s]['idx0']
-                m2 = lut_rad[s]['idx1']
-                m3 = lut_rad[s]['idx2']
-                mask = lut_rad[s]['mask']
-                # Finally get variables at radar
-                d = np.ma.array(data[m1, m2, m3], mask = mask)
-                var_at_radar[r][v][s] = d
-    file_COSMO.close() 
-    if cleanup:
-        os.remove(tmp_name)
-        os.remove(tmp_name + '.nc')
+    Returns
+    -------
+    The open lock file, or None if the lock is non-blocking 
+    (fcntl.LOCK_NB) and could not be taken
+    """
+    while True:
+        lock = open(nc_name + '.lock', 'a')
+        try:
+            fcntl.flock(lock, operation)
+        except OSError:
+            lock.close()
+            return None
+        if _is_current_lock(lock, nc_name):
+            return lock
+        lock.close()
         
-    return var_at_radar
+def _is_current_lock(lock, nc_name):
+    """ Checks that an open lock file is still the one of the cache file
+    """
+    try:
+        return os.path.samestat(os.fstat(lock.fileno()), 
+                                os.stat(nc_name + '.lock'))
+    except FileNotFoundError:
+        return False
+    
+def _read_COSMO_cached(grb, variables, cache_folder, cache_size):
+    """ Reads a set of variables from a COSMO GRIB file, the extracted 
+    netCDF file is kept in a cache folder that can be shared by several
+    processes, a file lock ensures that a given file is extracted only once
+    while the other processes wait for it
+    
+    Returns
+    -------
+    A dict of the form dict[variable] with the COSMO data
+    """
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok = True)
+    nc_name = os.path.join(cache_folder, os.path.basename(grb) + '_' + 
+                           '_'.join(sorted(variables)) + '.nc')
+    
+    while True:
+        lock = _lock_COSMO_cache(nc_name, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(nc_name):
+                os.utime(nc_name) # mark as recently used
+            else:
+                # hidden, so that it is not seen by _evict_COSMO_cache
+                tmp_name = os.path.join(cache_folder, 
+                                        '.{:s}.{:d}.tmp'.format(
+                                        os.path.basename(nc_name), 
+                                        os.getpid()))
+                _extract_COSMO(grb, variables, tmp_name)
+                os.remove(tmp_name)
+                os.replace(tmp_name + '.nc', nc_name)
+                _evict_COSMO_cache(cache_folder, cache_size)
+            # Other processes can read the file but not remove it
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            # The conversion of the lock is not atomic, the file may have
+            # been evicted in between, in which case it is extracted again
+            if not (_is_current_lock(lock, nc_name) and 
+                    os.path.exists(nc_name)):
+                continue
+            
+            file_COSMO = netCDF4.Dataset(nc_name)
+            data = {}
+            for v in variables:
+                data[v] = np.squeeze(file_COSMO.variables[v][:])
+            file_COSMO.close()
+            return data
+        finally:
+            lock.close()
+
+def _evict_COSMO_cache(cache_folder, cache_size):
+    """ Removes the least recently used files of the COSMO cache folder
+    and their lock files until its size is below cache_size, files that 
+    are in use are kept
+    """
+    entries = []
+    for f in glob.glob(os.path.join(cache_folder, '*.nc')):
+        try:
+            stat = os.stat(f)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, f))
+    entries.sort()
+    
+    total_size = sum([e[1] for e in entries])
+    for mtime, size, f in entries:
+        if total_size <= cache_size:
+            break
+        # fails if in use, or if this is the file being extracted
+        lock = _lock_COSMO_cache(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lock == None:
+            continue
+        with lock:
+            if os.path.exists(f):
+                os.remove(f)
+                total_size -= size
+            os.remove(f + '.lock')
 
 
 def retrieve_prod(folder_out, start_time, end_time, product_name,
-                  pattern = None, pattern_type = 'shell', sweeps = None):
+                  pattern = None, pattern_type = 'shell', sweeps = None,
+                  cache = None, index_folder = None):
     
     """ Retrieves radar data from the CSCS repository for a specified
     time range, unzips them and places them in a specified folder
@@ -220,6 +432,14 @@ def retrieve_prod(folder_out, start_time, end_time, product_name,
     sweeps: list of int (optional)
         For polar products, specifies which sweeps (elevations) must be
         retrieved, if not specified all available sweeps will be retrieved
+    cache: ExtractionCache (optional)
+        cache of extracted files, if specified the files are taken from the
+        cache when available instead of being extracted again
+    index_folder: str (optional)
+        folder where the indexes of the zip archives are stored, so they 
+        can be reused by other processes, one small file is written for 
+        every archive that is read. If not specified, the indexes are only
+        kept in memory
                 
     Returns
     -------
@@ -227,8 +447,140 @@ def retrieve_prod(folder_out, start_time, end_time, product_name,
    
     """
     
-    if product_name == 'ZZW' or product_name == 'ZZP': # no vpr for PPM and WEI
-        product_name = 'ZZA'
+    all_files = []
+    for t0, t1 in _daily_ranges(start_time, end_time):
+        files = _retrieve_prod_daily(folder_out, t0, t1, product_name, 
+                                     pattern, pattern_type, sweeps, cache,
+                                     index_folder)
+
+        all_files.extend(files)
+            
+    return all_files
+
+def retrieve_prod_memory(start_time, end_time, product_name, pattern = None,
+                         pattern_type = 'shell', sweeps = None, 
+                         index_folder = None):
+    
+    """ Reads radar data from the CSCS repository for a specified
+    time range directly from the zip archives, without extracting them
+    
+    Parameters
+    ----------
+    
+    start_time : datetime.datetime instance
+        starting time of the time range
+    end_time : datetime.datetime instance
+        end time of the time range
+    product_name: str
+        name of the product, as stored on CSCS, e.g. RZC, CPCH, MZC, BZC...
+    pattern: str
+        pattern constraint on file names, see retrieve_prod
+    pattern_type: either 'shell' or 'regex' (optional)
+        type of the pattern, see retrieve_prod
+    sweeps: list of int (optional)
+        For polar products, specifies which sweeps (elevations) must be
+        retrieved, if not specified all available sweeps will be retrieved
+    index_folder: str (optional)
+        folder where the indexes of the zip archives are stored, see 
+        retrieve_prod
+                
+    Returns
+    -------
+    A dict where the keys are the filenames and the values their content
+    as bytes, in chronological order
+   
+    """
+    
+    all_files = {}
+    for t0, t1 in _daily_ranges(start_time, end_time):
+        files = _retrieve_prod_memory_daily(t0, t1, product_name, pattern,
+                                            pattern_type, sweeps, 
+                                            index_folder)
+        all_files.update(files)
+            
+    return all_files
+
+def retrieve_many(folder_out, requests, max_workers = 4, cache = None,
+                  index_folder = None):
+    
+    """ Retrieves several products and/or time ranges from the CSCS 
+    repository at once, the retrievals of all products and days are run
+    concurrently in a pool of threads
+    
+    Parameters
+    ----------
+    
+    folder_out: str
+        directory where to store the unzipped files
+    requests : dict
+        dict of retrievals to perform, the values are dicts with the keyword
+        arguments of retrieve_prod (start_time, end_time, product_name and 
+        optionally pattern, pattern_type and sweeps) and optionally 
+        in_memory, if True the files are read in memory as with 
+        retrieve_prod_memory
+    max_workers : int (optional)
+        maximum number of retrievals that run at the same time
+    cache: ExtractionCache (optional)
+        cache of extracted files, see retrieve_prod, it is not used for the
+        retrievals done in memory
+    index_folder: str (optional)
+        folder where the indexes of the zip archives are stored, see 
+        retrieve_prod
+        
+    Returns
+    -------
+    A dict with the same keys as requests, where the values are the list
+    of retrieved files (or a dict of file contents if in_memory is True), 
+    failed retrievals are logged and are not in the dict
+   
+    """
+    tasks = []
+    for key in requests.keys():
+        kwargs = dict(requests[key])
+        in_memory = kwargs.pop('in_memory', False)
+        start_time = kwargs.pop('start_time')
+        end_time = kwargs.pop('end_time')
+        for t0, t1 in _daily_ranges(start_time, end_time):
+            if in_memory:
+                tasks.append((key, _retrieve_prod_memory_daily, 
+                              (t0, t1), 
+                              dict(kwargs, index_folder = index_folder)))
+            else:
+                tasks.append((key, _retrieve_prod_daily, 
+                              (folder_out, t0, t1), 
+                              dict(kwargs, cache = cache, 
+                                   index_folder = index_folder)))
+            
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(func, *args, **kwargs) 
+                   for _, func, args, kwargs in tasks]
+        
+        results = {}
+        failed = []
+        for task, future in zip(tasks, futures): # in chronological order
+            key = task[0]
+            try:
+                files = future.result()
+            except Exception as e:
+                logging.error('Retrieval of {:s} failed: {:s}'.format(str(key),
+                                                                      str(e)))
+                failed.append(key)
+                continue
+            if key not in results.keys():
+                results[key] = files
+            elif type(files) == dict:
+                results[key].update(files)
+            else:
+                results[key].extend(files)
+                
+    for key in failed:
+        results.pop(key, None)
+    return results
+
+def _daily_ranges(start_time, end_time):
+    """ Splits a time range into a list of (start, end) time ranges that are
+    each on a single day, as the archives are stored daily
+    """
     
     dt = datetime.timedelta(minutes = 5)
     delta = end_time - start_time
@@ -242,90 +594,334 @@ def retrieve_prod(folder_out, start_time, end_time, product_name,
                                        day = t.day))
     dates = np.unique(dates)
     
-    t0 = start_time
-    t1 = end_time
-    
-    all_files = []
+    ranges = []
     for i, d in enumerate(dates):
         if i == 0:
-            start_time = t0
+            t0 = start_time
         else:
-            start_time = datetime.datetime(year = d.year, month = d.month,
-                                           day = d.day)
+            t0 = datetime.datetime(year = d.year, month = d.month,
+                                   day = d.day)
         if i == len(dates) - 1:
-            end_time = t1
+            t1 = end_time
         else:
-            end_time = datetime.datetime(year = d.year, month = d.month,
-                                           day = d.day, hour = 23, minute = 59)
-        files = _retrieve_prod_daily(folder_out, start_time, end_time,
-                                     product_name, pattern, pattern_type,
-                                     sweeps)
+            t1 = datetime.datetime(year = d.year, month = d.month,
+                                   day = d.day, hour = 23, minute = 59)
+        ranges.append((t0, t1))
+    return ranges
 
-        all_files.extend(files)
-            
-    return all_files
+# Indexes of the archives that were read, see _archive_index
+_ARCHIVE_INDEXES = OrderedDict()
+_ARCHIVE_INDEXES_LOCK = threading.Lock()
+# Maximal number of archive indexes to keep in memory
+ARCHIVE_INDEX_CACHE = 128
 
+def _archive_index(zip_path, index_folder = None):
+    """ Returns the index of a daily zip archive, i.e. the names of all 
+    members with their time and sweep number, sorted by time. The indexes 
+    are kept in memory for the ARCHIVE_INDEX_CACHE archives that were used
+    last and are also stored in index_folder if specified.
+    
+    Parameters
+    ----------
+    zip_path : str
+        full path of the zip archive
+    index_folder : str (optional)
+        folder where to store the indexes as .npz files so they can be
+        reused by other processes
+        
+    Returns
+    -------
+    A dict with keys 'names' (member names), 'times' (datetime64) and 'sweeps'
+    (sweep number, -1 for non-polar files)
+    """
+    stat = os.stat(zip_path)
+    key = (zip_path, stat.st_mtime, stat.st_size)
+    with _ARCHIVE_INDEXES_LOCK:
+        if key in _ARCHIVE_INDEXES.keys():
+            _ARCHIVE_INDEXES.move_to_end(key)
+            return _ARCHIVE_INDEXES[key]
+    
+    index = None
+    if index_folder != None:
+        index_file = os.path.join(index_folder, 
+                                  os.path.basename(zip_path) + '.npz')
+        if os.path.exists(index_file):
+            with np.load(index_file) as data:
+                if (data['mtime'] == stat.st_mtime and 
+                    data['size'] == stat.st_size):
+                    index = {k: data[k] for k in ['names', 'times', 'sweeps']}
+                    
+    if index == None:
+        with zipfile.ZipFile(zip_path) as zipp:
+            names = zipp.namelist()
+        times = []
+        valid = []
+        for c in names:
+            try:
+                times.append(datetime.datetime.strptime(c[3:12], '%y%j%H%M'))
+                valid.append(c)
+            except ValueError:
+                pass # not a data file
+        names = np.array(valid)
+        sweeps = np.array([int(c[-3:]) if c[-3:].isdigit() else -1 
+                           for c in names], dtype = int)
+        times = np.array(times, dtype = 'datetime64[m]')
+        order = np.argsort(times, kind = 'stable')
+        index = {'names': names[order], 'times': times[order],
+                 'sweeps': sweeps[order]}
+        
+        if index_folder != None:
+            try:
+                if not os.path.exists(index_folder):
+                    os.makedirs(index_folder)
+                tmp_file = index_file + '.{:d}.{:d}.tmp'.format(os.getpid(),
+                                                    threading.get_ident())
+                with open(tmp_file, 'wb') as f:
+                    np.savez(f, mtime = stat.st_mtime, size = stat.st_size,
+                             **index)
+                os.replace(tmp_file, index_file)
+            except OSError:
+                logging.warning('Could not store index of {:s}'.format(zip_path))
+        
+    with _ARCHIVE_INDEXES_LOCK:
+        _ARCHIVE_INDEXES[key] = index
+        if len(_ARCHIVE_INDEXES) > ARCHIVE_INDEX_CACHE:
+            _ARCHIVE_INDEXES.popitem(last = False)
+    return index
 
-def _retrieve_prod_daily(folder_out, start_time, end_time, product_name,
-                  pattern = None, pattern_type = 'shell', sweeps = None):
+def _retrieve_prod_memory_daily(start_time, end_time, product_name, 
+                                pattern = None, pattern_type = 'shell', 
+                                sweeps = None, index_folder = None):
     
-    """ This is a version that works only for a given day (i.e. start and end
-    time on the same day)
+    """ This is a version of retrieve_prod_memory that works only for a given
+    day (i.e. start and end time on the same day)
     """
     
-    folder_out += '/'
+    zip_path, members = _zip_members(start_time, end_time, product_name,
+                                     pattern, pattern_type, sweeps,
+                                     index_folder)
+    files = {}
+    with zipfile.ZipFile(zip_path) as zipp:
+        for m in members:
+            files[os.path.basename(m)] = zipp.read(m)
+    return files
+
+def _zip_members(start_time, end_time, product_name, pattern = None, 
+                 pattern_type = 'shell', sweeps = None, index_folder = None):
+    
+    """ Finds the daily zip archive of a product and the members that 
+    correspond to a time range on that day
+    
+    Returns
+    -------
+    The full path of the zip archive and the list of members to retrieve
+    """
     
+    if product_name == 'ZZW' or product_name == 'ZZP': # no vpr for PPM and WEI
+        product_name = 'ZZA'
+        
     suffix =  str(start_time.year)[-2:] + str(start_time.timetuple().tm_yday).zfill(3)
     folder_in = constants.FOLDER_RADAR + str(start_time.year) + '/' +  suffix + '/'
     name_zipfile = product_name + suffix+'.zip'
     
-    # Get list of files in zipfile
-    zipp = zipfile.ZipFile(folder_in + name_zipfile)
-    content_zip = np.array(zipp.namelist())
+    index = _archive_index(folder_in + name_zipfile, index_folder)
+    
+    # Get all files in time range
+    i0 = np.searchsorted(index['times'], np.datetime64(start_time, 's'),
+                         side = 'left')
+    i1 = np.searchsorted(index['times'], np.datetime64(end_time, 's'),
+                         side = 'right')
+    content_zip = index['names'][i0:i1]
     
+    # Filter on sweeps:
+    if sweeps != None:
+        content_zip = content_zip[np.isin(index['sweeps'][i0:i1], sweeps)]
+        
     if pattern != None:
         if pattern_type == 'shell':
             content_zip = [c for c in content_zip 
                            if fnmatch.fnmatch(os.path.basename(c), pattern)]
         elif pattern_type == 'regex':
             content_zip = [c for c in content_zip 
-                           if re.match(os.path.basename(c), pattern) != None]
+                           if re.match(pattern, os.path.basename(c)) != None]
         else:
             raise ValueError('Unknown pattern_type, must be either "shell" or "regex".')
             
-    content_zip = np.array(content_zip)
-        
-    times_zip = np.array([datetime.datetime.strptime(c[3:12],
-                          '%y%j%H%M') for c in content_zip])
-  
-    # Get a list of all files to retrieve
-    conditions = np.array([np.logical_and(t >= start_time, t <= end_time)
-        for t in times_zip])
-    
-    # Filter on sweeps:
-    if sweeps != None:
-        sweeps_zip = np.array([int(c[-3:]) for c in content_zip])
-            # Get a list of all files to retrieve
-        conditions_sweep = np.array([s in sweeps for s in sweeps_zip])
-        conditions = np.logical_and(conditions, conditions_sweep)
-
-    if not np.any(conditions):
+    if not len(content_zip):
         msg = '''
         No file was found corresponding to this format, verify pattern and product_name
         '''
         raise ValueError(msg)
         
-    files_to_retrieve = ' '.join(content_zip[conditions])
-   
-    cmd = 'unzip -j -o -qq "{:s}" {:s} -d {:s}'.format(folder_in + name_zipfile,
-         files_to_retrieve , folder_out)
-    subprocess.call(cmd, shell=True)
-        
+    return folder_in + name_zipfile, sorted(content_zip)
+
+def _retrieve_prod_daily(folder_out, start_time, end_time, product_name,
+                  pattern = None, pattern_type = 'shell', sweeps = None,
+                  cache = None, index_folder = None):
     
-    files = sorted(np.array([folder_out + c for c in
-                                  content_zip[conditions]]))    
+    """ This is a version that works only for a given day (i.e. start and end
+    time on the same day)
+    """
     
-    return files
+    folder_out += '/'
+    
+    zip_path, members = _zip_members(start_time, end_time, product_name,
+                                     pattern, pattern_type, sweeps,
+                                     index_folder)
+    
+    # Extract the files without their folder structure (as unzip -j)
+    files = []
+    zipp = None
+    try:
+        for m in members:
+            fname = folder_out + os.path.basename(m)
+            if cache != None and cache.get(zip_path, m, fname):
+                files.append(fname)
+                continue
+            if zipp == None:
+                zipp = zipfile.ZipFile(zip_path)
+            if cache != None:
+                cache.put(zipp, zip_path, m, fname)
+            else:
+                with zipp.open(m) as fin, open(fname, 'wb') as fout:
+                    shutil.copyfileobj(fin, fout)
+            files.append(fname)
+    finally:
+        if zipp != None:
+            zipp.close()
+    
+    return sorted(files)
+
+class ExtractionCache(object):
+    
+    """ A cache of the files extracted from the zip archives, with a 
+    limited size on disk. The files are stored in the cache folder under
+    a name that depends on the archive, the member and the modification time
+    of the archive, and are hard-linked to the folder where they are
+    retrieved, so that deleting them after use only releases a reference.
+    When the cache is full, the files that were used least recently and that 
+    are not linked anywhere else are removed. The same folder can be shared 
+    by several processes.
+    """
+    
+    def __init__(self, folder, max_size):
+        """
+        Creates an ExtractionCache
+        
+        Parameters
+        ----------
+        folder : str
+            directory where to store the cached files
+        max_size : float
+            maximal size of the cache in bytes
+        """
+        self.folder = folder
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self._size = sum([os.path.getsize(f) for f in self._cached_files()])
+        
+    def _cached_files(self):
+        return [f.path for f in os.scandir(self.folder) 
+                if f.is_file() and not f.name.endswith('.tmp')]
+    
+    def _cache_name(self, zip_path, member):
+        mtime = os.stat(zip_path).st_mtime
+        key = '{:s}:{:s}:{:f}'.format(os.path.abspath(zip_path), member, mtime)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.folder, digest + '_' + 
+                            os.path.basename(member))
+    
+    @staticmethod
+    def _link(src, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError: # different file system
+            shutil.copyfile(src, dst)
+            
+    def get(self, zip_path, member, fname):
+        """
+        Places a member of an archive at a given location if it is in the
+        cache
+        
+        Parameters
+        ----------
+        zip_path : str
+            full path of the zip archive
+        member : str
+            name of the member in the archive
+        fname : str
+            path where to place the file
+            
+        Returns
+        -------
+        True if the file was in the cache, False otherwise
+        """
+        cname = self._cache_name(zip_path, member)
+        try:
+            os.utime(cname) # mark as recently used
+            self._link(cname, fname)
+        except FileNotFoundError: # not cached or evicted in the meantime
+            return False
+        return True
+    
+    def put(self, zipp, zip_path, member, fname):
+        """
+        Extracts a member of an archive into the cache and places it at a 
+        given location
+        
+        Parameters
+        ----------
+        zipp : zipfile.ZipFile
+            the opened zip archive
+        zip_path : str
+            full path of the zip archive
+        member : str
+            name of the member in the archive
+        fname : str
+            path where to place the file
+        """
+        cname = self._cache_name(zip_path, member)
+        tmp_name = cname + '.{:d}.{:d}.tmp'.format(os.getpid(), 
+                                                  threading.get_ident())
+        with zipp.open(member) as fin, open(tmp_name, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        size = os.path.getsize(tmp_name)
+        os.replace(tmp_name, cname)
+        self._link(cname, fname)
+        
+        with self._lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+                
+    def _evict(self):
+        # Other processes may have added or removed files, so the size is
+        # recomputed from the folder
+        entries = []
+        for f in self._cached_files():
+            try:
+                stat = os.stat(f)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, stat.st_nlink, f))
+        entries.sort()
+        
+        self._size = sum([e[1] for e in entries])
+        for mtime, size, nlink, f in entries:
+            if self._size <= self.max_size:
+                break
+            if nlink > 1: # still in use
+                continue
+            try:
+                os.remove(f)
+                self._size -= size
+            except FileNotFoundError:
+                pass
 
 
 def retrieve_CPCCV(time, stations):
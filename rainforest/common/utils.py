@@ -22,6 +22,9 @@ import logging
 import yaml
 import  dask.dataframe as dd
 import re
+import sqlite3
+import time
+from pathlib import Path
 
 # Local imports
 from .wgs84_ch1903 import GPSConverter
@@ -579,8 +582,172 @@ def nearest_time(dt, reference):
         
     return dt2
 
+# Name of the catalog of the qpe files, stored in the main qpe folder
+QPE_CATALOG = '.qpe_catalog.db'
+
+def _qpe_file_time(fname):
+    """Returns the datetime of a qpe file based on its name, None if invalid"""
+    match = re.match('.*[a-zA-Z]([0-9]{9}).*', os.path.basename(fname))
+    if match == None:
+        return None
+    try:
+        return datetime.datetime.strptime(match[1],'%y%j%H%M')
+    except ValueError:
+        return None
+    
+def _list_qpe_files(input_folder, list_models = None):
+    """
+    Lists all qpe files in a folder (as saved by qpe_compute)
+    
+    Returns
+    -------
+    A list of tuples (model, datetime, filename)
+    """
+    out = []
+    for sub in glob.glob(input_folder + '/*'):
+        model = os.path.basename(sub)
+        if not os.path.isdir(sub):
+            continue
+        if list_models != None:
+            if model not in list_models:
+                continue
+        for f in glob.glob(sub + '/*'):
+            t = _qpe_file_time(f)
+            if t == None:
+                logging.warning('Ignoring file {:s}, invalid name'.format(f))
+                continue
+            out.append((model, t, os.path.basename(f)))
+    return out
+
+def open_qpe_catalog(input_folder):
+    """
+    Opens the catalog of all qpe files in a folder (as saved by qpe_compute),
+    which is an sqlite database stored in the folder, it is created if it 
+    does not exist yet. Use sync_qpe_catalog to bring it up to date with
+    the content of the folder.
+    
+    Parameters
+    ----------
+    input_folder : str
+        main directory where the qpe files are saved, it contains one subfolder
+        for every qpe model (type) that was used
+        
+    Returns
+    -------
+    An sqlite3 connection to the catalog, with a table "files" with columns
+    model, time (in the format YYYYmmddHHMM) and name (filename), and a 
+    table "folders" with the modification time of every model subfolder when
+    it was last synchronized
+    """
+    catalog = str(Path(input_folder, QPE_CATALOG))
+    conn = sqlite3.connect(catalog, timeout = 60)
+    conn.execute('CREATE TABLE IF NOT EXISTS files (model TEXT, time TEXT, '+
+                 'name TEXT, PRIMARY KEY (model, name))')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_time ON files (time)')
+    conn.execute('CREATE TABLE IF NOT EXISTS folders (model TEXT PRIMARY KEY, '+
+                 'mtime INTEGER)')
+    conn.commit()
+    return conn
+
+def sync_qpe_catalog(conn, input_folder, list_models = None):
+    """
+    Brings the catalog of a qpe folder up to date with its content, every
+    model subfolder that was modified since it was last synchronized is 
+    listed again, the files that are missing from the catalog are added and 
+    the files that were deleted are removed
+    
+    Parameters
+    ----------
+    conn : sqlite3 connection
+        connection to the catalog, as given by open_qpe_catalog
+    input_folder : str
+        main directory where the qpe files are saved
+    list_models: (optional)
+        List of qpe types to synchronize, if not provided all subfolders 
+        are synchronized
+    """
+    synced = dict(conn.execute('SELECT model, mtime FROM folders'))
+    models = []
+    for sub in glob.glob(input_folder + '/*'):
+        model = os.path.basename(sub)
+        if not os.path.isdir(sub):
+            continue
+        models.append(model)
+        if list_models != None:
+            if model not in list_models:
+                continue
+        # Taken before the listing, so that files added meanwhile are 
+        # listed at the next synchronization
+        mtime = os.stat(sub).st_mtime_ns
+        if synced.get(model) == mtime:
+            continue
+        
+        logging.info('Updating catalog of qpe files in {:s}'.format(sub))
+        on_disk = {}
+        for f in os.listdir(sub):
+            if f.startswith('.'):
+                continue # temporary files
+            t = _qpe_file_time(f)
+            if t != None:
+                on_disk[f] = datetime.datetime.strftime(t, '%Y%m%d%H%M')
+        in_catalog = set([r[0] for r in conn.execute(
+            'SELECT name FROM files WHERE model = ?', (model,))])
+        conn.executemany('DELETE FROM files WHERE model = ? AND name = ?',
+                         [(model, f) for f in in_catalog - set(on_disk)])
+        conn.executemany('INSERT INTO files VALUES (?,?,?)',
+                         [(model, on_disk[f], f) 
+                          for f in set(on_disk) - in_catalog])
+        # The resolution of the modification time can be coarse, a folder 
+        # modified very recently is listed again at the next synchronization
+        if time.time() - mtime / 1E9 < 2:
+            mtime = None
+        conn.execute('INSERT OR REPLACE INTO folders VALUES (?,?)', 
+                     (model, mtime))
+        
+    # Subfolders that were removed
+    for model in synced.keys():
+        if model not in models:
+            conn.execute('DELETE FROM files WHERE model = ?', (model,))
+            conn.execute('DELETE FROM folders WHERE model = ?', (model,))
+    conn.commit()
+
+def add_to_qpe_catalog(input_folder, model, t, filepath, folder_mtime = None):
+    """
+    Adds a new qpe file to the catalog of a qpe folder, see open_qpe_catalog,
+    files that are not added with this function are found by 
+    sync_qpe_catalog
+    
+    Parameters
+    ----------
+    input_folder : str
+        main directory where the qpe files are saved
+    model : str
+        name of the qpe model, i.e. of the subfolder
+    t : datetime
+        timestep of the qpe file
+    filepath : str
+        path of the qpe file
+    folder_mtime : int (optional)
+        modification time (st_mtime_ns) of the model subfolder just before 
+        the file was written, if the catalog was in sync with the subfolder 
+        at that time, it is marked as in sync again, so that the subfolder 
+        does not need to be listed by sync_qpe_catalog
+    """
+    conn = open_qpe_catalog(input_folder)
+    try:
+        conn.execute('INSERT OR REPLACE INTO files VALUES (?,?,?)',
+                     (model, datetime.datetime.strftime(t, '%Y%m%d%H%M'),
+                      os.path.basename(filepath)))
+        if folder_mtime != None:
+            conn.execute('UPDATE folders SET mtime = ? WHERE model = ? AND '+
+                         'mtime = ?', (os.stat(os.path.dirname(filepath)).
+                                       st_mtime_ns, model, folder_mtime))
+        conn.commit()
+    finally:
+        conn.close()
+        
 def get_qpe_files(input_folder, t0 = None, t1 = None, time_agg = None,
-                  list_models = None):
+                  list_models = None, catalog = None):
     """
     Gets the list of all qpe files in a folder (as saved by qpe_compute)
     and separates them by qpe type and timestep
@@ -602,42 +769,73 @@ def get_qpe_files(input_folder, t0 = None, t1 = None, time_agg = None,
     list_models: (optional)
         List of qpe types to retrieve , if not provided all folders in input_folder
         will be used
+    catalog : bool (optional)
+        If True, the files are obtained from the catalog of the folder (see 
+        open_qpe_catalog), which is created or updated if needed, instead of 
+        listing the folder. Only the subfolders that were modified since the 
+        last call are listed. This requires write access to the folder, 
+        otherwise the folder is listed. If False the folder is always listed,
+        by default the catalog is used only if it already exists (e.g. if 
+        the files were written by qpe_compute with QPE_CATALOG = 1)
     Returns
     -------
-    A dictionary where every key is a QPE model and every value is a list
-    with all files in chronological order
-    """
+    A dictionary where every key is a timestep and every value is a dictionary
+    with a list of files for every QPE model
+    """
+    files = None
+    if catalog == None:
+        catalog = os.path.exists(str(Path(input_folder, QPE_CATALOG)))
+    if catalog:
+        try:
+            conn = open_qpe_catalog(input_folder)
+            sync_qpe_catalog(conn, input_folder, list_models)
+            query = 'SELECT model, time, name FROM files'
+            conditions = []
+            params = []
+            # Files are aggregated afterwards so take some margin
+            margin = datetime.timedelta(minutes = time_agg if time_agg else 0)
+            if t0 != None:
+                conditions.append('time >= ?')
+                params.append(datetime.datetime.strftime(t0 - margin,
+                                                         '%Y%m%d%H%M'))
+            if t1 != None:
+                conditions.append('time <= ?')
+                params.append(datetime.datetime.strftime(t1 + margin, 
+                                                         '%Y%m%d%H%M'))
+            if len(conditions):
+                query += ' WHERE ' + ' AND '.join(conditions)
+            query += ' ORDER BY time'
+            files = [(m, datetime.datetime.strptime(t, '%Y%m%d%H%M'), f) for 
+                     m, t, f in conn.execute(query, params)]
+            conn.close()
+        except sqlite3.Error as e:
+            logging.warning('Could not use the catalog of {:s}: {:s}'
+                            .format(input_folder, str(e)))
+            
+    if files == None:
+        files = sorted(_list_qpe_files(input_folder), key = lambda x: x[1])
+        
     all_files = {}
-    
-    for sub in glob.glob(input_folder + '/*'):
-        model = os.path.basename(sub)
-
+    for model, t, f in files:
         if list_models != None:
             if model not in list_models:
                 continue
         
-        files = glob.glob(sub + '/*')
-        for f in files:
-            try:
-                t = str(re.match('.*[a-zA-Z]([0-9]{9}).*',f)[1])
-                t = datetime.datetime.strptime(t,'%y%j%H%M')
-                if time_agg != None:
-                    t = nearest_time(t, time_agg)
-                    
-                if t0 != None:
-                    if t < t0:
-                        continue
-                if t1 != None:
-                    if t > t1:
-                        continue
-                    
-                if t not in all_files.keys():
-                    all_files[t] = {}
-                if model not in all_files[t].keys():
-                    all_files[t][model] = []
-                
-                all_files[t][model].append(f)   
-            except:
-                pass
+        if time_agg != None:
+            t = nearest_time(t, time_agg)
+            
+        if t0 != None:
+            if t < t0:
+                continue
+        if t1 != None:
+            if t > t1:
+                continue
+            
+        if t not in all_files.keys():
+            all_files[t] = {}
+        if model not in all_files[t].keys():
+            all_files[t][model] = []
+        
+        all_files[t][model].append(str(Path(input_folder, model, f)))
             
     return all_files
@@ -27,8 +27,9 @@ from rainforest.common import constants
 from rainforest.common.lookup import get_lookup
 from rainforest.common.utils import split_by_time, read_task_file, envyaml
 from rainforest.common.utils import aggregate_multi, nested_dict_values
-from rainforest.common.radarprocessing import Radar, hydroClass_single
-from rainforest.common.retrieve_data import retrieve_prod, get_COSMO_T, get_COSMO_variables
+from rainforest.common.radarprocessing import Radar, hydroClass_single, required_moments
+from rainforest.common.retrieve_data import retrieve_many, get_COSMO_T, get_COSMO_variables
+from rainforest.common.retrieve_data import ExtractionCache
 
 IGNORE_ERRORS = True
                    
@@ -85,6 +86,15 @@ class Updater(object):
             # after aggregation to save time
             self.dims['nrv'] -= 1
             
+        # Radar moments to decode from the polar files
+        self.moments = required_moments(self.radar_variables)
+        
+        # Cache of the files extracted from the archives, shared between jobs
+        self.cache = None
+        if self.radar_cfg.get('EXTRACTION_CACHE', None) != None:
+            self.cache = ExtractionCache(self.radar_cfg['EXTRACTION_CACHE'],
+                        self.radar_cfg.get('EXTRACTION_CACHE_SIZE', 20) * 1E9)
+            
     def retrieve_radar_files(self, radar, start_time, end_time, 
                              include_vpr = True, include_status = True):
         """
@@ -112,31 +122,36 @@ class Updater(object):
             files_rad['vpr'] = {}
         
 
+        if radar in ['L','A','D']:
+            radar_vpr = radar
+        else:
+            radar_vpr = 'A'
+            
+        # Retrieve all products at once
+        requests = {'radar': {'start_time': start_time, 'end_time': end_time,
+                              'product_name': 'ML' + radar, 'sweeps': sweeps}}
+        if include_vpr:
+            requests['vpr'] = {'start_time': start_time, 'end_time': end_time,
+                               'product_name': 'ZZ' + radar_vpr}
+        if include_status:
+            requests['status'] = {'start_time': start_time, 'end_time': end_time,
+                                  'product_name': 'ST' + radar, 'pattern': 'ST*'}
+            
         try:
-            files_r = retrieve_prod(self.config['TMP_FOLDER'], 
-                                            start_time, end_time, 
-                                            product_name = 'ML' + radar,
-                                            sweeps = sweeps)
-            files_rad['radar'] = files_r
+            files = retrieve_many(self.config['TMP_FOLDER'], requests,
+                                  self.radar_cfg.get('RETRIEVAL_WORKERS', 3),
+                                  self.cache, 
+                                  self.radar_cfg.get('ARCHIVE_INDEX_FOLDER',
+                                                     None))
+            if len(files) != len(requests):
+                raise IOError('Could not retrieve all files')
             
+            files_rad['radar'] = files['radar']
             if include_vpr:
-                if radar in ['L','A','D']:
-                    radar_vpr = radar
-                else:
-                    radar_vpr = 'A'
-                    
                 # Take only one out of two since we work at 5 min
-                files_v = retrieve_prod(self.config['TMP_FOLDER'], 
-                                            start_time, end_time, 
-                                            product_name = 'ZZ' + radar_vpr)
-                files_rad['vpr'] = files_v[::2]
-                
+                files_rad['vpr'] = files['vpr'][::2]
             if include_status:
-               files_s = retrieve_prod(self.config['TMP_FOLDER'], 
-                                        start_time, end_time, 
-                                        product_name = 'ST' + radar,
-                                        pattern = 'ST*')
-               files_rad['status'] = files_s
+               files_rad['status'] = files['status']
                
             files_rad = split_by_time(files_rad)
         except:
@@ -209,19 +224,18 @@ class Updater(object):
             
         # Censor file for SNR and visib, except for the visib field, which is kept as is
       
-        if 'ZH_VISIB' in self.radar_variables  or 'ZV_VISIB' in self.radar_variables :
-            radar_object.visib_mask(self.radar_cfg['VISIB_CORR']['MIN_VISIB'],
+        radar_object.visib_mask(self.radar_cfg['VISIB_CORR']['MIN_VISIB'],
                           self.radar_cfg['VISIB_CORR']['MAX_CORR'])
             
         radar_object.snr_mask(self.radar_cfg['SNR_THRESHOLD'])
      
-        # Compute KDP if needed
-        if 'KDP' in self.radar_variables:
-            radar_object.compute_kdp(self.radar_cfg['KDP_PARAMETERS'])
+        radar_object.compute_kdp(self.radar_cfg['KDP_PARAMETERS'])
 
-        # Compute attenuation correction if needed    
-        if 'ZH_CORR' in self.radar_variables or 'ZDR_CORR' in self.radar_variables:
-            radar_object.correct_attenuation()
+        # Compute only the derived variables that are needed (visibility 
+        # correction, KDP, attenuation correction), HYDRO is computed after
+        # aggregation
+        radar_object.compute_fields([v for v in self.radar_variables 
+                                     if v != 'HYDRO'])
 
         
         for sweep in radar_object.sweeps:
@@ -429,7 +443,11 @@ class Updater(object):
                             cosmo_data = get_COSMO_variables(tstart, 
                                      self.cosmo_variables, 
                                      self.sweeps, 
-                                     tmp_folder = self.config['TMP_FOLDER'])
+                                     tmp_folder = self.config['TMP_FOLDER'],
+                                     cache_folder = self.radar_cfg.get(
+                                         'COSMO_CACHE', None),
+                                     cache_size = self.radar_cfg.get(
+                                         'COSMO_CACHE_SIZE', 20) * 1E9)
                           
                     except Exception as e:
                         logging.error(e)
@@ -464,7 +482,8 @@ class Updater(object):
                         # Create radar object
                         radar = Radar(r, rad_files['radar'][tstamp],
                                       rad_files['status'][tstamp],
-                                      rad_files['vpr'][tstamp])
+                                      rad_files['vpr'][tstamp],
+                                      fields = self.moments)
   
                         if len(self.cosmo_variables):
                             radar.add_cosmo_data(cosmo_data[r])
@@ -30,7 +30,7 @@ from rainforest.common import constants
 from rainforest.common.lookup import get_lookup
 from rainforest.common.utils import read_task_file, envyaml
 from rainforest.common.retrieve_data import retrieve_prod, retrieve_CPCCV
-from rainforest.common.io_data import read_cart
+from rainforest.common.io_data import read_cart, read_cart_points
 
 
 class Updater(object):
@@ -306,28 +306,28 @@ class Updater(object):
                     data_prod = np.zeros((N,M), dtype = np.float32) + np.nan
                     
                     
+                    # Cart pixels of all stations and neighbours
+                    rows, cols = [], []
+                    for sta in stations_to_get: # Loop on stations
+                        for nx in self.neighb_x:
+                            for ny in self.neighb_y:
+                                strnb = '{:d}{:d}'.format(nx,ny)
+                                # Get idx of Cart pixel in 2D map
+                                idx = lut_cart[sta][strnb]
+                                rows.append(idx[0])
+                                cols.append(idx[1])
+                                
                     for k, f in enumerate(files):
                         try:
-                            proddata = read_cart(f)
+                            data_prod[:,k] = read_cart_points(f, rows, cols)
                         except:
-                            # fill with missing values, we don't care about the exact dimension
-                            proddata = np.zeros((1000,1000)) + np.nan
+                            # fill with missing values
+                            data_prod[:,k] = np.nan
                             
                         # Threshold radar precip product
                         if prod == 'RZC' or prod == 'AQC':
-                            proddata[proddata < constants.MIN_RZC_VALID] = 0
-                            
-                        idx_row = 0 # Keeps track of the row
-                        for sta in stations_to_get: # Loop on stations
-                            for nx in self.neighb_x:
-                                for ny in self.neighb_y:
-                                    strnb = '{:d}{:d}'.format(nx,ny)
-                                    # Get idx of Cart pixel in 2D map
-                                    idx = lut_cart[sta][strnb]
-                                    data_prod[idx_row,k] = proddata[idx[0],
-                                                                    idx[1]]
-                           
-                                    idx_row += 1
+                            data_prod[data_prod[:,k] < constants.MIN_RZC_VALID,
+                                      k] = 0
                                                 
                     data_prod = np.nanmean(data_prod,axis = 1)
                     data_prod[np.isnan(data_prod)] = fill_value
@@ -12,6 +12,7 @@ December 2019
 
 # Global imports
 import pickle
+import logging
 import numpy as np
 from sklearn.ensemble import RandomForestRegressor
 import os
@@ -40,6 +41,120 @@ def _polyfit_no_inter(x,y, degree):
     p = np.insert(p,0,0) # Add zero intercept at beginning for compatibility with polyval
     return p[::-1] # Reverse because that's how it is in polyfit (high degree first)
     
+def _pack_forest(estimators):
+    """
+    Packs the trees of a fitted forest into flat node arrays, the node 
+    indexes of every tree are offset so that all trees share the same arrays
+    
+    Parameters
+    ----------
+    estimators : list
+        list of fitted sklearn DecisionTreeRegressor instances
+        
+    Returns
+    -------
+    A dict with keys 'feature', 'threshold', 'children_left', 'children_right'
+    and 'value' containing the node arrays and 'roots' containing the index 
+    of the root node of every tree
+    """
+    packed = {'feature': [], 'threshold': [], 'children_left': [],
+              'children_right': [], 'value': [], 'roots': []}
+    offset = 0
+    for est in estimators:
+        tree = est.tree_
+        leaf = tree.children_left == -1
+        
+        # sklearn compares float32 inputs to float64 thresholds, rounding the
+        # thresholds down gives the same decisions in float32
+        threshold = tree.threshold.astype(np.float32)
+        down = threshold > tree.threshold
+        threshold[down] = np.nextafter(threshold[down], -np.inf)
+        
+        packed['feature'].append(np.where(leaf, 0, tree.feature))
+        packed['threshold'].append(threshold)
+        packed['children_left'].append(np.where(leaf, -1, 
+                                                tree.children_left + offset))
+        packed['children_right'].append(np.where(leaf, -1,
+                                                 tree.children_right + offset))
+        packed['value'].append(tree.value[:,0,0])
+        packed['roots'].append(offset)
+        offset += tree.node_count
+        
+    return {'feature': np.concatenate(packed['feature']).astype(np.int32),
+            'threshold': np.concatenate(packed['threshold']),
+            'children_left': np.concatenate(packed['children_left']).astype(np.int32),
+            'children_right': np.concatenate(packed['children_right']).astype(np.int32),
+            'value': np.concatenate(packed['value']).astype(np.float64),
+            'roots': np.array(packed['roots'], dtype = np.int32)}
+
+_FOREST_KERNEL = None
+
+def _forest_kernel():
+    """
+    Returns the numba compiled function that evaluates a packed forest on 
+    a batch of samples, in parallel over the samples. The average of all trees
+    is then passed through a polynomial (in the np.polyval convention) and 
+    optionally clipped at zero. numba is only imported on first use.
+    
+    The kernel may be called from several threads at once, so numba must use
+    a thread-safe threading layer (tbb or omp), unless NUMBA_THREADING_LAYER 
+    is set this function selects one for the whole process. If none is 
+    available, a serial kernel is returned instead.
+    """
+    global _FOREST_KERNEL
+    if _FOREST_KERNEL != None:
+        return _FOREST_KERNEL
+    
+    import numba
+    if numba.config.THREADING_LAYER == 'default':
+        numba.config.THREADING_LAYER = 'threadsafe'
+    
+    def kernel(X, feature, threshold, children_left, children_right, value,
+               roots, coefs, clip):
+        n = X.shape[0]
+        out = np.empty(n, dtype = np.float64)
+        for i in numba.prange(n):
+            acc = 0.
+            for r in range(roots.shape[0]):
+                node = roots[r]
+                while children_left[node] != -1:
+                    if X[i, feature[node]] <= threshold[node]:
+                        node = children_left[node]
+                    else:
+                        node = children_right[node]
+                acc += value[node]
+            acc /= roots.shape[0]
+            
+            # Horner evaluation of the bias-correction polynomial
+            y = 0.
+            for c in range(coefs.shape[0]):
+                y = y * acc + coefs[c]
+            if clip and y < 0:
+                y = 0.
+            out[i] = y
+        return out
+    
+    parallel_kernel = numba.njit(parallel = True)(kernel)
+    try:
+        # The threading layer is loaded on the first parallel call
+        parallel_kernel(np.zeros((1, 1), dtype = np.float32), 
+                        np.zeros(1, dtype = np.int32), 
+                        np.zeros(1, dtype = np.float32),
+                        np.full(1, -1, dtype = np.int32), 
+                        np.full(1, -1, dtype = np.int32),
+                        np.zeros(1), np.zeros(1, dtype = np.int32),
+                        np.array([1., 0.]), True)
+        layer = numba.threading_layer()
+    except Exception:
+        layer = None
+    
+    if layer in ['tbb', 'omp']:
+        _FOREST_KERNEL = parallel_kernel
+    else:
+        logging.warning('No thread-safe threading layer (tbb or omp) is available for numba, the compiled RF will not run in parallel')
+        _FOREST_KERNEL = numba.njit(kernel)
+    return _FOREST_KERNEL
+    
 class RandomForestRegressorBC(RandomForestRegressor):
     '''
     This is an extension of the RandomForestRegressor regressor class of
@@ -58,6 +173,10 @@ class RandomForestRegressorBC(RandomForestRegressor):
     spline fit between sorted predictions and sorted observations. Any
     new method should be added in this class in order to be used.
     
+    After calling *compile*, the predictions are computed from flat node 
+    arrays with a numba compiled traversal of all trees, instead of the 
+    sklearn implementation, this requires numba to be installed.
+    
     For any information regarding the sklearn parent class see
     
     https://github.com/scikit-learn/scikit-learn/blob/b194674c4/sklearn/ensemble/_forest.py#L1150
@@ -131,8 +250,67 @@ class RandomForestRegressorBC(RandomForestRegressor):
         else:
             self.p = 1
             
+        if getattr(self, 'compiled', None) != None:
+            self.compile()
         return 
     
+    def compile(self):
+        """
+        Packs the fitted trees into flat node arrays so that predict uses
+        the compiled traversal instead of the sklearn implementation.
+        If numba is not available, or if the forest has several outputs or 
+        routes missing values to the left child of some nodes, which the 
+        compiled traversal does not support, the sklearn implementation is 
+        kept. The compiled predict is thread-safe only with the tbb or omp
+        threading layers of numba, see _forest_kernel.
+        
+        Returns
+        -------
+        True if the compiled traversal will be used, False otherwise
+        """
+        self.compiled = None
+        if self.n_outputs_ != 1:
+            logging.warning('The RF has several outputs, it will not be compiled')
+            return False
+        for est in self.estimators_:
+            tree = est.tree_
+            # Missing values always go to the right child in the traversal
+            missing_left = getattr(tree, 'missing_go_to_left', None)
+            if (missing_left is not None and 
+                np.any(np.asarray(missing_left)[tree.children_left != -1])):
+                logging.warning('The RF was trained with missing values, it will not be compiled')
+                return False
+            
+        try:
+            _forest_kernel()
+        except ImportError:
+            logging.warning('numba is not available, the RF will not be compiled')
+            return False
+        
+        self.compiled = _pack_forest(self.estimators_)
+        return True
+    
+    def _predict_compiled(self, X, bc = True):
+        """
+        Predicts the regression target with the compiled forest, the 
+        polynomial bias-corrections are applied within the traversal
+        """
+        X = np.ascontiguousarray(X, dtype = np.float32)
+        
+        coefs = np.array([1., 0.]) # identity
+        if bc and self.bctype in ['cdf','raw']:
+            coefs = np.asarray(self.p, dtype = np.float64)
+        spline = bc and self.bctype == 'spline'
+        
+        c = self.compiled
+        out = _forest_kernel()(X, c['feature'], c['threshold'], 
+                               c['children_left'], c['children_right'],
+                               c['value'], c['roots'], coefs, not spline)
+        if spline:
+            out = self.p(out)
+            out[out < 0] = 0
+        return out
+    
     def predict(self, X, round_func = None, bc = True):
         """
         Predict regression target for X.
@@ -156,10 +334,13 @@ class RandomForestRegressorBC(RandomForestRegressor):
         y : array-like of shape (n_samples,) or (n_samples, n_outputs)
             The predicted values.
         """
-        pred = super().predict(X)
-        
         if round_func == None:
             round_func = lambda x: x
+            
+        if getattr(self, 'compiled', None) != None:
+            return round_func(self._predict_compiled(X, bc))
+        
+        pred = super().predict(X)
         
         func = lambda x: x
         if bc:
@@ -21,13 +21,14 @@ import matplotlib.pyplot as plt
 from ..common.utils import read_df, get_qpe_files, perfscores
 from ..common.utils import timestamp_from_datetime, nearest_time
 from ..common.lookup import get_lookup
-from ..common.io_data import read_cart
+from ..common.io_data import read_cart_points
 from ..common.graphics import score_plot, qpe_scatterplot
 from ..common.retrieve_data import retrieve_CPCCV
 
 def evaluation(qpefolder, gaugepattern, list_models = None, 
                outputfolder = './', t0 = None, t1 = None,
-               bounds10 = [0,2,10,100], bounds60 = [0,1,10,100]):
+               bounds10 = [0,2,10,100], bounds60 = [0,1,10,100],
+               catalog = None):
     
     """
         PErforms an evaluation of QPE products with reference gauge data
@@ -55,12 +56,16 @@ def evaluation(qpefolder, gaugepattern, list_models = None,
         list_models : list of str
             list of models to use in the evaluation, default is to use all
             subfolders (models) available in qpefolder
+        catalog : bool (optional)
+            whether to find the QPE files with the catalog of qpefolder, see 
+            get_qpe_files, by default it is used if it exists
                         
      
     """
     logging.info('Getting all files from qpe folder {:s}'.format(qpefolder))
 
-    tmp = get_qpe_files(qpefolder, time_agg = 10, list_models = list_models)
+    tmp = get_qpe_files(qpefolder, time_agg = 10, list_models = list_models,
+                        catalog = catalog)
     # Get only timesteps where at least 2 files are available during 10 min period
     qpe_files10 = copy.deepcopy(tmp)
     for k in tmp.keys():
@@ -97,6 +102,9 @@ def evaluation(qpefolder, gaugepattern, list_models = None,
     
     logging.info('Getting lookup table')
     lut = get_lookup('station_to_qpegrid')
+    # QPE grid pixels of all stations
+    rows = np.array([lut[s]['00'][0] for s in stations])
+    cols = np.array([lut[s]['00'][1] for s in stations])
     
     # Initialize matrices of precip at stations
     precip_qpe = {}
@@ -115,9 +123,7 @@ def evaluation(qpefolder, gaugepattern, list_models = None,
         # Get QPE precip
         for m in models:
             for f in qpe_files10_filt[tstep][m]:
-                data = read_cart(f)
-                for j,s in enumerate(stations):
-                    precip_qpe[m][i,j] += data[lut[s]['00'][0], lut[s]['00'][1]]
+                precip_qpe[m][i] += read_cart_points(f, rows, cols)
                     
             precip_qpe[m][i] /= len(qpe_files10_filt[tstep][m])
    
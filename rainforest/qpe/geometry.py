@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Functions to compile and read the QPE geometry plans, i.e. the sparse
+operators that map the polar gates of every radar and sweep to the Cartesian
+QPE grid, as well as the heights of all polar gates
+
+The plans are stored as plain .npy files (one file per array) so that they
+can be memory-mapped, every QPEProcessor instance reading them will then
+share the same pages through the OS cache
+
+Every radar has a manifest that records the modification time of the lookup
+tables the plans were compiled from, plans that are older than the lookup
+tables are ignored and recomputed
+"""
+
+import os
+import json
+import logging
+import numpy as np
+from pathlib import Path
+from scipy.sparse import csr_matrix
+
+from ..common import constants
+from ..common.lookup import get_lookup, LOOKUP_FOLDER
+
+# Default folder where the plans are stored
+GEOMETRY_FOLDER = str(Path(LOOKUP_FOLDER, 'qpe_geometry'))
+
+# Centerpoints of all QPE grid cells
+Y_QPE_CENTERS = constants.Y_QPE_CENTERS
+X_QPE_CENTERS = constants.X_QPE_CENTERS
+
+NBINS_X = len(X_QPE_CENTERS)
+NBINS_Y = len(Y_QPE_CENTERS)
+
+# Arrays that make up the plan of a single radar and sweep
+PLAN_ARRAYS = ['indptr', 'indices', 'data', 'height']
+# Version of the layout of the plans, plans with another version are ignored
+GEOMETRY_VERSION = 1
+# Lookup tables from which the plans are compiled
+SOURCE_LOOKUPS = ['qpegrid_to_rad', 'cartcoords_rad']
+
+def projection_operator(lut_elev, polar_shape):
+    """
+    Builds a sparse operator that maps the polar gates of a given sweep to
+    the Cartesian QPE grid, i.e. the sum of all gates falling within every
+    QPE pixel is obtained with a single sparse matrix product
+
+    Parameters
+    ----------
+    lut_elev : ndarray
+        2D array with 5 columns, subset of the qpegrid_to_rad lookup table
+        that corresponds to a single sweep
+        | sweep | azimuth_idx | range_idx | Swiss Y coord | Swiss X coord|
+    polar_shape : tuple
+        shape of the polar data of the sweep (nazimuth x nrange)
+
+    Returns
+    -------
+    A scipy.sparse CSR matrix of shape (NBINS_X * NBINS_Y) x (nazimuth * nrange)
+    """
+    # Convert from Swiss-coordinates to array index
+    idx_x = (NBINS_X - (lut_elev[:,4] - np.min(X_QPE_CENTERS))).astype(int)
+    idx_y = (lut_elev[:,3] -  np.min(Y_QPE_CENTERS)).astype(int)
+    idx_az = lut_elev[:,1].astype(int)
+    idx_rng = lut_elev[:,2].astype(int)
+
+    # Ignore gates that fall outside of the QPE grid or of the polar data
+    valid = np.logical_and.reduce((idx_x >= 0, idx_x < NBINS_X,
+                                   idx_y >= 0, idx_y < NBINS_Y,
+                                   idx_az < polar_shape[0],
+                                   idx_rng < polar_shape[1]))
+
+    rows = idx_x[valid] * NBINS_Y + idx_y[valid]
+    cols = idx_az[valid] * polar_shape[1] + idx_rng[valid]
+
+    # Duplicate (row, col) entries are summed, as with np.add.at
+    return csr_matrix((np.ones(len(rows), dtype = np.float32), (rows, cols)),
+                      shape = (NBINS_X * NBINS_Y,
+                               polar_shape[0] * polar_shape[1]))
+
+def _plan_name(folder, radar, sweep, array):
+    return str(Path(folder, 'plan_{:s}{:02d}_{:s}.npy'.format(radar, sweep,
+                                                              array)))
+
+def _manifest_name(folder, radar):
+    return str(Path(folder, 'plan_{:s}_manifest.json'.format(radar)))
+
+def _source_mtimes(radar):
+    """Returns the modification time of the lookup tables from which the
+    plans of a radar are compiled, None if a table does not exist
+    """
+    mtimes = {}
+    for lookup_type in SOURCE_LOOKUPS:
+        lut_name = str(Path(LOOKUP_FOLDER, 'lut_' + lookup_type + radar + '.p'))
+        if os.path.exists(lut_name):
+            mtimes[lookup_type] = os.path.getmtime(lut_name)
+        else:
+            mtimes[lookup_type] = None
+    return mtimes
+
+def _read_manifest(folder, radar):
+    """Reads the manifest of the plans of a radar, None if there is none"""
+    try:
+        with open(_manifest_name(folder, radar), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _is_up_to_date(folder, radar, sweeps, manifest):
+    """Checks that the plans of a radar exist for all sweeps, have the 
+    current layout and were compiled from the current lookup tables
+    """
+    if manifest == None:
+        return False
+    if manifest.get('version') != GEOMETRY_VERSION:
+        return False
+    if manifest.get('sources') != _source_mtimes(radar):
+        return False
+    for sweep in sweeps:
+        for k in PLAN_ARRAYS:
+            if not os.path.exists(_plan_name(folder, radar, sweep, k)):
+                return False
+    return True
+
+def _replace(fname, write):
+    """Writes a file under a temporary name with the function write(file) 
+    and renames it, processes that memory-mapped the previous file keep 
+    reading it unchanged
+    """
+    tmp_name = str(Path(os.path.dirname(fname), '.{:s}.{:d}.tmp'.format(
+        os.path.basename(fname), os.getpid())))
+    try:
+        with open(tmp_name, 'wb') as f:
+            write(f)
+        os.replace(tmp_name, fname)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+def compute_geometry(radar, sweeps):
+    """
+    Computes the sparse polar to Cartesian operators and the heights of all 
+    polar gates of a radar directly from the lookup tables, this is much 
+    slower than reading the compiled plans
+    
+    Parameters
+    ----------
+    radar : char
+        radar for which to compute the geometry
+    sweeps : list of int
+        list of sweeps for which to compute the geometry
+        
+    Returns
+    -------
+    proj_operators : dict
+        the sparse polar to Cartesian operators in the form dict[sweep]
+    rad_heights : dict
+        the heights of all polar gates in the form dict[sweep]
+    """
+    lut_cart = np.array(get_lookup('qpegrid_to_rad', radar = radar))
+    coords = get_lookup('cartcoords_rad', radar)
+    proj_operators = {}
+    rad_heights = {}
+    for sweep in sweeps:
+        # Same type as in the compiled plans
+        rad_heights[sweep] = coords[sweep][2].astype(np.float32)
+        # get cart index of all polar gates for this sweep
+        lut_elev = lut_cart[lut_cart[:,0] == sweep - 1] # 0-indexed
+        proj_operators[sweep] = projection_operator(lut_elev, 
+                                                    rad_heights[sweep].shape)
+    return proj_operators, rad_heights
+
+def compile_geometry(radars = None, sweeps = None, folder = GEOMETRY_FOLDER):
+    """
+    Compiles the geometry plans from the qpegrid_to_rad and cartcoords_rad
+    lookup tables and writes them to a folder in .npy format
+
+    Parameters
+    ----------
+    radars : list of chars (optional)
+        list of radars for which to compile the plans, if not specified
+        all 5 radars will be used ('A','L','D','W','P')
+    sweeps : list of int (optional)
+        list of sweeps for which to compile the plans, if not specified, all
+        20 will be used
+    folder : str (optional)
+        directory where to store the plans, default is the qpe_geometry
+        subfolder of the lookup tables folder
+    """
+    if radars == None:
+        radars = list(constants.RADARS.Abbrev)
+    if sweeps == None:
+        sweeps = range(1,21)
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    for rad in radars:
+        logging.info('Compiling geometry plans for radar {:s}'.format(rad))
+        sources = _source_mtimes(rad)
+        proj_operators, rad_heights = compute_geometry(rad, sweeps)
+        
+        # Without manifest the plans are not used by new QPE processes while
+        # they are replaced, running processes keep the files they mapped
+        if os.path.exists(_manifest_name(folder, rad)):
+            os.remove(_manifest_name(folder, rad))
+        for sweep in sweeps:
+            height = rad_heights[sweep]
+            proj = proj_operators[sweep]
+
+            plan = {'indptr': proj.indptr.astype(np.int32),
+                    'indices': proj.indices.astype(np.int32),
+                    'data': proj.data.astype(np.float32),
+                    'height': height.astype(np.float32)}
+            for k in PLAN_ARRAYS:
+                _replace(_plan_name(folder, rad, sweep, k),
+                         lambda f: np.save(f, plan[k]))
+        
+        # The manifest is written last, the plans are used only if it exists
+        manifest = {'version': GEOMETRY_VERSION, 'sources': sources,
+                    'sweeps': list(sweeps)}
+        _replace(_manifest_name(folder, rad), 
+                 lambda f: f.write(json.dumps(manifest).encode()))
+
+def load_geometry(radars, sweeps, folder = GEOMETRY_FOLDER):
+    """
+    Reads the geometry plans as memory-mapped arrays, the plans of radars 
+    that were not compiled or were compiled from older lookup tables are 
+    computed from the lookup tables instead
+
+    Parameters
+    ----------
+    radars : list of chars
+        list of radars for which to read the plans
+    sweeps : list of int
+        list of sweeps for which to read the plans
+    folder : str (optional)
+        directory where the plans are stored, as given by compile_geometry
+
+    Returns
+    -------
+    proj_operators : dict
+        the sparse polar to Cartesian operators in the form dict[radar][sweep]
+    rad_heights : dict
+        the heights of all polar gates in the form dict[radar][sweep]
+    """
+    proj_operators = {}
+    rad_heights = {}
+    for rad in radars:
+        manifest = _read_manifest(folder, rad)
+        if _is_up_to_date(folder, rad, sweeps, manifest):
+            try:
+                proj_operators[rad], rad_heights[rad] = _load_plans(folder, 
+                                                                rad, sweeps)
+                # Make sure the plans were not recompiled in the meantime
+                if _read_manifest(folder, rad) == manifest:
+                    continue
+            except (OSError, ValueError):
+                pass
+            
+        logging.warning('No up to date geometry found in {:s} for radar {:s}, computing it from the lookup tables'
+                        .format(str(folder), rad))
+        logging.warning('Use the qpe_geometry command to compile it once')
+        proj_operators[rad], rad_heights[rad] = compute_geometry(rad, sweeps)
+    return proj_operators, rad_heights
+
+def _load_plans(folder, rad, sweeps):
+    """Reads the plans of a radar as memory-mapped arrays, see 
+    load_geometry
+    """
+    proj_operators = {}
+    rad_heights = {}
+    for sweep in sweeps:
+        plan = {}
+        for k in PLAN_ARRAYS:
+            plan[k] = np.load(_plan_name(folder, rad, sweep, k),
+                              mmap_mode = 'r')
+
+        height = plan['height']
+        proj_operators[sweep] = csr_matrix((plan['data'], plan['indices'],
+                                            plan['indptr']),
+                                 shape = (NBINS_X * NBINS_Y, height.size),
+                                 copy = False)
+        rad_heights[sweep] = height
+    return proj_operators, rad_heights
@@ -16,22 +16,32 @@ warnings.filterwarnings('ignore')
 import numpy as np 
 import datetime
 import os
+import glob
+import time
+import pickle
+import sqlite3
 import logging
+import threading
+import multiprocessing
+from queue import Queue
 logging.basicConfig(level=logging.INFO)
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from scipy.ndimage import gaussian_filter
-from scipy.signal import convolve2d
 from scipy.ndimage import map_coordinates
 
 logging.getLogger().setLevel(logging.INFO)
 
 
 from ..common import constants
-from ..common.retrieve_data import retrieve_prod, get_COSMO_T
-from ..common.lookup import get_lookup
-from ..common.utils import split_by_time, nanadd_at, envyaml
-from ..common.radarprocessing import Radar
+from ..common.retrieve_data import retrieve_many, get_COSMO_T, ExtractionCache
+from ..common.utils import split_by_time, envyaml
+from ..common.utils import timefromfilename, sweepnumber_fromfile
+from ..common.utils import add_to_qpe_catalog
+from ..common.radarprocessing import Radar, required_moments
 from ..common.io_data import save_gif
+from .geometry import load_geometry, GEOMETRY_FOLDER
 
 ###############################################################################
 # Centerpoints of all QPE grid cells
@@ -43,18 +53,84 @@ NBINS_Y = len(Y_QPE_CENTERS)
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+# Config keys that are not required, with their default values
+OPTIONAL_KEYS = {'GEOMETRY_FOLDER': GEOMETRY_FOLDER,
+                 'NUM_WORKERS': 1,
+                 'WORKER_TYPE': 'process',
+                 'PREFETCH': 0,
+                 'COMPILE_RF': 0,
+                 'PREDICT_WORKERS': None,
+                 'PREDICT_CHUNK_SIZE': 20000,
+                 'WRITER_QUEUE': 0,
+                 'ADVECTION_REFERENCE': None,
+                 'OUTLIER_WINDOW': 3,
+                 'QPE_CATALOG': 1,
+                 'IN_MEMORY': 0,
+                 'RETRIEVAL_WORKERS': 1,
+                 'EXTRACTION_CACHE': None,
+                 'EXTRACTION_CACHE_SIZE': 20,
+                 'ARCHIVE_INDEX_FOLDER': None}
+
+# Number of pixels within the window of the outlier removal, by shape and size
+_OUTLIER_NORMS = {}
+
+def _box_sum(image, N):
+    """
+    Computes the sum over a square moving window of size 2N+1 along the last
+    two axes of an array, with summed-area tables, so that the cost does not 
+    depend on the size of the window. Pixels outside of the image count as 0.
+    
+    Parameters
+    ----------
+    image : ndarray
+        array of at least 2 dimensions
+    N : int
+        half size of the moving window
+        
+    Returns
+    -------
+    An array with the same shape as image
+    """
+    k = 2*N+1
+    pad = [(0,0)] * (image.ndim - 2) + [(N+1, N), (N+1, N)]
+    c = np.pad(image, pad).cumsum(axis = -2).cumsum(axis = -1)
+    return c[...,k:,k:] - c[...,:-k,k:] - c[...,k:,:-k] + c[...,:-k,:-k]
+
+def _outlier_norm(shape, N = 3):
+    """
+    Returns the number of pixels within the moving window of the outlier
+    removal, for an image without missing values, it is computed only once 
+    for every shape and window size
+    
+    Parameters
+    ----------
+    shape : tuple
+        shape of the image
+    N : int
+        half size of the moving window, see _outlier_removal
+        
+    Returns
+    -------
+    A 2D array with the same shape as the image
+    """
+    if (shape, N) not in _OUTLIER_NORMS.keys():
+        _OUTLIER_NORMS[(shape, N)] = _box_sum(np.ones(shape), N)
+    return _OUTLIER_NORMS[(shape, N)]
+
 def _outlier_removal(image, N = 3, threshold = 3):
     """
     Performs localized outlier correction by standardizing the data in a moving
-    window and remove values that are below - threshold or above + threshold
+    window and remove values that are above + threshold, missing values 
+    (nan) are ignored in the statistics of the window and kept as they are
     
     Parameters
     ----------
     image : ndarray
-        2D numpy array, of shape
+        2D numpy array, or 3D array containing a stack of 2D images that are
+        processed independently (f.ex. one per model)
     N : int
-        size of the moving window, for both rows and columns ( the window is
-        square)
+        half size of the moving window, for both rows and columns ( the window
+        is square, of size 2N+1)
     threshold : threshold for a standardized value to be considered an outlier
            
     Returns
@@ -63,24 +139,62 @@ def _outlier_removal(image, N = 3, threshold = 3):
     """
     
     im = np.array(image, dtype=float)
-    im2 = im**2
+    valid = np.isfinite(im)
     
-    im_copy = im.copy()
-    ones = np.ones(im.shape)
-
-    kernel = np.ones((2*N+1, 2*N+1))
-    s = convolve2d(im, kernel, mode="same")
-    s2 = convolve2d(im2, kernel, mode="same")
-    ns = convolve2d(ones, kernel, mode="same")
-    
-    mean = (s/ns)
-    std = (np.sqrt((s2 - s**2 / ns) / ns))
+    if valid.all():
+        ns = _outlier_norm(im.shape[-2:], N)
+    else:
+        im[~valid] = 0
+        ns = _box_sum(valid.astype(float), N)
+        
+    s = _box_sum(im, N)
+    s2 = _box_sum(im**2, N)
     
-    z = (image - mean)/std
-    im_copy[z >= threshold] = mean[z >= threshold]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = (s/ns)
+        std = np.sqrt(np.maximum(s2 - s**2 / ns, 0) / ns)
+        z = (im - mean)/std
+        
+    outliers = np.logical_and(valid, z >= threshold)
+    im_copy = np.array(image, dtype=float)
+    im_copy[outliers] = mean[outliers]
     return im_copy
     
-def _disaggregate(R, T = 5, t = 1,):
+# Pixel coordinates of the grids used in the advection correction, by shape
+_ADVECTION_GRIDS = {}
+
+def _advection_grid(shape):
+    """
+    Returns the row and column coordinates of all pixels of an image, they 
+    are computed only once for every shape
+    """
+    if shape not in _ADVECTION_GRIDS.keys():
+        x,y = np.meshgrid(np.arange(shape[1],dtype=float),
+                          np.arange(shape[0],dtype=float))
+        _ADVECTION_GRIDS[shape] = (y, x)
+    return _ADVECTION_GRIDS[shape]
+
+def _motion_field(R):
+    """
+    Computes the motion field between two consecutive QPE images with the
+    Lucas-Kanade optical flow of pysteps
+    
+    Parameters
+    ----------
+    R : list
+        List of two numpy 2D arrays, containing the previous and the current
+        QPE estimate
+        
+    Returns
+    -------
+    The motion field as an array of shape 2 x nrows x ncols, the first 
+    component is along the columns and the second along the rows
+    """
+    import pysteps
+    oflow_method = pysteps.motion.get_method("LK")
+    return oflow_method(np.log(R))
+
+def _disaggregate(R, T = 5, t = 1, V = None):
     """
     Disaggregates a set of two consecutive QPE images to 1 min resolution and
     then averages them to get a new advection corrected QPE estimates
@@ -95,31 +209,163 @@ def _disaggregate(R, T = 5, t = 1,):
     t : int
         The reference time interval used for the disaggregation, 1 min by 
         default, should not be touched I think
-  
+    V : ndarray (optional)
+        The motion field between the two images, as given by _motion_field, 
+        it is computed from R if not provided
+        
     Returns
     -------
     An advection corrected QPE estimate
     
     """
-    import pysteps
-    x,y = np.meshgrid(np.arange(R[0].shape[1],dtype=float),
-                  np.arange(R[0].shape[0],dtype=float))
-    oflow_method = pysteps.motion.get_method("LK")
-    V1 = oflow_method(np.log(R))
-    Rd = np.zeros((R[0].shape))
+    R = np.asarray(R, dtype = float)
+    if V is None:
+        V = _motion_field(R)
+    y, x = _advection_grid(R[0].shape)
     
-    for i in range(1 + int(T/t)):
-        
-        pos1 = (y - i/T * V1[1],x - i/T * V1[0])
-        R1 = map_coordinates(R[0],pos1, order = 1)
-        
-        pos2 = (y + (T-i)/T * V1[1],x + (T-i)/T * V1[0])
-        R2 = map_coordinates(R[1],pos2, order = 1)
-        
-        Rd += (T-i) * R1 + i * R2
+    # Interpolate all intermediate steps of both images at once, the first
+    # coordinate is the index of the image, which is integer so the linear
+    # interpolation along it returns the values of the image itself
+    steps = np.arange(1 + int(T/t))[:,None,None]
+    n = len(steps)
+    coords = np.empty((3, 2 * n) + R[0].shape)
+    coords[0,:n] = 0
+    coords[0,n:] = 1
+    coords[1,:n] = y - steps/T * V[1]
+    coords[2,:n] = x - steps/T * V[0]
+    coords[1,n:] = y + (T - steps)/T * V[1]
+    coords[2,n:] = x + (T - steps)/T * V[0]
+    Ri = map_coordinates(R, coords, order = 1)
+    
+    weights = np.concatenate((T - steps.ravel(), steps.ravel()))
+    Rd = np.tensordot(weights, Ri, axes = 1)
     return 1/T**2 * Rd
 
+def _preprocess_radar(radname, polfiles, statusfile, cosmo_data, config,
+                      fields):
+    """
+    Reads the polar data of a single radar, applies the masking and computes
+    the derived variables, this is done in a separate function so that it 
+    can be run in parallel for all radars
+    
+    Parameters
+    ----------
+    radname : char
+        Name of the radar, either 'A','D','L','P' or 'W'
+    polfiles : list of str
+        List of full filepaths of the radar files for a given timestep
+    statusfile : str or bytes
+        Full path of the status file that corresponds to this radar and
+        timestep, or its content
+    cosmo_data : dict
+        dict of COSMO data at polar coordinates, in the form dic[variable][sweep]
+    config : dict
+        the QPE configuration, as read from the yaml config file
+    fields : list of str
+        the name of all fields to return, see Radar.get_field
+        
+    Returns
+    -------
+    A dict of the form dic[sweep][field] containing the fields as numpy arrays
+    where masked values are replaced by nan
+    """
+    # Decode and compute only the fields that are needed
+    radobject = Radar(radname, polfiles, statusfile, 
+                      fields = required_moments(fields))
+    radobject.visib_mask(config['VISIB_CORR']['MIN_VISIB'],
+                         config['VISIB_CORR']['MAX_CORR'])
+    radobject.snr_mask(config['SNR_THRESHOLD'])
+    radobject.compute_kdp(config['KDP_PARAMETERS'])
+    radobject.add_cosmo_data(cosmo_data)
+    
+    if 'KDP' in [f.upper() for f in fields]:
+        try:
+            radobject.compute_fields(['KDP']) # all sweeps at once
+        except:
+            logging.error('Could not compute KDP for radar {:s}'.format(radname))
+            
+    data = {}
+    for sweep in radobject.sweeps:
+        try:
+            datasweep = {}
+            for f in fields:
+                datasweep[f] = np.ma.filled(radobject.get_field(sweep, f),
+                                            np.nan)
+            data[sweep] = datasweep
+        except:
+            logging.error('Could not get data for radar {:s} and sweep {:d}'
+                          .format(radname, sweep))
+    return data
+
+
+def _predict_chunk(model, X, out, idx):
+    """
+    Predicts a block of rows with a RF model and writes the result in place
+    
+    Parameters
+    ----------
+    model : RandomForestRegressorBC instance
+        the model to use
+    X : ndarray
+        2D array of features of the block (rows x variables)
+    out : ndarray
+        1D output array where to write the predictions
+    idx : ndarray
+        indexes of the rows of X in the output array
+    """
+    out[idx] = model.predict(X)
 
+def _write_qpe(filepath, qpe, file_format):
+    """
+    Writes a QPE field to a file, the file is first written with a temporary
+    hidden name in the same folder and then renamed, so that it never appears
+    partially written
+    
+    Parameters
+    ----------
+    filepath : str
+        Full path of the file to write, without extension
+    qpe : ndarray
+        2D array of precipitation intensities, it is not modified
+    file_format : str
+        Either 'DN' (binary bytes), 'DN_gif' (gif file) or 'float' (binary
+        float32)
+        
+    Returns
+    -------
+    The full path of the written file, with extension
+    """
+    qpe = np.array(qpe) # copy
+    
+    if file_format == 'DN_gif':
+        filepath += '.gif'
+    elif file_format not in ['DN', 'float']:
+        logging.error('Invalid file_format, using float instead')
+        file_format = 'float'
+        
+    folder, name = os.path.split(filepath)
+    tmppath = str(Path(folder, '.' + name))
+    try:
+        if file_format == 'DN' :
+            # Find idx from CPC scale
+            qpe = np.searchsorted(constants.SCALE_CPC, qpe)
+            qpe = qpe.astype('B') # Convert to byte
+            qpe[constants.MASK_NAN] = 255
+            qpe.tofile(tmppath)
+        elif file_format == 'DN_gif':
+            qpe[constants.MASK_NAN] = -99
+            save_gif(tmppath, qpe)
+        else:
+            qpe = qpe.astype(np.float32)
+            qpe[constants.MASK_NAN] = np.nan
+            qpe.tofile(tmppath)
+        os.replace(tmppath, filepath)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    return filepath
+        
 class QPEProcessor(object):
     def __init__(self, config_file, models):
         """
@@ -147,7 +393,10 @@ class QPEProcessor(object):
         config = envyaml(config_file)
             
         self.config = config
-            
+        for k in OPTIONAL_KEYS.keys():
+            if k not in self.config.keys():
+                self.config[k] = OPTIONAL_KEYS[k]
+                
         self.models = models
         
         if self.config['RADARS'] == 'all':
@@ -156,18 +405,22 @@ class QPEProcessor(object):
         if self.config['SWEEPS'] == 'all':
             self.config['SWEEPS'] = list(range(1,21))
 
-        # Precompute cart. lookup tables and radar heights
-        self.lut_cart = {}
-        self.rad_heights = {}
-        
-        for rad in self.config['RADARS']:
-            self.lut_cart[rad] = np.array(get_lookup('qpegrid_to_rad', 
-                         radar = rad))
-            self.rad_heights[rad] = {}
-            coords = get_lookup('cartcoords_rad', rad)
-            for sweep in self.config['SWEEPS']:
-                self.rad_heights[rad][sweep] = coords[sweep][2]
+        # Read precompiled polar to cart. operators and radar heights
+        self.proj_operators, self.rad_heights = load_geometry(
+            self.config['RADARS'], self.config['SWEEPS'], 
+            self.config['GEOMETRY_FOLDER'])
         
+        compiled = False
+        for k in self.models.keys():
+            # If PREDICT_WORKERS is given, the parallelism of the prediction
+            # is given by it only, otherwise n_jobs of the models is used
+            if (self.config['PREDICT_WORKERS'] != None and 
+                hasattr(self.models[k], 'n_jobs')):
+                self.models[k].n_jobs = 1
+            if self.config['COMPILE_RF'] and hasattr(self.models[k], 'compile'):
+                # Use the compiled traversal of the trees for prediction
+                compiled = self.models[k].compile() or compiled
+                    
         self.model_weights_per_var = {}
         # keys of this dict are the variable used for the RF models, their values
         # is a list of all vertical weighting to be used
@@ -177,7 +430,304 @@ class QPEProcessor(object):
                     self.model_weights_per_var[var] = []
                 if models[k].beta not in self.model_weights_per_var[var]:
                     self.model_weights_per_var[var].append(models[k].beta)
+        
+        # Radar fields that need to be computed for the models
+        self.radar_fields = ['ZH']
+        for var in self.model_weights_per_var.keys():
+            if 'RADAR' in var or var == 'HEIGHT':
+                continue
+            if var not in self.radar_fields:
+                self.radar_fields.append(var)
+                
+        # Cache of the files extracted from the archives
+        self.cache = None
+        if self.config['EXTRACTION_CACHE'] != None:
+            self.cache = ExtractionCache(self.config['EXTRACTION_CACHE'],
+                                self.config['EXTRACTION_CACHE_SIZE'] * 1E9)
+            
+        # Pool of workers for the radar preprocessing
+        self.executor = None
+        if self.config['NUM_WORKERS'] > 1:
+            self._start_executor(self.config['WORKER_TYPE'])
             
+        # Pool of threads for the RF prediction
+        self.predict_executor = None
+        n_workers = self.config['PREDICT_WORKERS']
+        if compiled and n_workers != None and n_workers > 1:
+            logging.warning('The compiled RF is already parallel, PREDICT_WORKERS is ignored')
+        elif n_workers != None and n_workers > 1:
+            self.predict_executor = ThreadPoolExecutor(
+                self.config['PREDICT_WORKERS'])
+            
+        # Background writer of the output files
+        self._write_queue = None
+        self._writer = None
+        if self.config['WRITER_QUEUE'] > 0:
+            self._write_queue = Queue(self.config['WRITER_QUEUE'])
+            self._writer = threading.Thread(target = self._write_loop, 
+                                            daemon = True)
+            self._writer.start()
+            
+        # Features and QPE of the previous timestep
+        self.reset_state()
+        # Time at which every incoming timestep was first seen (streaming)
+        self._first_seen = {}
+            
+    def _start_executor(self, worker_type):
+        """
+        Starts the pool of workers used to preprocess the radars in parallel
+        
+        Parameters
+        ----------
+        worker_type : str
+            Either 'process' or 'thread', if the process pool can not be
+            created a thread pool is used instead
+        """
+        if self.executor != None:
+            self.executor.shutdown()
+            
+        n_workers = self.config['NUM_WORKERS']
+        if worker_type == 'process':
+            # The workers must not be forked, as this process runs other
+            # threads (prefetch, writer, retrieval) that may hold locks
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context('spawn')
+            try:
+                self.executor = ProcessPoolExecutor(n_workers, 
+                                                    mp_context = context)
+                return
+            except (NotImplementedError, OSError):
+                logging.warning('Could not start process pool, using threads instead')
+        elif worker_type != 'thread':
+            logging.error('Invalid WORKER_TYPE, using threads instead')
+        self.executor = ThreadPoolExecutor(n_workers)
+        
+    def _preprocess_radars(self, t, cosmo_data):
+        """
+        Preprocesses all radars for a given timestep, in parallel if 
+        NUM_WORKERS > 1
+        
+        Parameters
+        ----------
+        t : datetime
+            The timestep to process
+        cosmo_data : dict
+            dict of COSMO data at polar coordinates, as given by get_COSMO_T
+            
+        Returns
+        -------
+        A dict of the form dic[radar][sweep][field]
+        """
+        
+        jobs = {}
+        radardata = {}
+        for rad in self.config['RADARS']:
+            if (t not in self.radar_files.get(rad, {}).keys() or
+                t not in self.status_files.get(rad, {}).keys()):
+                logging.error('No data for radar {:s} at time {:s}'
+                              .format(rad, str(t)))
+                radardata[rad] = {}
+                continue
+            jobs[rad] = (rad, self.radar_files[rad][t], 
+                         self.status_files[rad][t], cosmo_data[rad],
+                         self.config, self.radar_fields)
+            
+        if self.executor == None:
+            for rad in jobs.keys():
+                radardata[rad] = _preprocess_radar(*jobs[rad])
+            return radardata
+        
+        try:
+            futures = {rad: self.executor.submit(_preprocess_radar, *jobs[rad])
+                       for rad in jobs.keys()}
+            for rad in futures.keys():
+                radardata[rad] = futures[rad].result()
+        except (BrokenProcessPool, pickle.PicklingError):
+            logging.warning('Process pool failed, using threads instead')
+            self._start_executor('thread')
+            futures = {rad: self.executor.submit(_preprocess_radar, *jobs[rad])
+                       for rad in jobs.keys()}
+            for rad in futures.keys():
+                radardata[rad] = futures[rad].result()
+        return radardata
+    
+    def _predict(self, model, X, out, idx):
+        """
+        Predicts with a RF model by blocks of PREDICT_CHUNK_SIZE rows, the 
+        blocks are processed in parallel if PREDICT_WORKERS > 1. If 
+        PREDICT_WORKERS is not set, all rows are predicted at once by the 
+        model, with its own n_jobs
+        
+        Parameters
+        ----------
+        model : RandomForestRegressorBC instance
+            the model to use
+        X : ndarray
+            2D array of features (rows x variables)
+        out : ndarray
+            preallocated 1D output array where to write the predictions
+        idx : ndarray
+            indexes of the rows of X in the output array
+        """
+        chunk = self.config['PREDICT_CHUNK_SIZE']
+        if self.config['PREDICT_WORKERS'] == None:
+            chunk = max(X.shape[0], 1)
+        jobs = [(model, X[i:i + chunk], out, idx[i:i + chunk]) 
+                for i in range(0, X.shape[0], chunk)]
+        
+        if self.predict_executor == None:
+            for job in jobs:
+                _predict_chunk(*job)
+            return
+        
+        futures = [self.predict_executor.submit(_predict_chunk, *job)
+                   for job in jobs]
+        for future in futures:
+            future.result()
+        
+    def _write_loop(self):
+        """
+        Writes the QPE fields put in the write queue one after the other,
+        this is meant to run in a background thread, it stops when it gets
+        None from the queue
+        """
+        while True:
+            job = self._write_queue.get()
+            if job == None:
+                self._write_queue.task_done()
+                break
+            filepath, qpe, catalog = job
+            try:
+                self._save(filepath, qpe, catalog)
+            except Exception as e:
+                logging.error('Could not write {:s}: {:s}'.format(filepath,
+                                                                  str(e)))
+            finally:
+                self._write_queue.task_done()
+                
+    def _save(self, filepath, qpe, catalog = None):
+        """
+        Writes a QPE field and adds it to the catalog of the output folder
+        
+        Parameters
+        ----------
+        filepath : str
+            Full path of the file to write, without extension
+        qpe : ndarray
+            2D array of precipitation intensities
+        catalog : tuple (optional)
+            (output_folder, model, timestep) of the file, if not provided the
+            catalog is not updated
+        """
+        folder_mtime = os.stat(os.path.dirname(filepath)).st_mtime_ns
+        filepath = _write_qpe(filepath, qpe, self.config['FILE_FORMAT'])
+        if catalog != None and self.config['QPE_CATALOG']:
+            try:
+                add_to_qpe_catalog(catalog[0], catalog[1], catalog[2], filepath,
+                                   folder_mtime)
+            except sqlite3.Error as e:
+                logging.error('Could not add {:s} to the catalog: {:s}'
+                              .format(filepath, str(e)))
+                
+    def _write(self, filepath, qpe, catalog = None):
+        """
+        Writes a QPE field, in the background if WRITER_QUEUE > 0, in which
+        case this only blocks if the queue is full
+        
+        Parameters
+        ----------
+        filepath : str
+            Full path of the file to write, without extension
+        qpe : ndarray
+            2D array of precipitation intensities, it must not be modified 
+            afterwards
+        catalog : tuple (optional)
+            (output_folder, model, timestep) of the file, see _save
+        """
+        if self._write_queue == None:
+            self._save(filepath, qpe, catalog)
+        else:
+            self._write_queue.put((filepath, qpe, catalog))
+            
+    def flush(self):
+        """
+        Waits until all QPE fields have been written to disk
+        """
+        if self._write_queue != None:
+            self._write_queue.join()
+            
+    def close(self):
+        """
+        Writes the pending QPE fields and stops all workers and background 
+        threads of the QPEProcessor, it can not compute anything afterwards
+        """
+        if self._writer != None:
+            self._write_queue.put(None)
+            self._writer.join()
+            self._writer = None
+            self._write_queue = None
+        if self.executor != None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.predict_executor != None:
+            self.predict_executor.shutdown()
+            self.predict_executor = None
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def _delete_files(self, t):
+        """
+        Deletes the polar and status files of a given timestep, once they 
+        have been read, files from the extraction cache are only unlinked 
+        and remain in the cache
+        
+        Parameters
+        ----------
+        t : datetime
+            The timestep for which to delete the files
+        """
+        for rad in self.config['RADARS']:
+            if t in self.radar_files.get(rad, {}).keys():
+                for f in self.radar_files[rad][t]:
+                    if os.path.exists(f):
+                        os.remove(f)
+            if t in self.status_files.get(rad, {}).keys():
+                if type(self.status_files[rad][t]) == bytes:
+                    continue # read in memory
+                if os.path.exists(self.status_files[rad][t]):
+                    os.remove(self.status_files[rad][t])
+                    
+    def _make_output_folders(self, output_folder):
+        """
+        Creates the output subfolders of all models
+        
+        Parameters
+        ----------
+        output_folder : str
+            Folder where to store the computed QPE fields
+        """
+        for model in self.models.keys():
+            if self.config['ADVECTION_CORRECTION']:
+                model += '_AC'
+            if not os.path.exists(str(Path(output_folder, model))):
+                os.makedirs(str(Path(output_folder, model)))
+                
+    def reset_state(self):
+        """
+        Discards the features and QPE of the previous timestep, the next 
+        timestep will be computed without temporal averaging and advection
+        correction
+        """
+        self.X_prev = {}
+        self.qpe_prev = {}
+        self.last_timestep = None
+        
     def fetch_data(self, t0, t1):
         """
         Retrieves and add new polar radar and status data to the QPEProcessor
@@ -191,23 +741,115 @@ class QPEProcessor(object):
             End time of the timerange in datetime format
         """
         
-        self.radar_files = {}
-        self.status_files = {}
+        self.radar_files, self.status_files = self._retrieve_files(t0, t1)
+        
+    def _retrieve_files(self, t0, t1):
+        """
+        Retrieves the polar radar and status files for a given time range
+        
+        Parameters
+        ----------
+        t0 : datetime
+            Start time of the timerange in datetime format
+        t1 : datetime
+            End time of the timerange in datetime format
+            
+        Returns
+        -------
+        radar_files : dict
+            the polar files in the form dict[radar][timestep]
+        status_files : dict
+            the status files in the form dict[radar][timestep]
+        """
+        
+        radar_files = {}
+        status_files = {}
 
-        # Retrieve polar files and lookup tables for all radars
+        # Retrieve polar and status files for all radars at once
+        requests = {}
+        for rad in self.config['RADARS']:
+            requests[(rad, 'ML')] = {'start_time': t0, 'end_time': t1,
+                                     'product_name': 'ML' + rad,
+                                     'sweeps': self.config['SWEEPS']}
+            # Status files can be read directly from the archive
+            requests[(rad, 'ST')] = {'start_time': t0, 'end_time': t1,
+                                     'product_name': 'ST' + rad,
+                                     'pattern': 'ST*.xml',
+                                     'in_memory': self.config['IN_MEMORY']}
+        logging.info('Retrieving data for radars ' + 
+                     ', '.join(self.config['RADARS']))
+        files = retrieve_many(self.config['TMP_FOLDER'], requests,
+                              self.config['RETRIEVAL_WORKERS'], self.cache,
+                              self.config['ARCHIVE_INDEX_FOLDER'])
+        
         for rad in self.config['RADARS']:
-            logging.info('Retrieving data for radar '+rad)
+            if (rad, 'ML') not in files.keys() or (rad, 'ST') not in files.keys():
+                logging.error('Failed to retrieve data for radar {:s}'.format(rad))
+            if (rad, 'ML') in files.keys():
+                radar_files[rad] = split_by_time(files[(rad, 'ML')])
+            if (rad, 'ST') in files.keys():
+                statfiles = files[(rad, 'ST')]
+                if self.config['IN_MEMORY']:
+                    status_files[rad] = {timefromfilename(f): statfiles[f]
+                                         for f in statfiles.keys()}
+                else:
+                    status_files[rad] = split_by_time(statfiles)
+        return radar_files, status_files
+    
+    def _prefetch(self, timeserie, queue, slots, stop):
+        """
+        Retrieves the files of all timesteps one after the other and puts 
+        them in a queue, this is meant to run in a background thread while 
+        the QPE is computed
+        
+        Parameters
+        ----------
+        timeserie : list of datetime
+            all timesteps to retrieve, in chronological order
+        queue : Queue instance
+            queue in which to put the retrieved files, in the form of tuples
+            (timestep, radar_files, status_files)
+        slots : Semaphore instance
+            a slot is taken before every retrieval and must be released by
+            the consumer once the files of a timestep have been deleted, 
+            this limits the number of timesteps that are on disk
+        stop : Event instance
+            if it is set, no more timesteps are retrieved
+        """
+        for t in timeserie:
+            slots.acquire()
+            if stop.is_set():
+                break
             try:
-                radfiles = retrieve_prod(self.config['TMP_FOLDER'], t0, t1, 
-                                   product_name = 'ML' + rad, 
-                                   sweeps = self.config['SWEEPS'])
-                self.radar_files[rad] = split_by_time(radfiles)
-                statfiles = retrieve_prod(self.config['TMP_FOLDER'], t0, t1, 
-                                   product_name = 'ST' + rad, pattern = 'ST*.xml')
-                self.status_files[rad] = split_by_time(statfiles)
+                radar_files, status_files = self._retrieve_files(t, t)
             except:
-                logging.error('Failed to retrieve data for radar {:s}'.format(rad))
-                
+                logging.error('Failed to retrieve data for time {:s}'.format(str(t)))
+                radar_files, status_files = {}, {}
+            queue.put((t, radar_files, status_files))
+            
+    def _add_files(self, radar_files, status_files):
+        """
+        Adds polar and status files, as given by _retrieve_files, to the 
+        files of the QPEProcessor
+        """
+        for rad in radar_files.keys():
+            self.radar_files.setdefault(rad, {}).update(radar_files[rad])
+        for rad in status_files.keys():
+            self.status_files.setdefault(rad, {}).update(status_files[rad])
+            
+    def _stop_prefetch(self, producer, queue, slots, stop):
+        """
+        Stops the background retrieval of compute and deletes the files of 
+        the timesteps that were retrieved but not processed
+        """
+        stop.set()
+        slots.release() # in case the producer waits for a slot
+        producer.join()
+        while not queue.empty():
+            t, radar_files, status_files = queue.get()
+            self._add_files(radar_files, status_files)
+            self._delete_files(t)
+            
     def compute(self, output_folder, t0, t1, timestep = 5,
                                                     basename = 'RF%y%j%H%M'):
         """
@@ -234,209 +876,461 @@ class QPEProcessor(object):
         
         """
         
-        for model in self.models.keys():
-            if self.config['ADVECTION_CORRECTION']:
-                model += '_AC'
-            if not os.path.exists(str(Path(output_folder, model))):
-                os.makedirs(str(Path(output_folder, model)))
-        
-        # Retrieve data for time range
-        self.fetch_data(t0, t1)
+        self._make_output_folders(output_folder)
         
         # Get all timesteps in time range
         n_incr = int((t1 - t0).total_seconds() / (60 * timestep))
         timeserie = t0 + np.array([datetime.timedelta(minutes = timestep * i) 
                             for i in range(n_incr + 1)])
         
-        qpe_prev = {}
-        X_prev = {}
+        prefetch = self.config['PREFETCH']
+        if prefetch > 0:
+            # Retrieve data in the background, at most prefetch timesteps
+            # ahead of the current one
+            self.radar_files = {rad: {} for rad in self.config['RADARS']}
+            self.status_files = {rad: {} for rad in self.config['RADARS']}
+            queue = Queue()
+            slots = threading.Semaphore(prefetch + 1)
+            stop = threading.Event()
+            producer = threading.Thread(target = self._prefetch,
+                                        args = (timeserie, queue, slots, stop),
+                                        daemon = True)
+            producer.start()
+        else:
+            # Retrieve data for time range
+            self.fetch_data(t0, t1)
         
-        for i, t in enumerate(timeserie): # Loop on timesteps
-            logging.info('====')
-            logging.info('Processing time '+str(t))
+        # Every time range starts without previous timestep
+        self.reset_state()
         
-            # Initialize RF features 
-            rf_features_cart = {}
-            weights_cart = {}
-            for var in self.model_weights_per_var.keys():
-                for weight in self.model_weights_per_var[var]:
-                    if weight not in rf_features_cart.keys():
-                        rf_features_cart[weight] = {}
-                        
-                    rf_features_cart[weight][var] = np.zeros((NBINS_X, NBINS_Y))   
-                
-                    # add weights
-                    if weight not in weights_cart.keys():
-                        weights_cart[weight] = np.zeros((NBINS_X, NBINS_Y)) 
-        
-            """Part one - compute radar variables and mask"""
-            # Get COSMO temperature for all radars for this timestamp
-            T_cosmo = get_COSMO_T(t, radar = self.config['RADARS'])
-            radobjects = {}
-            for rad in self.config['RADARS']:
-                radobjects[rad] = Radar(rad, self.radar_files[rad][t],
-                          self.status_files[rad][t])
-                radobjects[rad].visib_mask(self.config['VISIB_CORR']['MIN_VISIB'],
-                                 self.config['VISIB_CORR']['MAX_CORR'])
-                radobjects[rad].snr_mask(self.config['SNR_THRESHOLD'])
-                radobjects[rad].compute_kdp(self.config['KDP_PARAMETERS'])
-                radobjects[rad].add_cosmo_data(T_cosmo[rad])
-                
-                # Delete files
-                for f in self.radar_files[rad][t]:
-                    if os.path.exists(f):
-                        os.remove(f)
-                if os.path.exists(self.status_files[rad][t]):
-                    os.remove(self.status_files[rad][t])
-              
+        try:
+            for t in timeserie: # Loop on timesteps
+                if prefetch > 0:
+                    # Wait for the files of this timestep
+                    _, radar_files, status_files = queue.get()
+                    self._add_files(radar_files, status_files)
                 
-            for sweep in self.config['SWEEPS']: # Loop on sweeps
-                logging.info('---')
-                logging.info('Processing sweep ' + str(sweep))
+                try:
+                    self.process_timestep(t, output_folder, basename)
+                    self.last_timestep = t
+                finally:
+                    if prefetch > 0:
+                        # The files are normally already deleted
+                        self._delete_files(t)
+                        for rad in self.config['RADARS']:
+                            self.radar_files[rad].pop(t, None)
+                            self.status_files[rad].pop(t, None)
+                        slots.release()
+        finally:
+            if prefetch > 0:
+                self._stop_prefetch(producer, queue, slots, stop)
+            self.flush()
                 
-                for rad in self.config['RADARS']: # Loop on radars, A,D,L,P,W
-                    logging.info('Processing radar ' + str(rad))
-                    if sweep not in radobjects[rad].radsweeps.keys():
-                        continue
-                    try:
-                        """Part two - retrieve radar data at every sweep"""
-                        datasweep = {}
-                        ZH = np.ma.filled(radobjects[rad].get_field(sweep,'ZH'), 
-                                          np.nan)
-        
-                        for var in self.model_weights_per_var.keys():
-                            if 'RADAR' in var:
-                                datasweep['RADAR_{:s}'.format(rad)] = np.isfinite(ZH).astype(float)
-                            elif var == 'HEIGHT':
-                                datasweep['HEIGHT'] = self.rad_heights[rad][sweep].copy()
-                            else:
-                                datasweep[var] = np.ma.filled(radobjects[rad].get_field(sweep, var), 
-                                          np.nan)
+    def process_timestep(self, t, output_folder, basename = 'RF%y%j%H%M'):
+        """
+        Computes the QPE for a single timestep, from the radar files that
+        were added to the QPEProcessor, and stores it in a folder
+        
+        The features and QPE of the previous timestep are kept in the 
+        QPEProcessor and are used for the temporal averaging and the 
+        advection correction, use reset_state to discard them
+        
+        Parameters
+        ----------
+        t : datetime
+            The timestep to process
+        output_folder : str
+            Folder where to store the computed QPE fields, the subfolders for
+            every model must already exist
+        basename: str (optional)
+            Pattern for the filenames, default is  'RF%y%j%H%M'
+        """
+        logging.info('====')
+        logging.info('Processing time '+str(t))
+        
+        # Initialize RF features 
+        rf_features_cart = {}
+        weights_cart = {}
+        for var in self.model_weights_per_var.keys():
+            for weight in self.model_weights_per_var[var]:
+                if weight not in rf_features_cart.keys():
+                    rf_features_cart[weight] = {}
+                    
+                rf_features_cart[weight][var] = np.zeros((NBINS_X, NBINS_Y))   
+            
+                # add weights
+                if weight not in weights_cart.keys():
+                    weights_cart[weight] = np.zeros((NBINS_X, NBINS_Y)) 
     
-                        # Mask on minimum zh
-                        invalid = np.logical_or(np.isnan(ZH), 
-                                                ZH < self.config['ZH_THRESHOLD'])
-                        
-                        for var in datasweep.keys():
-                            # Because add.at does not support nan we replace by zero
-                            datasweep[var][invalid] = 0
+        """Part one - compute radar variables and mask"""
+        # Get COSMO temperature for all radars for this timestamp
+        T_cosmo = get_COSMO_T(t, radar = self.config['RADARS'])
+        radardata = self._preprocess_radars(t, T_cosmo)
+        
+        self._delete_files(t)
+            
+        for sweep in self.config['SWEEPS']: # Loop on sweeps
+            logging.info('---')
+            logging.info('Processing sweep ' + str(sweep))
+            
+            for rad in self.config['RADARS']: # Loop on radars, A,D,L,P,W
+                logging.info('Processing radar ' + str(rad))
+                if sweep not in radardata[rad].keys():
+                    continue
+                try:
+                    """Part two - retrieve radar data at every sweep"""
+                    datasweep = {}
+                    ZH = radardata[rad][sweep]['ZH']
+    
+                    for var in self.model_weights_per_var.keys():
+                        if 'RADAR' in var:
+                            datasweep['RADAR_{:s}'.format(rad)] = np.isfinite(ZH).astype(float)
+                        elif var == 'HEIGHT':
+                            datasweep['HEIGHT'] = self.rad_heights[rad][sweep].copy()
+                        else:
+                            datasweep[var] = radardata[rad][sweep][var]
+
+                    # Mask on minimum zh
+                    invalid = np.logical_or(np.isnan(ZH), 
+                                            ZH < self.config['ZH_THRESHOLD'])
+                    
+                    """Part three - convert to Cartesian"""
+                    proj = self.proj_operators[rad][sweep]
+                    
+                    for weight in rf_features_cart.keys():
+                        # Compute altitude weighting
+                        W = 10 ** (weight * (datasweep['HEIGHT']/1000.))
+                        W[invalid] = 0
                         
-                        """Part three - convert to Cartesian"""
-                        # get cart index of all polar gates for this sweep
-                        lut_elev = self.lut_cart[rad][self.lut_cart[rad][:,0]
-                                                        == sweep-1] # 0-indexed
+                        # Project all variables and the weights at once
+                        variables = [var for var in rf_features_cart[weight].keys()
+                                     if var in datasweep.keys()]
+                        stacked = [(W * datasweep[var]).ravel() 
+                                   for var in variables]
+                        stacked.append(W.ravel())
+                        stacked = np.array(stacked).T
+                        # Invalid gates do not contribute to the sum
+                        stacked[~np.isfinite(stacked)] = 0
                         
-                        # Convert from Swiss-coordinates to array index
-                        idx_ch = np.vstack((len(X_QPE_CENTERS)  -
-                                        (lut_elev[:,4] - np.min(X_QPE_CENTERS)),  
-                                        lut_elev[:,3] -  np.min(Y_QPE_CENTERS))).T
-                                                
-                        idx_ch = idx_ch.astype(int)
-                        idx_polar = [lut_elev[:,1], lut_elev[:,2]]
-            
-                        for weight in rf_features_cart.keys():
-                            # Compute altitude weighting
-                            W = 10 ** (weight * (datasweep['HEIGHT']/1000.))
-                            W[invalid] = 0
-                            
-                            for var in rf_features_cart[weight].keys():
-                                if var in datasweep.keys():
-                                    # Add variable to cart grid
-                                    nanadd_at(rf_features_cart[weight][var], 
-                                        idx_ch, (W * datasweep[var])[idx_polar])
-                            # Add weights to cart grid
-                            nanadd_at(weights_cart[weight], idx_ch, W[idx_polar])
-                    except:
-                        logging.error('Could not compute sweep {:d}'.format(sweep))
-                        pass
+                        cart = proj.dot(stacked)
                         
-           
-            """Part four - RF prediction"""
-            # Get QPE estimate
-            for k in self.models.keys():
-                model = self.models[k]
-                X = []
-                for v in model.variables:
-                    dat = rf_features_cart[model.beta][v] / weights_cart[model.beta]
-                    X.append(dat.ravel())
-                
-                X = np.array(X).T
-                if i == 0:
-                    X_prev[k] = X
+                        for j, var in enumerate(variables):
+                            # Add variable to cart grid
+                            rf_features_cart[weight][var] += np.reshape(
+                                cart[:,j], (NBINS_X, NBINS_Y))
+                        # Add weights to cart grid
+                        weights_cart[weight] += np.reshape(cart[:,-1], 
+                                                (NBINS_X, NBINS_Y))
+                except:
+                    logging.error('Could not compute sweep {:d}'.format(sweep))
+                    pass
                     
-                idx_zh = np.where(np.array(model.variables)
-                                  == 'zh_VISIB')[0][0]
-               
+       
+        """Part four - RF prediction"""
+        # Build the features only once for all models that share the same
+        # vertical weighting
+        features = {}
+        for beta in rf_features_cart.keys():
+            variables = list(rf_features_cart[beta].keys())
+            X = []
+            for v in variables:
+                dat = rf_features_cart[beta][v] / weights_cart[beta]
+                X.append(dat.ravel())
+                
+            X = np.array(X).T
+            if beta not in self.X_prev.keys():
+                self.X_prev[beta] = X
+                
+            Xcomb = np.nanmean((self.X_prev[beta] , X),axis = 0)
+            self.X_prev[beta]  = X
+            Xcomb[np.isnan(Xcomb)] = 0
+            
+            features[beta] = {'variables': variables, 'Xcomb': Xcomb,
+                              'positive': Xcomb > 0}
+            
+            if 'zh_VISIB' in variables:
+                idx_zh = variables.index('zh_VISIB')
                 rproxy = (X[:,idx_zh]/constants.A_QPE)**(1/constants.B_QPE)
                 rproxy[np.isnan(rproxy)] = 0
-
-                Xcomb = np.nanmean((X_prev[k] , X),axis = 0)
-                X_prev[k]  = X
-                
-                Xcomb[np.isnan(Xcomb)] = 0
                 rproxy_mean = (Xcomb[:,idx_zh]/constants.A_QPE)**(1/constants.B_QPE)
                 rproxy_mean[np.isnan(rproxy_mean)] = 0
                 
+                # Rescaling factor of the qpe through rproxy
+                disag = rproxy / rproxy_mean
+                disag = np.reshape(disag, (NBINS_X, NBINS_Y))
+                disag[np.isnan(disag)] = 0
+                features[beta]['disag'] = disag
+            
+        # The motion field of the advection correction is computed only once
+        # from the reference model, which is therefore processed first
+        reference = self.config['ADVECTION_REFERENCE']
+        if reference not in self.models.keys():
+            reference = list(self.models.keys())[0]
+        keys = sorted(self.models.keys(), key = lambda k: k != reference)
+        motion = None
+        
+        # Get QPE estimate
+        predictions = {}
+        qpe_models = []
+        for k in keys:
+            model = self.models[k]
+            feat = features[model.beta]
             
+            if id(model) not in predictions.keys():
+                # Columns of the model in the shared features
+                cols = [feat['variables'].index(v) for v in model.variables]
                 # Remove axis with only zeros
-                validrows = (Xcomb>0).any(axis=1)
+                validrows = feat['positive'][:,cols].any(axis=1)
             
                 qpe = np.zeros((NBINS_X, NBINS_Y), dtype = np.float32).ravel()
+                # Inputs are converted to float32 by the RF anyway
+                X = np.asarray(feat['Xcomb'][np.ix_(validrows, cols)],
+                               dtype = np.float32)
                 try:
-                    qpe[validrows] = self.models[k].predict(Xcomb[validrows,:])
-                except:
-                    logging.error('RF failed!')
-                    pass
-                
-                # Rescale qpe through rproxy
-                disag = rproxy / rproxy_mean
-                disag = np.reshape(disag, (NBINS_X, NBINS_Y))
-                qpe = np.reshape(qpe, (NBINS_X, NBINS_Y))
-                disag[np.isnan(disag)] = 0
-                qpe = qpe * disag
-               
-                
-                
+                    self._predict(model, X, qpe, np.where(validrows)[0])
+                except Exception as e:
+                    logging.error('RF failed! {:s}'.format(str(e)))
+                # Same model under several names is only evaluated once
+                predictions[id(model)] = qpe
+            
+            # Rescale qpe through rproxy
+            qpe = np.reshape(predictions[id(model)], (NBINS_X, NBINS_Y))
+            qpe_models.append(qpe * feat['disag'])
+            
+        # Postprocessing
+        if self.config['OUTLIER_REMOVAL']:
+            # All models at once
+            qpe_models = _outlier_removal(np.array(qpe_models), 
+                                          self.config['OUTLIER_WINDOW'])
             
-                # Postprocessing
-                if self.config['OUTLIER_REMOVAL']:
-                    qpe = _outlier_removal(qpe)
+        for k, qpe in zip(keys, qpe_models):
+            if self.config['GAUSSIAN_SIGMA'] > 0:
+                qpe = gaussian_filter(qpe,
+                   self.config['GAUSSIAN_SIGMA'])
+        
+            has_prev = k in self.qpe_prev.keys()
+            if not has_prev:
+                self.qpe_prev[k] = qpe
                 
-                if self.config['GAUSSIAN_SIGMA'] > 0:
-                    qpe = gaussian_filter(qpe,
-                       self.config['GAUSSIAN_SIGMA'])
+            comp = np.array([self.qpe_prev[k].copy(), qpe.copy()])
+            self.qpe_prev[k] = qpe
+            if self.config['ADVECTION_CORRECTION'] and has_prev:
+                if motion is None:
+                    motion = _motion_field(comp)
+                qpe = _disaggregate(comp, V = motion)
+             
             
-                if i == 0:
-                    qpe_prev[k] = qpe
-                    
-                comp = np.array([qpe_prev[k].copy(), qpe.copy()])
-                qpe_prev[k] = qpe
-                if self.config['ADVECTION_CORRECTION'] and i > 0:
-                    qpe = _disaggregate(comp)
-                 
+            tstr = datetime.datetime.strftime(t, basename)
+            model = k
+            if self.config['ADVECTION_CORRECTION']:
+                model += '_AC'
                 
-                tstr = datetime.datetime.strftime(t, basename)
-                filepath = output_folder + '/' + k
-                if self.config['ADVECTION_CORRECTION']:
-                    filepath += '_AC'
-                    
-                filepath += '/' + tstr
+            filepath = output_folder + '/' + model + '/' + tstr
+            
+            self._write(filepath, qpe, (output_folder, model, t))
                 
-                if self.config['FILE_FORMAT'] == 'DN' :
-                    # Find idx from CPC scale
-                    qpe = np.searchsorted(constants.SCALE_CPC, qpe)
-                    qpe = qpe.astype('B') # Convert to byte
-                    qpe[constants.MASK_NAN] = 255
-                    qpe.tofile(filepath)
 
-                elif self.config['FILE_FORMAT'] == 'DN_gif':
-                    qpe[constants.MASK_NAN] = -99
-                    filepath += '.gif'
-                    save_gif(filepath, qpe)
                 
-                else:
-                    if self.config['FILE_FORMAT'] != 'float':
-                        logging.error('Invalid file_format, using float instead')
-                    qpe[constants.MASK_NAN] = np.nan
-                    qpe.to_file(filepath)
-                    
+    def _scan_incoming(self, input_folder, min_age = 10):
+        """
+        Lists the polar and status files that are present in a folder
+        
+        Parameters
+        ----------
+        input_folder : str
+            Folder where the radar files are delivered
+        min_age : int (optional)
+            Files that were modified less than min_age seconds ago are 
+            ignored, as they may still be being written. Hidden files are 
+            always ignored, so that files can also be written with a hidden 
+            name and renamed once complete
+            
+        Returns
+        -------
+        radar_files : dict
+            the polar files in the form dict[timestep][radar]
+        status_files : dict
+            the status files in the form dict[timestep][radar]
+        """
+        radar_files = {}
+        status_files = {}
+        now = time.time()
+        for f in sorted(glob.glob(str(Path(input_folder, '*')))):
+            bname = os.path.basename(f)
+            rad = bname[2:3]
+            if rad not in self.config['RADARS']:
+                continue
+            try:
+                if now - os.path.getmtime(f) < min_age:
+                    continue # Still being written
+                t = timefromfilename(f)
+                if bname.startswith('ML'):
+                    if sweepnumber_fromfile(f) not in self.config['SWEEPS']:
+                        continue
+                    radar_files.setdefault(t, {}).setdefault(rad, []).append(f)
+                elif bname.startswith('ST') and bname.endswith('.xml'):
+                    status_files.setdefault(t, {})[rad] = f
+            except (ValueError, OSError):
+                continue # Not a radar file or removed in the meantime
+        return radar_files, status_files
+    
+    def _remove_incoming(self, radar_files, status_files, t):
+        """
+        Deletes all polar and status files of a timestep from the folder 
+        where they are delivered
+        
+        Parameters
+        ----------
+        radar_files : dict
+            the polar files in the form dict[timestep][radar], as given by 
+            _scan_incoming
+        status_files : dict
+            the status files in the form dict[timestep][radar], as given by 
+            _scan_incoming
+        t : datetime
+            The timestep for which to delete the files
+        """
+        files = [f for rad_files in radar_files.get(t, {}).values() 
+                 for f in rad_files]
+        files.extend(status_files.get(t, {}).values())
+        for f in files:
+            if os.path.exists(f):
+                os.remove(f)
+                
+    def process_next(self, input_folder, output_folder, timeout = 300,
+                     timestep = 5, min_age = 10, basename = 'RF%y%j%H%M'):
+        """
+        Looks for the oldest new timestep in a folder where radar files are 
+        delivered in real-time and computes its QPE, if all radars have 
+        arrived or if the timeout has expired. The processed files are deleted
+        from the folder.
+        
+        Parameters
+        ----------
+        input_folder : str
+            Folder where the polar (ML*) and status (ST*.xml) files are 
+            delivered
+        output_folder : str
+            Folder where to store the computed QPE fields, note that subfolders
+            for every model will be created in this folder
+        timeout : int (optional)
+            Maximum time in seconds to wait for missing radars or sweeps since
+            the first file of a timestep was seen, after that the timestep is
+            computed with the radars that are available
+        timestep : int (optional)
+            Time in minutes between two timesteps, if the previous computed
+            timestep is older than that, the new one is computed without 
+            temporal averaging and advection correction
+        min_age : int (optional)
+            Files that were modified less than min_age seconds ago are 
+            considered incomplete and ignored, see _scan_incoming
+        basename: str (optional)
+            Pattern for the filenames, default is  'RF%y%j%H%M'
+            
+        Returns
+        -------
+        The timestep that was processed as a datetime, or None if no timestep
+        is ready yet
+        """
+        radar_files, status_files = self._scan_incoming(input_folder, min_age)
+        
+        timesteps = sorted(set(radar_files.keys()) | set(status_files.keys()))
+        if self.last_timestep != None:
+            # Files that arrived too late can not be processed anymore
+            for t in timesteps:
+                if t <= self.last_timestep:
+                    logging.warning('Removing files of {:s}, which arrived too late'
+                                    .format(str(t)))
+                    self._remove_incoming(radar_files, status_files, t)
+            timesteps = [t for t in timesteps if t > self.last_timestep]
+            
+        if not len(timesteps):
+            return None
+        
+        t = timesteps[0]
+        if t not in self._first_seen.keys():
+            self._first_seen[t] = time.time()
+        
+        # Radars for which the status file and all sweeps are available
+        complete = [rad for rad in self.config['RADARS'] 
+                    if rad in status_files.get(t, {}).keys() and
+                    len(radar_files.get(t, {}).get(rad, [])) == 
+                        len(self.config['SWEEPS'])]
+        
+        if len(complete) < len(self.config['RADARS']):
+            if time.time() - self._first_seen[t] < timeout:
+                return None
+            logging.warning('Timeout expired for time {:s}, only {:d} complete radars'
+                            .format(str(t), len(complete)))
+        
+        self.radar_files = {rad: {} for rad in self.config['RADARS']}
+        self.status_files = {rad: {} for rad in self.config['RADARS']}
+        for rad in radar_files.get(t, {}).keys():
+            if rad in status_files.get(t, {}).keys():
+                self.radar_files[rad][t] = radar_files[t][rad]
+                self.status_files[rad][t] = status_files[t][rad]
+        
+        self._first_seen.pop(t)
+        if not any(len(self.radar_files[rad]) for rad in self.radar_files):
+            logging.error('No usable radar data for time {:s}, removing its files'
+                          .format(str(t)))
+            self._remove_incoming(radar_files, status_files, t)
+            return None
+                
+        # The previous timestep can only be used if it is the one just before
+        if (self.last_timestep != None and 
+            t - self.last_timestep > datetime.timedelta(minutes = timestep)):
+            logging.warning('Missing timesteps before {:s}, starting over'
+                            .format(str(t)))
+            self.reset_state()
+            
+        self._make_output_folders(output_folder)
+        try:
+            self.process_timestep(t, output_folder, basename)
+        except Exception:
+            logging.exception('Could not compute QPE for time {:s}'
+                              .format(str(t)))
+        finally:
+            self._delete_files(t)
+            # Also the files of the radars that could not be used
+            self._remove_incoming(radar_files, status_files, t)
+            
+        self.last_timestep = t
+        return t
+    
+    def run_forever(self, input_folder, output_folder, timeout = 300,
+                    poll_interval = 10, timestep = 5, min_age = 10, 
+                    basename = 'RF%y%j%H%M'):
+        """
+        Computes the QPE in real-time, by polling a folder where radar files
+        are delivered, every timestep is computed as soon as all radars have
+        arrived or after a timeout, the features and QPE of the previous
+        timestep are kept in memory
+        
+        Parameters
+        ----------
+        input_folder : str
+            Folder where the polar (ML*) and status (ST*.xml) files are 
+            delivered
+        output_folder : str
+            Folder where to store the computed QPE fields, note that subfolders
+            for every model will be created in this folder
+        timeout : int (optional)
+            Maximum time in seconds to wait for missing radars or sweeps, 
+            see process_next
+        poll_interval : int (optional)
+            Time in seconds between two checks of the input folder
+        timestep : int (optional)
+            Time in minutes between two timesteps, see process_next
+        min_age : int (optional)
+            Minimal age in seconds of the files to process, see process_next
+        basename: str (optional)
+            Pattern for the filenames, default is  'RF%y%j%H%M'
+        """
+        try:
+            while True:
+                if self.process_next(input_folder, output_folder, timeout,
+                                     timestep, min_age, basename) == None:
+                    time.sleep(poll_interval)
+        finally:
+            self.close()
@@ -43,6 +43,14 @@ def main():
                       ', please note the double and single quotes, which are required',
                       metavar="MODELS")
     
+    parser.add_option("-w", "--watch", dest = "watch", type = str,
+                      default = None, help="Path of a folder where radar files are delivered in real-time, if specified the QPE is computed continuously for every new timestep and --start and --end are ignored",
+                      metavar="WATCH")
+    
+    parser.add_option("-t", "--timeout", dest = "timeout", type = int,
+                      default = 300, help="Only with --watch, maximum time in seconds to wait for missing radars before computing a timestep, default is 300",
+                      metavar="TIMEOUT")
+    
     (options, args) = parser.parse_args()
     
     if options.config == None:
@@ -56,8 +64,13 @@ def main():
     if not os.path.exists(options.outputfolder):
         os.makedirs(options.outputfolder)
         
-    options.start = datetime.datetime.strptime(options.start, '%Y%m%d%H%M')
-    options.end = datetime.datetime.strptime(options.end, '%Y%m%d%H%M')
-    
-    qpe = QPEProcessor(options.config, options.models)
-    qpe.compute(options.outputfolder, options.start, options.end)
+    with QPEProcessor(options.config, options.models) as qpe:
+        if options.watch != None:
+            qpe.run_forever(options.watch, options.outputfolder, 
+                            options.timeout)
+        else:
+            options.start = datetime.datetime.strptime(options.start, 
+                                                       '%Y%m%d%H%M')
+            options.end = datetime.datetime.strptime(options.end, 
+                                                     '%Y%m%d%H%M')
+            qpe.compute(options.outputfolder, options.start, options.end)
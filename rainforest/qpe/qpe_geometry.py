@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line script to compile the geometry plans used by the RandomForest QPE
+
+see :ref:`qpe_geometry` 
+"""
+
+# Global imports
+import logging
+logging.basicConfig(level=logging.INFO)
+from optparse import OptionParser
+
+# Local imports
+from rainforest.qpe.geometry import compile_geometry, GEOMETRY_FOLDER
+
+def main():
+    parser = OptionParser()
+    
+    parser.add_option("-o", "--output", dest = "outputfolder", type = str,
+                      help="Path of the output folder, default is the qpe_geometry folder within the lookup tables folder",
+                      default = GEOMETRY_FOLDER, metavar="OUTPUT")
+    
+    parser.add_option("-r", "--radars", dest = "radars", type = str,
+                      help="Specify for which radars you want to compile the plans, default is to use all, must be comma separated, e.g. 'A,D,L'",
+                      default = None, metavar="RADARS")
+    
+    parser.add_option("-s", "--sweeps", dest = "sweeps", type = str,
+                      help="Specify for which sweeps you want to compile the plans, default is to use all 20, must be comma separated, e.g. '1,2,3'",
+                      default = None, metavar="SWEEPS")
+    
+    (options, args) = parser.parse_args()
+    
+    if options.radars != None:
+        options.radars = [r.strip() for r in options.radars.split(',')]
+    if options.sweeps != None:
+        options.sweeps = [int(s) for s in options.sweeps.split(',')]
+        
+    compile_geometry(options.radars, options.sweeps, options.outputfolder)
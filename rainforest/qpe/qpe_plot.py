@@ -109,6 +109,7 @@ def main():
         options.models = options.models.split(',')
         options.models = [m.strip() for m in options.models]
             
+    # The catalog of the folder is used if it exists
     all_files = get_qpe_files(options.inputfolder, options.start, options.end,
                               list_models = options.models)
     
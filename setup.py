@@ -25,6 +25,7 @@ setup(name        = "rainforest",
         entry_points = {
             'console_scripts':['rainforest_interface =  rainforest.interface:main',
                                'qpe_compute = rainforest.qpe.qpe_compute:main',
+                               'qpe_geometry = rainforest.qpe.qpe_geometry:main',
                                'qpe_plot = rainforest.qpe.qpe_plot:main',
                                'qpe_evaluation = rainforest.qpe.qpe_evaluation:main',
                                'db_populate = rainforest.database.db_populate:main',
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares the numpy least-square KDP (kdp_leastsquare, METHOD: 'numpy' in
+KDP_PARAMETERS) with the pyart function kdp_leastsquare_single_window on
+synthetic sweeps with masked gates, for an odd and an even window length,
+including the gates at the edges of the range. The sweeps are also
+processed at once with Radar._compute_kdp_stack, as in the QPE, with
+sweeps of different sizes and one sweep shorter than half of the window
+
+Usage: python check_kdp_leastsquare.py
+
+The script exits with a non-zero status if the results differ
+"""
+
+import sys
+import copy
+import numpy as np
+from pyart.testing import make_empty_ppi_radar
+from pyart.retrieve import kdp_leastsquare_single_window
+
+from rainforest.common.radarprocessing import Radar, kdp_leastsquare
+
+R_RES = 500. # range resolution in m
+RWIND = 3000. # length of the window in m, i.e. 6 gates (even)
+ATOL = 1E-6 # deg/km
+
+def synthetic_sweep(nrays, ngates, seed):
+    """
+    Creates a pyart sweep with a PHIDP field that increases along the range
+    with noise, random masked gates, a masked block and masked edge gates
+    """
+    rng = np.random.default_rng(seed)
+    radsweep = make_empty_ppi_radar(ngates, nrays, 1)
+    radsweep.range['data'] = R_RES / 2 + R_RES * np.arange(ngates)
+
+    kdp = np.abs(rng.normal(0.5, 1., (nrays, ngates)))
+    phidp = 2 * np.cumsum(kdp, axis = 1) * R_RES / 1000.
+    phidp += rng.normal(0., 1., phidp.shape)
+
+    mask = rng.random(phidp.shape) < 0.2
+    mask[:nrays // 4, ngates // 3:ngates // 3 + 10] = True
+    mask[nrays // 2, :3] = True
+    mask[nrays // 2 + 1, -3:] = True
+    mask[-1, :] = True
+    radsweep.add_field('PHIDP', {'data': np.ma.array(phidp, mask = mask)})
+    return radsweep
+
+def compare(name, kdp, kdp_ref):
+    """
+    Compares a KDP array with the reference, returns True if they are equal
+    """
+    kdp = np.ma.asarray(kdp)
+    kdp_ref = np.ma.asarray(kdp_ref)
+    mask = np.ma.getmaskarray(kdp)
+    mask_ref = np.ma.getmaskarray(kdp_ref)
+
+    ok = True
+    if np.any(mask != mask_ref):
+        print('{:s}: {:d} gates are masked in only one of the results'
+              .format(name, np.sum(mask != mask_ref)))
+        ok = False
+    both = ~mask & ~mask_ref
+    diff = np.abs(np.ma.getdata(kdp)[both] - np.ma.getdata(kdp_ref)[both])
+    err = np.max(diff, initial = 0)
+    if err > ATOL:
+        print('{:s}: maximum difference of {:f} deg/km'.format(name, err))
+        ok = False
+    if ok:
+        print('{:s}: OK, {:d} valid gates, maximum difference of {:g} deg/km'
+              .format(name, np.sum(both), err))
+    return ok
+
+def main():
+    ok = True
+
+    # Single sweep, odd and even windows
+    radsweep = synthetic_sweep(120, 200, 0)
+    for wind_len in [7, 6]:
+        min_valid = int(wind_len / 2 + 1)
+        kdp_ref = kdp_leastsquare_single_window(radsweep,
+                    wind_len = wind_len, min_valid = min_valid,
+                    phidp_field = 'PHIDP', kdp_field = 'KDP',
+                    vectorize = True)['data']
+        kdp = kdp_leastsquare(radsweep.fields['PHIDP']['data'],
+                              radsweep.range['data'] / 1000., wind_len,
+                              min_valid)
+        ok = compare('kdp_leastsquare, wind_len = {:d}'.format(wind_len),
+                     kdp, kdp_ref) and ok
+
+    # Several sweeps of different sizes at once, as in the QPE
+    radar = Radar.__new__(Radar)
+    radar.sweeps = [1, 2, 3]
+    radar.radsweeps = {1: synthetic_sweep(120, 200, 1),
+                       2: synthetic_sweep(90, 150, 2),
+                       3: synthetic_sweep(60, 2, 3)}
+    radar._kdp_params = {'RWIND': RWIND, 'METHOD': 'pyart'}
+    reference = copy.deepcopy(radar)
+    for s in [1, 2]:
+        reference._compute_kdp(s, 'KDP')
+
+    radar._kdp_params['METHOD'] = 'numpy'
+    radar._compute_kdp_stack()
+    for s in [1, 2]:
+        ok = compare('_compute_kdp_stack, sweep {:d}'.format(s),
+                     radar.radsweeps[s].fields['KDP']['data'],
+                     reference.radsweeps[s].fields['KDP']['data']) and ok
+
+    # The sweep that is shorter than half of the window has no valid KDP
+    kdp = np.ma.asarray(radar.radsweeps[3].fields['KDP']['data'])
+    if np.all(np.ma.getmaskarray(kdp)):
+        print('_compute_kdp_stack, sweep 3: OK, all gates are masked')
+    else:
+        print('_compute_kdp_stack, sweep 3: {:d} gates are not masked'
+              .format(np.sum(~np.ma.getmaskarray(kdp))))
+        ok = False
+
+    return ok
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)